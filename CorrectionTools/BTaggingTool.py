@@ -7,12 +7,14 @@
 # https://twiki.cern.ch/twiki/bin/viewauth/CMS/BtagRecommendation102X
 from CorrectionTools import modulepath
 from array import array
-from ScaleFactorTool import ensureTFile
+import csv, math, __future__
+import numpy as num
+from ScaleFactorTool import ensureTFile, getTH2Arrays, getPayloadKey, ScaleFactorTable
+from PayloadCache import loadPayload
 import ROOT
-#ROOT.gROOT.ProcessLine('.L ./BTagCalibrationStandalone.cpp+')
-from ROOT import TH2F, BTagCalibration, BTagCalibrationReader
-from ROOT.BTagEntry import OP_LOOSE, OP_MEDIUM, OP_TIGHT, OP_RESHAPING
-from ROOT.BTagEntry import FLAV_B, FLAV_C, FLAV_UDSG
+from ROOT import TH2F
+OP_LOOSE, OP_MEDIUM, OP_TIGHT, OP_RESHAPING = 0, 1, 2, 3 # as in BTagEntry
+FLAV_B, FLAV_C, FLAV_UDSG = 0, 1, 2
 path = modulepath+"/btag/"
 
 
@@ -49,16 +51,135 @@ class BTagWPs:
         self.tight    = 0.9693
   
 
+class BTagCalibrationTable:
+    """SFs of one jet flavor from the entries of a BTagCalibration CSV file, evaluated like
+    BTagCalibrationReader::eval, with the formula of the first entry containing |eta| and pT,
+    and 0 outside all entries. The formulas are pre-evaluated on a grid of pT nodes, with a step
+    of at most ptstep within each pT range of the entries, and bins of |eta| between the edges
+    of the entries, and linearly interpolated in pT, for all jets at once. With exact=True,
+    the formulas are evaluated for each jet instead, which needs the entries."""
+    
+    def __init__(self, etaedges, ptnodes, lovals, hivals, entries=None):
+        self.etaedges = num.array(etaedges,dtype=num.float64)
+        self.ptnodes  = num.array(ptnodes,dtype=num.float64)
+        self.lovals   = num.array(lovals,dtype=num.float64).reshape(max(len(self.etaedges)-1,0),max(len(self.ptnodes)-1,0))
+        self.hivals   = num.array(hivals,dtype=num.float64).reshape(self.lovals.shape)
+        self.entries  = entries
+        self.funcs    = [compileFormula(entry[4]) for entry in entries] if entries else None
+        
+    @staticmethod
+    def fromEntries(entries, ptstep=0.25):
+        """Create a table from the entries of one flavor, see readCalibrationEntries."""
+        etaedges = sorted(set(max(0.,bound) for entry in entries for bound in entry[0:2])) # for |eta|
+        ptbounds = sorted(set(bound for entry in entries for bound in entry[2:4]))
+        ptnodes  = [ ]
+        for ptmin, ptmax in zip(ptbounds[:-1],ptbounds[1:]):
+          nsteps = max(1,int(math.ceil((ptmax-ptmin)/ptstep)))
+          ptnodes.extend(num.linspace(ptmin,ptmax,nsteps+1)[:-1])
+        ptnodes.extend(ptbounds[-1:])
+        etaedges, ptnodes = num.array(etaedges,dtype=num.float64), num.array(ptnodes,dtype=num.float64)
+        neta, npt = max(len(etaedges)-1,0), max(len(ptnodes)-1,0)
+        lovals, hivals = num.zeros((neta,npt)), num.zeros((neta,npt))
+        if neta>0 and npt>0:
+          # each interval (lo,hi] of pT nodes lies within the pT range of one entry
+          funcs  = [compileFormula(entry[4]) for entry in entries]
+          abseta = num.repeat(0.5*(etaedges[:-1]+etaedges[1:]),npt)
+          ptlo   = num.tile(ptnodes[:-1],neta)
+          pthi   = num.tile(ptnodes[1:],neta)
+          index  = matchEntries(entries,abseta,pthi)
+          lovals = evalEntries(funcs,index,ptlo).reshape(neta,npt)
+          hivals = evalEntries(funcs,index,pthi).reshape(neta,npt)
+        return BTagCalibrationTable(etaedges,ptnodes,lovals,hivals,entries)
+        
+    @staticmethod
+    def fromPayload(payload, prefix=""):
+        """Create a table from the arrays of a payload, see getPayload."""
+        return BTagCalibrationTable(payload[prefix+'etaedges'],payload[prefix+'ptnodes'],
+                                    payload[prefix+'lovals'],payload[prefix+'hivals'])
+        
+    def getPayload(self, prefix=""):
+        """Return the arrays of the grid."""
+        return { prefix+'etaedges': self.etaedges, prefix+'ptnodes': self.ptnodes,
+                 prefix+'lovals':   self.lovals,   prefix+'hivals':  self.hivals }
+        
+    def eval(self, abseta, pt):
+        """Get the SFs for arrays of |eta| and pT from the grid."""
+        abseta = num.asarray(abseta,dtype=num.float32).astype(num.float64) # single precision, as in BTagCalibrationReader
+        pt     = num.asarray(pt,dtype=num.float32).astype(num.float64)
+        sfs    = num.zeros(len(pt))
+        if self.lovals.size==0:
+          return sfs
+        ieta   = num.searchsorted(self.etaedges,abseta,side='right')-1
+        ieta[abseta==self.etaedges[-1]] = len(self.etaedges)-2 # upper edge is included
+        ipt    = num.searchsorted(self.ptnodes,pt,side='left')-1 # intervals (lo,hi]
+        valid  = (ieta>=0) & (ieta<len(self.etaedges)-1) & (ipt>=0) & (ipt<len(self.ptnodes)-1)
+        ieta, ipt, pt = ieta[valid], ipt[valid], pt[valid]
+        frac   = (pt-self.ptnodes[ipt])/(self.ptnodes[ipt+1]-self.ptnodes[ipt])
+        sfs[valid] = self.lovals[ieta,ipt]*(1.-frac) + self.hivals[ieta,ipt]*frac
+        return sfs
+        
+    def evalExact(self, abseta, pt):
+        """Get the SFs for arrays of |eta| and pT from the formulas of the entries."""
+        abseta = num.asarray(abseta,dtype=num.float32).astype(num.float64)
+        pt     = num.asarray(pt,dtype=num.float32).astype(num.float64)
+        return evalEntries(self.funcs,matchEntries(self.entries,abseta,pt),pt)
+    
+
+def readCalibrationFile(filename):
+  """Read all entries of a BTagCalibration CSV file, as a dictionary with tuples of
+  (operating point, measurement type, systematic type, jet flavor) as keys, e.g.
+  (OP_MEDIUM,'comb','up',FLAV_B), and lists of (etaMin, etaMax, ptMin, ptMax, formula)
+  in order of the file as values, with the bounds in single precision."""
+  entries = { }
+  with open(filename) as file:
+    for row in csv.reader(file,skipinitialspace=True):
+      if len(row)<11 or not row[0].strip().isdigit(): # header
+        continue
+      key    = (int(row[0]),row[1].strip(),row[2].strip(),int(row[3]))
+      bounds = [float(num.float32(bound)) for bound in row[4:8]]
+      entries.setdefault(key,[ ]).append(tuple(bounds)+(row[10].strip(),))
+  return entries
+  
+formulaFunctions = { 'log': num.log, 'exp': num.exp, 'sqrt': num.sqrt, 'pow': num.power, 'abs': num.abs,
+                     'max': num.maximum, 'min': num.minimum }
+def compileFormula(formula):
+  """Compile the formula of a BTagCalibration entry into a function of an array of pT."""
+  code = compile(formula.replace('TMath::',''),'<formula>','eval',__future__.division.compiler_flag)
+  return lambda x: num.broadcast_to(eval(code,{'__builtins__': None},dict(formulaFunctions,x=x)),x.shape)
+  
+def matchEntries(entries, abseta, pt):
+  """Get the index of the first entry containing each pair of |eta| and pT, or -1."""
+  index = num.full(len(pt),-1,dtype=num.int64)
+  for i, (etamin, etamax, ptmin, ptmax, formula) in enumerate(entries):
+    index[(index<0) & (etamin<=abseta) & (abseta<=etamax) & (ptmin<pt) & (pt<=ptmax)] = i
+  return index
+  
+def evalEntries(funcs, index, x):
+  """Evaluate the formula of the matched entries for an array of x, or return 0 if none."""
+  values = num.zeros(len(x))
+  for i, func in enumerate(funcs):
+    matched = index==i
+    if matched.any():
+      values[matched] = func(x[matched])
+  return values
+  
+
+
 class BTagWeightTool:
     
-    def __init__(self, tagger, wp='medium', sigma='central', channel='mutau', year=2017):
-        """Load b tag weights from CSV file."""
-        print "Loading BTagWeightTool for %s (%s WP)..."%(tagger,wp)
+    def __init__(self, tagger, wp='medium', sigma='central', channel='mutau', year=2017, exact=False, ptstep=0.25, wps=[ ], sigmas=[ ]):
+        """Load b tag weights from CSV file. The SFs are evaluated from a grid with a pT step
+        of ptstep, or exactly from the formulas, if exact=True. Besides the default WP and
+        systematic type, the variations for all combinations of the WPs in wps and
+        the types in sigmas are loaded from the same CSV file (see getWeightVariations)."""
+        wps    = [wp]+[w for w in wps if w!=wp]
+        sigmas = [sigma]+[s for s in sigmas if s!=sigma]
+        print "Loading BTagWeightTool for %s (%s WP)..."%(tagger,', '.join(wps))
         
         assert(year in [2016,2017,2018]), "You must choose a year from: 2016, 2017, or 2018."
         assert(tagger in ['CSVv2','DeepCSV']), "BTagWeightTool: You must choose a tagger from: CSVv2, DeepCSV!"
-        assert(wp in ['loose','medium','tight']), "BTagWeightTool: You must choose a WP from: loose, medium, tight!"
-        assert(sigma in ['central','up','down']), "BTagWeightTool: You must choose a WP from: central, up, down!"
+        assert(all(w in ['loose','medium','tight'] for w in wps)), "BTagWeightTool: You must choose a WP from: loose, medium, tight!"
+        assert(all(s in ['central','up','down'] for s in sigmas)), "BTagWeightTool: You must choose a WP from: central, up, down!"
         #assert(channel in ['mutau','eletau','tautau','mumu']), "BTagWeightTool: You must choose a channel from: mutau, eletau, tautau, mumu!"
         
         # FILE
@@ -85,21 +206,31 @@ class BTagWeightTool:
             effname = path+'CSVv2_2018_Autumn18_eff.root'
         
         # TAGGING WP
-        self.wp     = getattr(BTagWPs(tagger,year),wp)
+        wpcuts      = dict((w,getattr(BTagWPs(tagger,year),w)) for w in wps)
+        self.wp     = wpcuts[wp]
         if 'deep' in tagger.lower():
-          tagged = lambda e,i: e.Jet_btagDeepB[i]>self.wp
+          self.discriminator = 'Jet_btagDeepB'
+          tagged = lambda e,i,w=self.wp: e.Jet_btagDeepB[i]>w
         else:
-          tagged = lambda e,i: e.Jet_btagCSVV2[i]>self.wp
+          self.discriminator = 'Jet_btagCSVV2'
+          tagged = lambda e,i,w=self.wp: e.Jet_btagCSVV2[i]>w
         
-        # CSV READER
-        op        = OP_LOOSE if wp=='loose' else OP_MEDIUM if wp=='medium' else OP_TIGHT if wp=='tight' else OP_RESHAPING
+        # CSV TABLES
+        ops       = dict((w,OP_LOOSE if w=='loose' else OP_MEDIUM if w=='medium' else OP_TIGHT if w=='tight' else OP_RESHAPING) for w in wps)
         type_udsg = 'incl'
         type_bc   = 'comb' # 'mujets' for QCD; 'comb' for QCD+TT
-        calib     = BTagCalibration(tagger, csvname)
-        reader    = BTagCalibrationReader(op, sigma)
-        reader.load(calib, FLAV_B, type_bc)
-        reader.load(calib, FLAV_C, type_bc)
-        reader.load(calib, FLAV_UDSG, type_udsg)
+        types     = [(FLAV_B,type_bc),(FLAV_C,type_bc),(FLAV_UDSG,type_udsg)]
+        variations = [(w,s) for w in wps for s in sigmas]
+        def buildcalib():
+          entries = readCalibrationFile(csvname) # parse once for all variations
+          return dict(((w,s,flav),BTagCalibrationTable.fromEntries(entries.get((ops[w],type,s,flav),[ ]),ptstep))
+                      for w, s in variations for flav, type in types)
+        if exact:
+          calib   = buildcalib()
+        else:
+          payload = loadPayload(getPayloadKey('BTagCalibration',csvname,str(ptstep),*['%s_%s'%v for v in variations]),[csvname],
+                                lambda: getCalibrationPayload(buildcalib()),year=year)
+          calib   = dict(((w,s,flav),BTagCalibrationTable.fromPayload(payload,"%s_%s_%d_"%(w,s,flav))) for w, s in variations for flav, type in types)
         
         # EFFICIENCIES
         ptbins     = array('d',[10,20,30,50,70,100,140,200,300,500,1000,1500])
@@ -107,65 +238,162 @@ class BTagWeightTool:
         bins       = (len(ptbins)-1,ptbins,len(etabins)-1,etabins)
         hists      = { }
         effs       = { }
-        efffile    = ensureTFile(effname)
-        for flavor in [0,4,5]:
-          flavor   = flavorToString(flavor)
-          histname = "%s_%s_%s"%(tagger,flavor,wp)
-          effname  = "%s/eff_%s_%s_%s"%(channel,tagger,flavor,wp)
-          hists[flavor]        = TH2F(histname,histname,*bins)
-          hists[flavor+'_all'] = TH2F(histname+'_all',histname+'_all',*bins)
-          effs[flavor]         = efffile.Get(effname)
-          hists[flavor].SetDirectory(0)
-          hists[flavor+'_all'].SetDirectory(0)
-          effs[flavor].SetDirectory(0)
-        efffile.Close()
-        
-        self.tagged = tagged
-        self.calib  = calib
-        self.reader = reader
-        self.hists  = hists
-        self.effs   = effs
+        for w in wps:
+          payload  = loadPayload(getPayloadKey('BTagWeightTool',effname,channel,tagger,w),[effname],
+                                 lambda: getEfficiencyArrays(effname,channel,tagger,w),year=year)
+          effs[w]  = { }
+          for flavor in [0,4,5]:
+            flavor   = flavorToString(flavor)
+            histname = "%s_%s_%s"%(tagger,flavor,w)
+            hists[histname]        = TH2F(histname,histname,*bins)
+            hists[histname+'_all'] = TH2F(histname+'_all',histname+'_all',*bins)
+            effs[w][flavor]        = ScaleFactorTable.fromPayload(payload,flavor+'_') # eta (x) vs. pT (y)
+            hists[histname].SetDirectory(0)
+            hists[histname+'_all'].SetDirectory(0)
+        
+        self.tagger     = tagger
+        self.wpname     = wp
+        self.sigma      = sigma
+        self.wpcuts     = wpcuts
+        self.variations = variations
+        self.tagged     = tagged
+        self.exact      = exact
+        self.calib      = calib
+        self.hists      = hists
+        self.effs       = effs
+        self.ptbins     = num.array(ptbins,dtype=num.float64)
+        self.etabins    = num.array(etabins,dtype=num.float64)
+        self.counts     = dict((histname,num.zeros((len(ptbins)+1)*(len(etabins)+1),dtype=num.int64)) for histname in hists)
         
     def getWeight(self,event,jetids):
         """Get event weight for a given set of jets."""
-        weight = 1.
-        for id in jetids:
-          weight *= self.getSF(event.Jet_pt[id],event.Jet_eta[id],event.Jet_partonFlavour[id],self.tagged(event,id))
-        return weight
+        return self.getWeightVariations(event,jetids)[self.wpname,self.sigma]
+        
+    def getWeightVariations(self,event,jetids):
+        """Get event weights of all variations for a given set of jets,
+        as a dictionary with (wp, sigma) as keys."""
+        if not jetids:
+          return dict((variation,1.) for variation in self.variations)
+        pt     = num.array([event.Jet_pt[id] for id in jetids])
+        eta    = num.array([event.Jet_eta[id] for id in jetids])
+        flavor = num.array([event.Jet_partonFlavour[id] for id in jetids])
+        discr  = num.array([getattr(event,self.discriminator)[id] for id in jetids])
+        return dict((variation,float(weights[0])) for variation, weights in self.getWeightArrays(pt,eta,flavor,discr).iteritems())
+        
+    def getWeights(self,batch,jets):
+        """Get event weights of all variations for a batch of events (see BatchTools.EventBatch),
+        given a mask of the selected jets, as a dictionary with (wp, sigma) as keys."""
+        return self.getWeightArrays(batch.Jet_pt[jets],batch.Jet_eta[jets],batch.Jet_partonFlavour[jets],
+                                    getattr(batch,self.discriminator)[jets],batch.eventIndex('Jet')[jets],len(batch))
+        
+    def getWeightArrays(self,pt,eta,flavor,discr,index=None,nevents=1):
+        """Get event weights of all variations for arrays of jets, with the index of their event
+        in index, as the product of the weights of their jets, in order. The flavors, |eta| bins
+        and efficiencies of the jets are looked up once for all variations."""
+        pt, eta = num.asarray(pt,dtype=num.float64), num.asarray(eta,dtype=num.float64)
+        discr   = num.asarray(discr)
+        if index is None:
+          index = num.zeros(len(pt),dtype=num.int64)
+        flavs   = flavorToFLAV(num.asarray(flavor))
+        jets    = [(flav,flavs==flav) for flav in [FLAV_B,FLAV_C,FLAV_UDSG]]
+        jets    = [(flav,mask,abs(eta[mask]),pt[mask]) for flav, mask in jets if mask.any()]
+        effs    = dict((wp,self.getEfficiencyArray(pt,eta,flavor,wp)) for wp in self.wpcuts)
+        weights = { }
+        for wp, sigma in self.variations:
+          sfs = num.zeros(len(pt))
+          for flav, mask, abseta, ptflav in jets:
+            table = self.calib[wp,sigma,flav]
+            sfs[mask] = table.evalExact(abseta,ptflav) if self.exact else table.eval(abseta,ptflav)
+          weights[wp,sigma] = num.ones(nevents)
+          num.multiply.at(weights[wp,sigma],index,getJetWeights(sfs,effs[wp],discr>self.wpcuts[wp]))
+        return weights
+        
+    def getWeightArray(self,pt,eta,flavor,tagged,index=None,nevents=1):
+        """Get event weights of the default variation for arrays of jets, given if they are tagged."""
+        weights = num.ones(nevents)
+        if index is None:
+          index = num.zeros(len(pt),dtype=num.int64)
+        num.multiply.at(weights,index,getJetWeights(self.getSFArray(pt,eta,flavor),self.getEfficiencyArray(pt,eta,flavor),tagged))
+        return weights
         
     def getSF(self,pt,eta,flavor,tagged):
         """Get SF for one jet."""
-        FLAV = flavorToFLAV(flavor)
-        SF   = self.reader.eval(FLAV,abs(eta),pt)
-        if tagged:
-          weight = SF
-        else:
-          eff = self.getEfficiency(pt,eta,flavor)
-          weight = (1-SF*eff)/(1-eff)
-        return weight
+        return float(getJetWeights(self.getSFArray([pt],[eta],[flavor]),self.getEfficiencyArray([pt],[eta],[flavor]),[tagged])[0])
+        
+    def getSFArray(self,pt,eta,flavor,wp=None,sigma=None):
+        """Get the SFs of arrays of jets, evaluated for all jets of the same flavor at once."""
+        pt, eta = num.asarray(pt,dtype=num.float64), num.asarray(eta,dtype=num.float64)
+        flavs   = flavorToFLAV(num.asarray(flavor))
+        sfs     = num.zeros(len(pt))
+        for flav in [FLAV_B,FLAV_C,FLAV_UDSG]:
+          jets  = flavs==flav
+          if jets.any():
+            table = self.calib[wp or self.wpname,sigma or self.sigma,flav]
+            sfs[jets] = table.evalExact(abs(eta[jets]),pt[jets]) if self.exact else table.eval(abs(eta[jets]),pt[jets])
+        return sfs
         
-    def getEfficiency(self,pt,eta,flavor):
+    def getEfficiency(self,pt,eta,flavor,wp=None):
         """Get SF for one jet."""
-        flavor = flavorToString(flavor)
-        hist   = self.effs[flavor]
-        xbin   = hist.GetXaxis().FindBin(eta)
-        ybin   = hist.GetYaxis().FindBin(pt)
-        if xbin==0: xbin = 1
-        elif xbin>hist.GetXaxis().GetNbins(): xbin -= 1
-        if ybin==0: ybin = 1
-        elif ybin>hist.GetYaxis().GetNbins(): ybin -= 1
-        sf     = hist.GetBinContent(xbin,ybin)
-        return sf
+        return self.effs[wp or self.wpname][flavorToString(flavor)].lookup(eta,pt)
+        
+    def getEfficiencyArray(self,pt,eta,flavor,wp=None):
+        """Get the efficiencies of arrays of jets."""
+        pt, eta = num.asarray(pt,dtype=num.float64), num.asarray(eta,dtype=num.float64)
+        absflav = num.abs(num.asarray(flavor))
+        effs    = num.zeros(len(pt))
+        for flavor, jets in [('b',absflav==5),('c',absflav==4),('udsg',(absflav!=5)&(absflav!=4))]:
+          if jets.any():
+            effs[jets] = self.effs[wp or self.wpname][flavor].lookup(eta[jets],pt[jets])
+        return effs
         
     def fillEfficiencies(self,event,jetids):
-        """Fill efficiency of MC."""
-        for id in jetids:
-          flavor = flavorToString(event.Jet_partonFlavour[id])
-          if self.tagged(event,id):
-            self.hists[flavor].Fill(event.Jet_pt[id],event.Jet_eta[id])
-          self.hists[flavor+'_all'].Fill(event.Jet_pt[id],event.Jet_eta[id])
+        """Fill efficiency of MC for all WPs."""
+        if not jetids:
+          return
+        pt     = num.array([event.Jet_pt[id] for id in jetids])
+        eta    = num.array([event.Jet_eta[id] for id in jetids])
+        flavor = num.array([event.Jet_partonFlavour[id] for id in jetids])
+        discr  = num.array([getattr(event,self.discriminator)[id] for id in jetids])
+        self.fillEfficiencyArrays(pt,eta,flavor,discr)
+        
+    def fillEfficienciesBatch(self,batch,jets):
+        """Fill efficiency of MC for all WPs with the jets of a batch of events (see BatchTools.EventBatch),
+        given a mask of the selected jets."""
+        self.fillEfficiencyArrays(batch.Jet_pt[jets],batch.Jet_eta[jets],batch.Jet_partonFlavour[jets],
+                                  getattr(batch,self.discriminator)[jets])
+        
+    def fillEfficiencyArrays(self,pt,eta,flavor,discr):
+        """Count arrays of jets in the bins of the efficiency histograms, including under- and
+        overflow, like TH2F::Fill. The counts are added to the histograms by fillHists."""
+        nbins   = (len(self.ptbins)+1)*(len(self.etabins)+1)
+        bins    = num.searchsorted(self.ptbins,pt,side='right')*(len(self.etabins)+1) + num.searchsorted(self.etabins,eta,side='right')
+        absflav = num.abs(num.asarray(flavor))
+        discr   = num.asarray(discr)
+        for flavor, jets in [('b',absflav==5),('c',absflav==4),('udsg',(absflav!=5)&(absflav!=4))]:
+          if not jets.any():
+            continue
+          for wp, cut in self.wpcuts.iteritems():
+            histname = "%s_%s_%s"%(self.tagger,flavor,wp)
+            self.counts[histname]        += num.bincount(bins[jets & (discr>cut)],minlength=nbins)
+            self.counts[histname+'_all'] += num.bincount(bins[jets],minlength=nbins)
+        
+    def fillHists(self):
+        """Add the counts of the jets to the efficiency histograms, and reset them."""
+        netabins = len(self.etabins)+1
+        for histname, counts in self.counts.iteritems():
+          hist    = self.hists[histname]
+          entries = hist.GetEntries()
+          for bin in num.nonzero(counts)[0]:
+            ix, iy  = divmod(int(bin),netabins)
+            content = hist.GetBinContent(ix,iy)+counts[bin]
+            hist.SetBinContent(ix,iy,content)
+            if hist.GetSumw2N()>0: # unit weights
+              hist.SetBinError(ix,iy,math.sqrt(content))
+          hist.SetEntries(entries+counts.sum()) # SetBinContent increments the entries
+          counts[:] = 0
         
     def setDirectory(self,directory,subdirname=None):
+        self.fillHists()
         if subdirname:
           subdir = directory.Get(subdirname)
           if not subdir:
@@ -174,7 +402,34 @@ class BTagWeightTool:
         for histname, hist in self.hists.iteritems():
           hist.SetDirectory(directory)
 
+def getEfficiencyArrays(filename,channel,tagger,wp):
+  """Read the b tag efficiency maps of all flavors from a file, and return their arrays."""
+  payload = { }
+  efffile = ensureTFile(filename)
+  for flavor in ['b','c','udsg']:
+    payload.update(getTH2Arrays(efffile.Get("%s/eff_%s_%s_%s"%(channel,tagger,flavor,wp)),flavor+'_'))
+  efffile.Close()
+  return payload
+
+def getCalibrationPayload(calib):
+  """Return the arrays of the grids of a dictionary of BTagCalibrationTables per WP, systematic type and flavor."""
+  payload = { }
+  for (wp, sigma, flav), table in calib.iteritems():
+    payload.update(table.getPayload("%s_%s_%d_"%(wp,sigma,flav)))
+  return payload
+
+def getJetWeights(sfs,effs,tagged):
+  """Get the weights of arrays of jets, given their SFs, efficiencies, and if they are tagged."""
+  weights  = sfs.copy()
+  untagged = ~num.asarray(tagged,dtype=bool)
+  weights[untagged] = (1-sfs[untagged]*effs[untagged])/(1-effs[untagged])
+  return weights
+
 def flavorToFLAV(flavor):
+  """Get the flavor of the BTagCalibration of a parton flavor, or of an array."""
+  if isinstance(flavor,num.ndarray):
+    absflav = num.abs(flavor)
+    return num.where(absflav==5,FLAV_B,num.where((absflav==4)|(absflav==15),FLAV_C,FLAV_UDSG))
   return FLAV_B if abs(flavor)==5 else FLAV_C if abs(flavor)==4 or abs(flavor)==15 else FLAV_UDSG       
 
 def flavorToString(flavor):
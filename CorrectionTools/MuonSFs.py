@@ -16,18 +16,18 @@ class MuonSFs:
         assert year in [2016,2017,2018], "MuonSFs: You must choose a year from: 2016, 2017, or 2018."
         
         if year==2016:
-          self.sftool_trig  = ScaleFactorHTT(pathHTT+"Run2016BtoH/Muon_Mu22OR_eta2p1_eff.root",'ZMass','mu_trig')
-          self.sftool_idiso = ScaleFactorHTT(pathHTT+"Run2016BtoH/Muon_IdIso_IsoLt0p15_2016BtoH_eff.root",'ZMass','mu_idiso')
+          self.sftool_trig  = ScaleFactorHTT(pathHTT+"Run2016BtoH/Muon_Mu22OR_eta2p1_eff.root",'ZMass','mu_trig',year=year)
+          self.sftool_idiso = ScaleFactorHTT(pathHTT+"Run2016BtoH/Muon_IdIso_IsoLt0p15_2016BtoH_eff.root",'ZMass','mu_idiso',year=year)
         elif year==2017:
           #self.sftool_trig  = ScaleFactor(pathPOG+"Run2017/EfficienciesAndSF_RunBtoF_Nov17Nov2017.root","IsoMu27_PtEtaBins/abseta_pt_ratio",'mu_trig')
-          self.sftool_trig  = ScaleFactorHTT(pathHTT+"Run2017/Muon_IsoMu24orIsoMu27.root",'ZMass','mu_idiso')
-          self.sftool_idiso = ScaleFactorHTT(pathHTT+"Run2017/Muon_IdIso_IsoLt0p15_eff_RerecoFall17.root",'ZMass','mu_idiso')
+          self.sftool_trig  = ScaleFactorHTT(pathHTT+"Run2017/Muon_IsoMu24orIsoMu27.root",'ZMass','mu_idiso',year=year)
+          self.sftool_idiso = ScaleFactorHTT(pathHTT+"Run2017/Muon_IdIso_IsoLt0p15_eff_RerecoFall17.root",'ZMass','mu_idiso',year=year)
           #sftool_id         = ScaleFactor(pathPOG+"Run2017/RunBCDEF_SF_ID.root","NUM_MediumID_DEN_genTracks_pt_abseta",'mu_id',ptvseta=False)
           #sftool_iso        = ScaleFactor(pathPOG+"Run2017/RunBCDEF_SF_ISO.root","NUM_TightRelIso_DEN_MediumID_pt_abseta",'mu_iso',ptvseta=False)
           #self.sftool_idiso = sftool_id*sftool_iso
         else:
-          self.sftool_trig  = ScaleFactorHTT(pathHTT+"Run2018/Muon_Run2018_IsoMu24orIsoMu27.root",'ZMass','mu_trig')
-          self.sftool_idiso = ScaleFactorHTT(pathHTT+"Run2018/Muon_Run2018_IdIso.root") # MediumID, DB corrected iso (dR<0.4) < 0.15
+          self.sftool_trig  = ScaleFactorHTT(pathHTT+"Run2018/Muon_Run2018_IsoMu24orIsoMu27.root",'ZMass','mu_trig',year=year)
+          self.sftool_idiso = ScaleFactorHTT(pathHTT+"Run2018/Muon_Run2018_IdIso.root",year=year) # MediumID, DB corrected iso (dR<0.4) < 0.15
           #sftool_id         = ScaleFactor(pathPOG+"Run2018/RunABCD_SF_ID.root","NUM_MediumID_DEN_genTracks_pt_abseta",'mu_id',ptvseta=False)
           #sftool_iso        = ScaleFactor(pathPOG+"Run2018/RunABCD_SF_ISO.root","NUM_TightRelIso_DEN_MediumID_pt_abseta",'mu_iso',ptvseta=False)
           #self.sftool_idiso = sftool_id*sftool_iso
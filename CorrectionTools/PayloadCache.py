@@ -0,0 +1,148 @@
+# Cache of the tables of the correction tools in one binary file per year, so jobs do not
+# need to open all ROOT files with corrections at startup. Payloads are stored as numpy
+# arrays with the hash of the content of their source files, and rebuilt when these change.
+from CorrectionTools import modulepath
+import os, json, hashlib
+import numpy as num
+cachedir = modulepath+"/cache/"
+enabled  = True # set to False to always build payloads from the source files
+magic    = 'NTPAYLD1'
+align    = 64
+
+def alignOffset(offset):
+  """Round an offset up to a multiple of the alignment."""
+  return -(-offset//align)*align
+
+def getDataStart(length):
+  """Get the offset of the data in the file, given the length of the header."""
+  return alignOffset(len(magic)+8+length)
+
+hashes = { }
+def getHash(filenames):
+  """Get the SHA1 hash of the content of a list of files."""
+  key = tuple(filenames)
+  if key not in hashes:
+    hash = hashlib.sha1()
+    for filename in filenames:
+      hash.update(os.path.basename(filename))
+      with open(filename,'rb') as file:
+        for block in iter(lambda: file.read(1<<20),''):
+          hash.update(block)
+    hashes[key] = hash.hexdigest()
+  return hashes[key]
+
+
+class PayloadCache:
+    """Binary file with named payloads, which are dictionaries of numpy arrays.
+    The file starts with a magic string, the length of a JSON header with the index
+    of all arrays, and the header, followed by the raw data of the arrays at aligned
+    offsets, which are memory-mapped when loading. Changes are written to a temporary
+    file that replaces the cache, so running jobs can keep reading the old one."""
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.index    = None
+        self.data     = None
+        self.start    = 0
+
+    def load(self):
+        """Read the index, and memory-map the data of the cache file, if it exists."""
+        self.index = { }
+        self.data  = None
+        if not os.path.isfile(self.filename):
+          return
+        try:
+          with open(self.filename,'rb') as file:
+            if file.read(len(magic))!=magic:
+              raise IOError("wrong format")
+            length     = int(num.fromstring(file.read(8),dtype='<u8')[0])
+            self.index = json.loads(file.read(length))
+            self.start = getDataStart(length)
+          self.data = num.memmap(self.filename,dtype=num.uint8,mode='r')
+        except (IOError,ValueError) as error:
+          print ">>> Warning! PayloadCache.load: Could not read %s (%s), rebuilding it..."%(self.filename,error)
+          self.index = { }
+          self.data  = None
+
+    def get(self, key, hash):
+        """Return the payload of a key as a dictionary of read-only arrays,
+        or None if it does not exist, or was built from sources with another hash."""
+        if self.index is None:
+          self.load()
+        entry = self.index.get(key,None)
+        if entry is None or entry['hash']!=hash:
+          return None
+        payload = { }
+        for name, (dtype, shape, offset) in entry['arrays'].iteritems():
+          payload[str(name)] = num.ndarray(shape,dtype=num.dtype(str(dtype)),buffer=self.data,offset=self.start+offset)
+        return payload
+
+    def put(self, key, hash, payload):
+        """Add or replace the payload of a key, and write the cache file.
+        The current file is read again first, to keep payloads added by other jobs."""
+        self.load()
+        payloads = { }
+        for oldkey, entry in self.index.iteritems():
+          if oldkey!=key:
+            payloads[oldkey] = (entry['hash'],self.get(oldkey,entry['hash']))
+        payloads[key] = (hash,payload)
+        self.write(payloads)
+        self.load()
+
+    def write(self, payloads):
+        """Write a dictionary of keys to (hash, payload) pairs to the cache file."""
+        index  = { }
+        arrays = [ ]
+        offset = 0
+        for key, (hash, payload) in sorted(payloads.iteritems()):
+          entry = { 'hash': hash, 'arrays': { } }
+          for name, array in sorted(payload.iteritems()):
+            array  = num.ascontiguousarray(array)
+            offset = alignOffset(offset)
+            entry['arrays'][name] = (array.dtype.str,array.shape,offset)
+            arrays.append((offset,array))
+            offset += array.nbytes
+          index[key] = entry
+        header = json.dumps(index,sort_keys=True)
+        start  = getDataStart(len(header))
+        dirname = os.path.dirname(self.filename)
+        if dirname and not os.path.exists(dirname):
+          os.makedirs(dirname)
+        tmpname = "%s.%d.tmp"%(self.filename,os.getpid())
+        with open(tmpname,'wb') as file:
+          file.write(magic)
+          file.write(num.array([len(header)],dtype='<u8').tostring())
+          file.write(header)
+          for offset, array in arrays:
+            file.write('\0'*(start+offset-file.tell()))
+            file.write(array.tostring())
+          file.flush()
+          os.fsync(file.fileno())
+        os.rename(tmpname,self.filename)
+
+
+
+caches = { }
+def getPayloadCache(year=None):
+  """Get the payload cache of a year, or the common one."""
+  name = "payloads_%s.bin"%(year) if year else "payloads.bin"
+  if name not in caches:
+    caches[name] = PayloadCache(os.path.join(cachedir,name))
+  return caches[name]
+
+def loadPayload(key, sources, build, year=None):
+  """Return the payload of a key from the cache of a year, if it was built from the same
+  source files, or else build it with build(), and add it to the cache."""
+  if not enabled:
+    return build()
+  hash    = getHash(sources)
+  cache   = getPayloadCache(year)
+  payload = cache.get(key,hash)
+  if payload is None:
+    payload = build()
+    try:
+      cache.put(key,hash,payload)
+    except (IOError,OSError) as error:
+      print ">>> Warning! PayloadCache.loadPayload: Could not write %s: %s"%(cache.filename,error)
+  return payload
+
@@ -1,49 +1,85 @@
 # Author: Izaak Neutelings (November 2018)
 from CorrectionTools import modulepath
+from bisect import bisect_right
+import numpy as num
 from ROOT import TFile
-from ScaleFactorTool import ensureTFile
+from ScaleFactorTool import ensureTFile, getAxisEdges, getPayloadKey
+from PayloadCache import loadPayload
 path = modulepath+"/pileup/"
+minbiases = { 'central': '69p2', 'down': '66p0168', 'up': '72p3832' } # -/+4.6%
 
 
 class PileupWeightTool:
-    
+    sigmas = ['central','up','down']
+        
     def __init__( self, year=2017, sigma='central' ):
-        """Load data and MC pilup profiles."""
+        """Load data and MC pilup profiles. The weights of all variations are precomputed
+        in bins of the number of true interactions; getWeight returns the one of sigma."""
         
         assert( year in [2016,2017,2018] ), "You must choose a year from: 2016, 2017, or 2018."
         assert( sigma in ['central','up','down'] ), "You must choose a s.d. variation from: 'central', 'up', or 'down'."
         
-        minbias = '69p2'
-        if sigma=='down':
-          minbias = '66p0168' # -4.6%
-        elif sigma=='up':
-          minbias = '72p3832' # +4.6%
-        
         if year==2016:
-          self.datafile = ensureTFile( path+'Data_PileUp_2016_%s.root'%(minbias), 'READ')
-          self.mcfile   = ensureTFile( path+'MC_PileUp_2016_Moriond17.root', 'READ')
+          self.datafilenames = [path+'Data_PileUp_2016_%s.root'%(minbiases[s]) for s in self.sigmas]
+          self.mcfilename    = path+'MC_PileUp_2016_Moriond17.root'
         elif year==2017:
-          self.datafile = ensureTFile( path+'Data_PileUp_2017_%s.root'%(minbias), 'READ')
-          self.mcfile   = ensureTFile( path+'MC_PileUp_2017_Winter17_V2.root', 'READ')
+          self.datafilenames = [path+'Data_PileUp_2017_%s.root'%(minbiases[s]) for s in self.sigmas]
+          self.mcfilename    = path+'MC_PileUp_2017_Winter17_V2.root'
         else:
-          self.datafile = ensureTFile( path+'Data_PileUp_2018_%s.root'%(minbias), 'READ')
-          self.mcfile   = ensureTFile( path+'MC_PileUp_2018_Autumn18.root', 'READ')
-        self.datahist = self.datafile.Get('pileup')
-        self.mchist   = self.mcfile.Get('pileup')
-        self.datahist.SetDirectory(0)
-        self.mchist.SetDirectory(0)
-        self.datahist.Scale(1./self.datahist.Integral())
-        self.mchist.Scale(1./self.mchist.Integral())
-        self.datafile.Close()
-        self.mcfile.Close()
-        
-    
+          self.datafilenames = [path+'Data_PileUp_2018_%s.root'%(minbiases[s]) for s in self.sigmas]
+          self.mcfilename    = path+'MC_PileUp_2018_Autumn18.root'
+        self.datafilename = self.datafilenames[self.sigmas.index(sigma)]
+        self.sigma        = sigma
+        
+        # NORMALIZED PROFILES: contents in the bins of the union of all bin edges, including under- and overflow, cached per year
+        sources  = self.datafilenames+[self.mcfilename]
+        payload  = loadPayload(getPayloadKey('PileupWeightTool',*sources),sources,self.buildPayload,year=year)
+        mc       = payload['mc']
+        self.edgearray = payload['edges']
+        self.mcarray   = mc
+        self.edges     = self.edgearray.tolist()
+        self.mcvals    = mc.tolist()
+        self.weights   = num.ones((len(mc),len(self.sigmas))) # data/mc per bin and variation, 1 if mc is empty
+        for i, s in enumerate(self.sigmas):
+          self.weights[mc>0.,i] = payload['data_'+s][mc>0.]/mc[mc>0.]
+        self.weightlist = [tuple(weights) for weights in self.weights.tolist()]
+        self.isigma     = self.sigmas.index(sigma)
+        
+    def buildPayload(self):
+        """Read the data and MC profiles from their files, normalize them, and return their
+        contents in the bins of the union of their bin edges, so each bin lies within one bin
+        of every profile, including under- and overflow."""
+        hists = [ ]
+        for filename in self.datafilenames+[self.mcfilename]:
+          file = ensureTFile(filename,'READ')
+          hist = file.Get('pileup')
+          hist.Scale(1./hist.Integral())
+          hists.append((getAxisEdges(hist.GetXaxis()),[hist.GetBinContent(i) for i in xrange(hist.GetNbinsX()+2)]))
+          file.Close()
+        edges   = sorted(set(edge for histedges, contents in hists for edge in histedges))
+        xvals   = [edges[0]-1.]+edges # a value in each bin
+        payload = { 'edges': num.array(edges,dtype=num.float64) }
+        for name, (histedges, contents) in zip(['data_'+s for s in self.sigmas]+['mc'],hists):
+          payload[name] = num.array([contents[bisect_right(histedges,x)] for x in xvals],dtype=num.float64) # same bin as FindBin
+        return payload
+        
     def getWeight(self,npu):
         """Get pileup weight for a given number of pileup interactions."""
-        data = self.datahist.GetBinContent(self.datahist.GetXaxis().FindBin(npu))
-        mc   = self.mchist.GetBinContent(self.mchist.GetXaxis().FindBin(npu))
-        if mc>0.:
-          return data/mc
-        print ">>> Warning! PileupWeightTools.getWeight: Could not make pileup weight for npu=%s data=%s, mc=%s"%(npu,data,mc)  
-        return 1.
-    
+        return self.getWeights(npu)[self.isigma]
+        
+    def getWeights(self,npu):
+        """Get pileup weights of all variations (central, up, down) for a given number of pileup interactions."""
+        index = bisect_right(self.edges,npu)
+        if self.mcvals[index]<=0.:
+          print ">>> Warning! PileupWeightTools.getWeight: Could not make pileup weight for npu=%s, mc=%s"%(npu,self.mcvals[index])
+        return self.weightlist[index]
+        
+    def getWeightArrays(self,npu):
+        """Get pileup weights of all variations (central, up, down) for an array of numbers of
+        pileup interactions, as a 2D array with a column per variation."""
+        index = num.searchsorted(self.edgearray,npu,side='right') # same bin as FindBin
+        empty = num.count_nonzero(self.mcarray[index]<=0.)
+        if empty:
+          print ">>> Warning! PileupWeightTools.getWeightArrays: Could not make pileup weight for %d events, mc=0"%(empty)
+        return self.weights[index]
+
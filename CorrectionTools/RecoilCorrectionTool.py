@@ -8,12 +8,22 @@ from CorrectionTools import modulepath
 import os
 from math import sqrt, exp
 from ctypes import c_float
+import numpy as num
 from PhysicsTools.NanoAODTools.postprocessing.framework.datamodel import Collection
-from ScaleFactorTool import ensureTFile
+from ScaleFactorTool import ensureTFile, getTH2Arrays, getPayloadKey, ScaleFactorTable
+from PayloadCache import loadPayload
 import ROOT
 from ROOT import TLorentzVector, gROOT, gSystem, gInterpreter, Double
 rcpath  = "HTT-utilities/RecoilCorrections/data/"
 zptpath = modulepath+"/Zpt/"
+recoil_arrays_cxx = """
+void CorrectByMeanResolutionArrays(RecoilCorrector& corrector, int n, const float* metpx, const float* metpy,
+                                   const float* bosonpx, const float* bosonpy, const float* bosonvispx, const float* bosonvispy,
+                                   const int* njets, float* metpx_corr, float* metpy_corr){
+  for(int i=0; i<n; i++)
+    corrector.CorrectByMeanResolution(metpx[i],metpy[i],bosonpx[i],bosonpy[i],bosonvispx[i],bosonvispy[i],njets[i],metpx_corr[i],metpy_corr[i]);
+}
+"""
 
 
 
@@ -30,24 +40,20 @@ class ZptCorrectionTool:
         else:
           filename = zptpath+"Zpt_weights_2018.root"
         
-        file    = ensureTFile(filename,'READ')
-        hist = file.Get('zptmass_weights')
-        hist.SetDirectory(0)
-        file.Close()
-        
-        self.hist      = hist
         self.filename  = filename
+        payload        = loadPayload(getPayloadKey('ZptCorrectionTool',filename),[filename],self.buildPayload,year=year)
+        self.table     = ScaleFactorTable.fromPayload(payload) # Z mass (x) vs. Z pT (y)
+        
+    def buildPayload(self):
+        """Read the weights from the file, and return their bin edges and contents."""
+        file    = ensureTFile(self.filename,'READ')
+        payload = getTH2Arrays(file.Get('zptmass_weights'))
+        file.Close()
+        return payload
         
     def getZptWeight(self,Zpt,Zmass):
-        """Get Z pT weight for a given Z boson pT and mass."""
-        xbin = self.hist.GetXaxis().FindBin(Zmass)
-        ybin = self.hist.GetYaxis().FindBin(Zpt)
-        if xbin==0: xbin = 1
-        elif xbin>self.hist.GetXaxis().GetNbins(): xbin -= 1
-        if ybin==0: ybin = 1
-        elif ybin>self.hist.GetYaxis().GetNbins(): ybin -= 1
-        weight = self.hist.GetBinContent(xbin,ybin)
-        return weight
+        """Get Z pT weight for a given Z boson pT and mass, or arrays of them."""
+        return self.table.lookup(Zmass,Zpt)
     
 
 
@@ -71,6 +77,8 @@ class RecoilCorrectionTool:
         assert os.path.isfile(recoil_h), "RecoilCorrectionTool: Did not find RecoilCorrection header: %s"%recoil_h
         gROOT.ProcessLine('#include "%s"'%recoil_h)
         gSystem.Load("libHTT-utilitiesRecoilCorrections.so")
+        if not hasattr(ROOT,'CorrectByMeanResolutionArrays'):
+          gInterpreter.Declare(recoil_arrays_cxx)
         corrector  = ROOT.RecoilCorrector(filename)
         
         self.corrector = corrector
@@ -78,12 +86,32 @@ class RecoilCorrectionTool:
         
     def CorrectPFMETByMeanResolution(self, met, boson, boson_vis, njets):
         """Correct PF MET using the full and visibile boson Lorentz vector."""
-        metpx_corr, metpy_corr = c_float(), c_float()
         #print "before: met pt = %4.1f, phi = %4.1f, px = %4.1f, py = %4.1f; boson px = %4.1f, py = %4.1f; vis. boson px = %4.1f, py = %4.1f; njets = %d"%(met.Pt(),met.Phi(),met.Px(),met.Py(),boson.Px(),boson.Py(),boson_vis.Px(),boson_vis.Py(),njets)
-        self.corrector.CorrectByMeanResolution(met.Px(),met.Py(),boson.Px(),boson.Py(),boson_vis.Px(),boson_vis.Py(),njets,metpx_corr,metpy_corr)
-        met.SetPxPyPzE(metpx_corr.value,metpy_corr.value,0.,sqrt(metpx_corr.value**2+metpy_corr.value**2))
-        #print "after:  met pt = %4.1f, phi = %4.1f, px = %4.1f, py = %4.1f, metpx_corr.value = %.1f, metpy_corr.value = %.1f"%(met.Pt(),met.Phi(),met.Px(),met.Py(),metpx_corr.value,metpy_corr.value)
+        metpx_corr, metpy_corr = self.CorrectPFMET(met.Px(),met.Py(),boson.Px(),boson.Py(),boson_vis.Px(),boson_vis.Py(),njets)
+        met.SetPxPyPzE(metpx_corr,metpy_corr,0.,sqrt(metpx_corr**2+metpy_corr**2))
+        #print "after:  met pt = %4.1f, phi = %4.1f, px = %4.1f, py = %4.1f"%(met.Pt(),met.Phi(),met.Px(),met.Py())
         return met
+        
+    def CorrectPFMET(self, metpx, metpy, bosonpx, bosonpy, bosonvispx, bosonvispy, njets):
+        """Correct PF MET px and py using the px and py of the full and visibile boson,
+        e.g. from getGenBosons. Return the corrected px and py."""
+        metpx_corr, metpy_corr = c_float(), c_float()
+        self.corrector.CorrectByMeanResolution(metpx,metpy,bosonpx,bosonpy,bosonvispx,bosonvispy,njets,metpx_corr,metpy_corr)
+        return metpx_corr.value, metpy_corr.value
+        
+    def CorrectPFMETArrays(self, metpx, metpy, bosonpx, bosonpy, bosonvispx, bosonvispy, njets):
+        """Correct arrays of PF MET px and py, using the px and py of the full and visibile boson,
+        with one compiled loop over contiguous single-precision buffers, as RecoilCorrector takes floats.
+        Return arrays of the corrected MET px and py."""
+        inputs     = [num.ascontiguousarray(values,dtype=num.float32) for values in [metpx,metpy,bosonpx,bosonpy,bosonvispx,bosonvispy]]
+        njets      = num.ascontiguousarray(njets,dtype=num.int32)
+        nevents    = len(njets)
+        assert all(len(values)==nevents for values in inputs), "RecoilCorrectionTool.CorrectPFMETArrays: Arrays must have the same length!"
+        metpx_corr = num.zeros(nevents,dtype=num.float32)
+        metpy_corr = num.zeros(nevents,dtype=num.float32)
+        if nevents:
+          ROOT.CorrectByMeanResolutionArrays(self.corrector,nevents,*(inputs+[njets,metpx_corr,metpy_corr]))
+        return metpx_corr, metpy_corr
     
 
 def getTTptWeight(toppt1,toppt2):
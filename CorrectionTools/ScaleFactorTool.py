@@ -1,7 +1,10 @@
 # Author: Izaak Neutelings (November 2018)
 from CorrectionTools import modulepath
 import os, re
+from bisect import bisect_left, bisect_right
+import numpy as num
 from ROOT import TFile, TH1
+from PayloadCache import loadPayload
 
 
 def ensureTFile(filename,option='READ'):
@@ -28,84 +31,234 @@ def extractTH1(file,histname):
     hist.SetDirectory(0)
   return hist
   
+def getAxisEdges(axis):
+  """Get the list of bin edges of a TAxis."""
+  return [axis.GetBinLowEdge(i) for i in xrange(1,axis.GetNbins()+2)]
+  
+def getTH2Arrays(hist, prefix=""):
+  """Get the bin edges and contents of a TH2, without under- and overflow, as arrays."""
+  xedges = getAxisEdges(hist.GetXaxis())
+  yedges = getAxisEdges(hist.GetYaxis())
+  sfs    = [[hist.GetBinContent(ix,iy) for iy in xrange(1,len(yedges))] for ix in xrange(1,len(xedges))]
+  return { prefix+'xedges': num.array(xedges,dtype=num.float64), prefix+'yedges': num.array(yedges,dtype=num.float64),
+           prefix+'sfs':    num.array(sfs,dtype=num.float64).reshape(len(xedges)-1,len(yedges)-1) }
+  
+def getPayloadKey(tool, filename, *names):
+  """Get the key of a payload in the cache, with the path of its file relative to this package."""
+  return ':'.join([tool,os.path.relpath(os.path.abspath(filename),os.path.abspath(modulepath))]+list(names))
+  
+
+class ScaleFactorTable:
+    """Look-up table of SFs in bins of x and y, without under- and overflow."""
+    
+    def __init__(self, xedges, yedges, sfs):
+        self.xbins   = num.array(xedges,dtype=num.float64)
+        self.ybins   = num.array(yedges,dtype=num.float64)
+        self.sftable = num.array(sfs,dtype=num.float64).reshape(len(self.xbins)-1,len(self.ybins)-1)
+        self.xedges  = self.xbins.tolist()
+        self.yedges  = self.ybins.tolist()
+        self.nxbins  = len(self.xedges)-1
+        self.nybins  = len(self.yedges)-1
+        self.sfs     = self.sftable.tolist()
+        
+    @staticmethod
+    def fromPayload(payload, prefix=""):
+        """Create a table from the arrays of a payload, see getTH2Arrays."""
+        return ScaleFactorTable(payload[prefix+'xedges'],payload[prefix+'yedges'],payload[prefix+'sfs'])
+        
+    def transpose(self):
+        """Return the table with x and y swapped."""
+        return ScaleFactorTable(self.ybins,self.xbins,self.sftable.T)
+        
+    def lookup(self, x, y):
+        """Get the content of the bin containing x and y, like FindBin, using the last
+        (first) bin for values in the overflow (underflow). For arrays, return an array."""
+        if isinstance(x,num.ndarray) or isinstance(y,num.ndarray):
+          xbin = num.clip(num.searchsorted(self.xbins,x,side='right')-1,0,self.nxbins-1)
+          ybin = num.clip(num.searchsorted(self.ybins,y,side='right')-1,0,self.nybins-1)
+          return self.sftable[xbin,ybin]
+        xbin = min(max(bisect_right(self.xedges,x)-1,0),self.nxbins-1)
+        ybin = min(max(bisect_right(self.yedges,y)-1,0),self.nybins-1)
+        return self.sfs[xbin][ybin]
+    
+def multiplyTables(table1, table2, maxbins=100000):
+    """Multiply two look-up tables on the union of their bin edges. Each refined bin lies
+    within a single bin of both tables, so the product reproduces the product of two lookups,
+    including clamping. Return None if the refined table would exceed maxbins."""
+    xedges = sorted(set(table1.xedges)|set(table2.xedges))
+    yedges = sorted(set(table1.yedges)|set(table2.yedges))
+    if (len(xedges)-1)*(len(yedges)-1)>maxbins:
+      return None
+    sfs = [[table1.lookup(x,y)*table2.lookup(x,y) for y in yedges[:-1]] for x in xedges[:-1]]
+    return ScaleFactorTable(xedges,yedges,sfs)
+    
+
 
 class ScaleFactor:
     
-    def __init__(self, filename, histname, name="<noname>", ptvseta=True):
+    def __init__(self, filename, histname, name="<noname>", ptvseta=True, year=None):
         #print '>>> ScaleFactor.init("%s","%s",name="%s",ptvseta=%r)'%(filename,histname,name,ptvseta)
         self.name     = name
         self.ptvseta  = ptvseta
         self.filename = filename
-        self.file     = ensureTFile(filename)
-        self.hist     = self.file.Get(histname)
-        if not self.hist:
-          print '>>> ScaleFactor(%s).__init__: histogram "%s" does not exist in "%s"'%(self.name,histname,filename)
-          exit(1)
-        self.hist.SetDirectory(0)
-        self.file.Close()
+        self.histname = histname
+        
+        # LOOK-UP TABLE: copy of bin edges and contents, cached per year
+        payload    = loadPayload(getPayloadKey('ScaleFactor',filename,histname),[filename],self.buildPayload,year=year)
+        self.table = ScaleFactorTable.fromPayload(payload)
         
         if ptvseta: self.getSF = self.getSF_ptvseta
         else:       self.getSF = self.getSF_etavspt
         
+    def buildPayload(self):
+        """Read the histogram from the file, and return its bin edges and contents."""
+        file = ensureTFile(self.filename)
+        hist = file.Get(self.histname)
+        if not hist:
+          print '>>> ScaleFactor(%s).__init__: histogram "%s" does not exist in "%s"'%(self.name,self.histname,self.filename)
+          exit(1)
+        payload = getTH2Arrays(hist)
+        file.Close()
+        return payload
+        
     def __mul__(self, oScaleFactor):
         return ScaleFactorProduct(self, oScaleFactor)
         
     def getSF_ptvseta(self, pt, eta):
-        """Get SF for a given pT, eta."""
-        xbin = self.hist.GetXaxis().FindBin(eta)
-        ybin = self.hist.GetYaxis().FindBin(pt)
-        if xbin==0: xbin = 1
-        elif xbin>self.hist.GetXaxis().GetNbins(): xbin -= 1
-        if ybin==0: ybin = 1
-        elif ybin>self.hist.GetYaxis().GetNbins(): ybin -= 1
-        sf   = self.hist.GetBinContent(xbin,ybin)
-        #print "ScaleFactor(%s).getSF_ptvseta: pt = %6.2f, eta = %6.3f, sf = %6.3f"%(self.name,pt,eta,sf)
-        return sf
+        """Get SF for a given pT, eta, or arrays of them."""
+        return self.table.lookup(eta,pt)
         
     def getSF_etavspt(self, pt, eta):
-        """Get SF for a given pT, eta."""
-        xbin = self.hist.GetXaxis().FindBin(pt)
-        ybin = self.hist.GetYaxis().FindBin(eta)
-        if xbin==0: xbin = 1
-        elif xbin>self.hist.GetXaxis().GetNbins(): xbin -= 1
-        if ybin==0: ybin = 1
-        elif ybin>self.hist.GetYaxis().GetNbins(): ybin -= 1
-        sf   = self.hist.GetBinContent(xbin,ybin)
-        #print "ScaleFactor(%s).getSF_etavspt: pt = %6.2f, eta = %6.3f, sf = %6.3f"%(self.name,pt,eta,sf)
-        return sf
+        """Get SF for a given pT, eta, or arrays of them."""
+        return self.table.lookup(pt,eta)
+        
+    def getEtaPtTable(self):
+        """Get the look-up table in bins of eta (x) and pT (y)."""
+        return self.table if self.ptvseta else self.table.transpose()
+    
+
+
+def getGraphArrays(graph, prefix=""):
+    """Get the points of a TGraph as arrays."""
+    npoints = graph.GetN()
+    return { prefix+'x': num.array([graph.GetX()[i] for i in xrange(npoints)],dtype=num.float64),
+             prefix+'y': num.array([graph.GetY()[i] for i in xrange(npoints)],dtype=num.float64) }
+    
+
+class GraphTable:
+    """Copy of the points of a TGraph, to evaluate it like TGraph::Eval with linear interpolation
+    between the two nearest points, and linear extrapolation with the two first (last) points
+    outside the range, for a single value or a numpy array. The points are sorted in x,
+    so extrapolation only matches TGraph::Eval for graphs stored in order, as usual."""
+    
+    def __init__(self, xvals, yvals, name=""):
+        npoints      = len(xvals)
+        points       = zip(num.asarray(xvals,dtype=num.float64).tolist(),num.asarray(yvals,dtype=num.float64).tolist())
+        self.name    = name
+        self.npoints = npoints
+        self.yfirst  = points[0][1] if points else 0. # TGraph::Eval returns the first point for NaN
+        points.sort(key=lambda p: p[0])
+        self.xvals   = [x for x, y in points]
+        self.yvals   = [y for x, y in points]
+        self.xarray  = num.array(self.xvals,dtype=num.float64)
+        self.yarray  = num.array(self.yvals,dtype=num.float64)
+        
+    def Eval(self, x):
+        """Evaluate the graph at x, or an array of x values."""
+        if isinstance(x,num.ndarray):
+          return self.evalArray(x)
+        if self.npoints<2:
+          return self.yvals[0] if self.npoints else 0.
+        if x!=x:
+          return self.yfirst
+        up = bisect_left(self.xvals,x)
+        if up<self.npoints and self.xvals[up]==x:
+          return self.yvals[up]
+        up  = min(max(up,1),self.npoints-1)
+        low = up-1
+        xlow, xup = self.xvals[low], self.xvals[up]
+        ylow, yup = self.yvals[low], self.yvals[up]
+        if xlow==xup:
+          return ylow
+        return yup + (x-xup)*(ylow-yup)/(xlow-xup)
+        
+    def evalArray(self, x):
+        """Evaluate the graph for an array of x values, in the same way as Eval."""
+        if self.npoints<2:
+          return num.full(x.shape,self.yvals[0] if self.npoints else 0.)
+        index = num.searchsorted(self.xarray,x,side='left')
+        exact = num.take(self.xarray,index,mode='clip')==x
+        up    = num.clip(index,1,self.npoints-1)
+        xlow, xup = self.xarray[up-1], self.xarray[up]
+        ylow, yup = self.yarray[up-1], self.yarray[up]
+        with num.errstate(divide='ignore',invalid='ignore'):
+          y = yup + (x-xup)*(ylow-yup)/(xlow-xup)
+        y = num.where(xlow==xup,ylow,y)
+        y = num.where(exact,num.take(self.yarray,index,mode='clip'),y)
+        return num.where(num.isnan(x),self.yfirst,y)
     
 
 
 class ScaleFactorHTT(ScaleFactor):
     
-    def __init__(self, filename, graphname='ZMass', name="<noname>"):
+    def __init__(self, filename, graphname='ZMass', name="<noname>", year=None):
         #print '>>> ScaleFactor.init("%s","%s",name="%s")'%(filename,graphname,name)
         self.name      = name
         self.filename  = filename
-        self.file      = ensureTFile(filename)
-        self.hist_eta  = self.file.Get('etaBinsH')
-        self.hist_eta.SetDirectory(0)
-        self.effs_data = { }
-        self.effs_mc   = { }
-        for ieta in range(1,self.hist_eta.GetXaxis().GetNbins()+1):
-          etalabel = self.hist_eta.GetXaxis().GetBinLabel(ieta)
-          self.effs_data[etalabel] = self.file.Get(graphname+etalabel+"_Data")
-          self.effs_mc[etalabel]   = self.file.Get(graphname+etalabel+"_MC")
-        self.file.Close()
+        self.graphname = graphname
+        
+        # LOOK-UP TABLES: bin edges in |eta|, and copies of the graphs per eta bin, cached per year
+        payload         = loadPayload(getPayloadKey('ScaleFactorHTT',filename,graphname),[filename],self.buildPayload,year=year)
+        self.etaedges   = payload['etaedges'].tolist()
+        self.netabins   = len(self.etaedges)-1
+        self.etabins    = num.array(self.etaedges)
+        self.table_data = [GraphTable(payload['data%d_x'%i],payload['data%d_y'%i]) for i in xrange(self.netabins)]
+        self.table_mc   = [GraphTable(payload['mc%d_x'%i],  payload['mc%d_y'%i])   for i in xrange(self.netabins)]
+        
+    def buildPayload(self):
+        """Read the eta binning and efficiency graphs from the file, and return their arrays."""
+        file     = ensureTFile(self.filename)
+        hist_eta = file.Get('etaBinsH')
+        axis     = hist_eta.GetXaxis()
+        payload  = { 'etaedges': num.array(getAxisEdges(axis),dtype=num.float64) }
+        for ieta in range(1,axis.GetNbins()+1):
+          etalabel = axis.GetBinLabel(ieta)
+          payload.update(getGraphArrays(file.Get(self.graphname+etalabel+"_Data"),'data%d_'%(ieta-1)))
+          payload.update(getGraphArrays(file.Get(self.graphname+etalabel+"_MC"),  'mc%d_'%(ieta-1)))
+        file.Close()
+        return payload
+        
+    def getEtaPtTable(self):
+        """The interpolated efficiencies cannot be put in a table of bins."""
+        return None
         
     
     def getSF(self, pt, eta):
-        """Get SF for a given pT, eta."""
-        abseta = abs(eta)
-        etabin = self.hist_eta.GetXaxis().GetBinLabel(min(self.hist_eta.GetXaxis().GetNbins(),self.hist_eta.GetXaxis().FindBin(abseta)))
-        data   = self.effs_data[etabin].Eval(pt)
-        mc     = self.effs_mc[etabin].Eval(pt)
+        """Get SF for a given pT, eta, or arrays of them."""
+        if isinstance(pt,num.ndarray) or isinstance(eta,num.ndarray):
+          return self.getSFArray(pt,eta)
+        ieta = min(max(bisect_right(self.etaedges,abs(eta)),1),self.netabins)-1
+        data = self.table_data[ieta].Eval(pt)
+        mc   = self.table_mc[ieta].Eval(pt)
         if mc==0:
-          sf   = 1.0
+          sf = 1.0
         else:
-          sf   = data/mc
+          sf = data/mc
         #print "ScaleFactorHTT(%s).getSF: pt = %6.2f, eta = %6.3f, data = %6.3f, mc = %6.3f, sf = %6.3f"%(self.name,pt,eta,data,mc,sf)
         return sf
+        
+    def getSFArray(self, pt, eta):
+        """Get SFs for arrays of pT and eta, evaluating the graphs of each eta bin at once."""
+        pt, eta = num.broadcast_arrays(num.asarray(pt,dtype=num.float64),num.asarray(eta,dtype=num.float64))
+        ieta = num.clip(num.searchsorted(self.etabins,num.abs(eta),side='right'),1,self.netabins)-1
+        sfs  = num.ones(pt.shape)
+        for i in num.unique(ieta):
+          mask = ieta==i
+          data = self.table_data[i].Eval(pt[mask])
+          mc   = self.table_mc[i].Eval(pt[mask])
+          with num.errstate(divide='ignore',invalid='ignore'):
+            sfs[mask] = num.where(mc==0,1.0,data/mc)
+        return sfs
     
 
 
@@ -120,8 +273,29 @@ class ScaleFactorProduct:
         self.scaleFactor1 = scaleFactor1
         self.scaleFactor2 = scaleFactor2
         
+        # FUSE: multiply the tables of binned SFs into one on their common binning
+        self.table = None
+        table1 = scaleFactor1.getEtaPtTable()
+        table2 = scaleFactor2.getEtaPtTable()
+        if table1 and table2:
+          self.table = multiplyTables(table1,table2)
+        if self.table:
+          self.getSF = self.getSF_fused
+        
+    def __mul__(self, oScaleFactor):
+        return ScaleFactorProduct(self, oScaleFactor)
+        
+    def getEtaPtTable(self):
+        """Get the fused look-up table in bins of eta (x) and pT (y), if available."""
+        return self.table
+        
     def getSF(self, pt, eta):
+        """Get the product of SFs for a given pT, eta, or arrays of them."""
         return self.scaleFactor1.getSF(pt,eta)*self.scaleFactor2.getSF(pt,eta)
+        
+    def getSF_fused(self, pt, eta):
+        """Get the product of SFs for a given pT, eta, or arrays of them, from the fused table."""
+        return self.table.lookup(eta,pt)
     
 
 #def getBinsFromTGraph(graph):
@@ -1,15 +1,123 @@
 # Author: Izaak Neutelings (November 2018)
 # 2016: https://github.com/rmanzoni/triggerSF/tree/moriond17
 # 2017: https://github.com/truggles/TauTriggerSFs/tree/final_2017_MCv2
-import os
+import os, math
 from math import sqrt, pi
+from bisect import bisect_right
+import numpy as num
 from CorrectionTools import modulepath
-from ScaleFactorTool import ensureTFile, extractTH1
+from ScaleFactorTool import ensureTFile, extractTH1, getAxisEdges, getPayloadKey
+from PayloadCache import loadPayload
 from ROOT import TMath
 path = modulepath+"/tauEfficiencies/"
+wps  = ['vloose', 'loose', 'medium', 'tight', 'vtight', 'vvtight']
+dms  = [0, 1, 10]
+ptmin, ptmax = 20., 450. # range of the fits, see TauTriggerSFs.ptCheck
+payloads = { } # payloads of all WPs of a trigger, shared by all instances
         
 
 
+class TauTriggerEfficiency:
+    """Efficiency of one WP and DM in data or MC, evaluated like TauTriggerSFs.getEfficiency, with
+    the fit function tabulated on uniform pT nodes, and linearly interpolated, the error band in
+    its bins, and the ratio of the eta-phi map to its average in bins of the union of their
+    edges, including under- and overflow, where it is NaN if the average is not positive."""
+    
+    def __init__(self, ptnodes, fitvals, uncedges, uncerrs, etaedges, phiedges, ratios):
+        self.ptnodes  = num.array(ptnodes,dtype=num.float64)
+        self.fitarray = num.array(fitvals,dtype=num.float64)
+        self.uncbins  = num.array(uncedges,dtype=num.float64)
+        self.uncarray = num.array(uncerrs,dtype=num.float64)
+        self.etabins  = num.array(etaedges,dtype=num.float64)
+        self.phibins  = num.array(phiedges,dtype=num.float64)
+        self.ratios   = num.array(ratios,dtype=num.float64).reshape(len(self.etabins)+1,len(self.phibins)+1)
+        self.ptmin    = self.ptnodes[0]
+        self.ptstep   = (self.ptnodes[-1]-self.ptnodes[0])/(len(self.ptnodes)-1)
+        self.nsteps   = len(self.ptnodes)-1
+        self.fitvals  = self.fitarray.tolist()
+        self.uncedges = self.uncbins.tolist()
+        self.uncerrs  = self.uncarray.tolist()
+        self.etaedges = self.etabins.tolist()
+        self.phiedges = self.phibins.tolist()
+        self.ratiolist = self.ratios.tolist()
+        
+    @staticmethod
+    def fromPayload(payload, prefix=""):
+        """Create the efficiency from the arrays of a payload, see getEfficiencyArrays."""
+        return TauTriggerEfficiency(payload['ptnodes'],payload[prefix+'fit'],payload[prefix+'uncedges'],payload[prefix+'uncerrs'],
+                                    payload[prefix+'etaedges'],payload[prefix+'phiedges'],payload[prefix+'ratios'])
+        
+    def eval(self, pt, eta, phi, uncert='Nominal'):
+        """Get the efficiency of a tau with pT within the range of the nodes."""
+        istep = min(int((pt-self.ptmin)/self.ptstep),self.nsteps-1)
+        frac  = (pt-self.ptnodes[istep])/self.ptstep
+        eff   = self.fitvals[istep]*(1.-frac) + self.fitvals[istep+1]*frac
+        if uncert=='Up':
+          eff += self.uncerrs[bisect_right(self.uncedges,pt)]
+        elif uncert=='Down':
+          eff -= self.uncerrs[bisect_right(self.uncedges,pt)]
+        ratio = self.ratiolist[bisect_right(self.etaedges,eta)][bisect_right(self.phiedges,phi)]
+        if ratio!=ratio:
+          print "One of the provided tau (eta, phi) values (%3.3f, %3.3f) is outside the boundary of triggering taus" % (eta, phi)
+          print "Returning efficiency = 0.0"
+          return 0.0
+        eff *= ratio
+        if eff > 1.: eff = 1.
+        if eff < 0.: eff = 0. # Some efficiency fits go negative at very low tau pT, prevent that.
+        return eff
+        
+    def evalArrays(self, pt, eta, phi):
+        """Get the nominal, up and down efficiencies for arrays of taus with pT within the range of the nodes."""
+        istep = num.minimum(((pt-self.ptmin)/self.ptstep).astype(num.int64),self.nsteps-1)
+        frac  = (pt-self.ptnodes[istep])/self.ptstep
+        eff   = self.fitarray[istep]*(1.-frac) + self.fitarray[istep+1]*frac
+        unc   = self.uncarray[num.searchsorted(self.uncbins,pt,side='right')]
+        ratio = self.ratios[num.searchsorted(self.etabins,eta,side='right'),num.searchsorted(self.phibins,phi,side='right')]
+        outside = num.isnan(ratio)
+        if outside.any():
+          print "%d of the provided tau (eta, phi) values are outside the boundary of triggering taus, returning efficiency = 0.0"%(num.count_nonzero(outside))
+        return tuple(num.where(outside,0.,num.clip(e*ratio,0.,1.)) for e in [eff,eff+unc,eff-unc])
+    
+
+
+def getEfficiencyArrays(fit, uncHist, etaPhiHist, etaPhiAvgHist, ptnodes, prefix=""):
+    """Tabulate the fit function on the pT nodes, and get the error band and eta-phi corrections as arrays."""
+    uncedges = getAxisEdges(uncHist.GetXaxis())
+    uncerrs  = [uncHist.GetBinError(i) for i in xrange(len(uncedges)+1)]
+    etaedges = sorted(set(getAxisEdges(etaPhiHist.GetXaxis()))|set(getAxisEdges(etaPhiAvgHist.GetXaxis())))
+    phiedges = sorted(set(getAxisEdges(etaPhiHist.GetYaxis()))|set(getAxisEdges(etaPhiAvgHist.GetYaxis())))
+    etavals  = [etaedges[0]-1.]+etaedges # a value in each bin
+    phivals  = [phiedges[0]-1.]+phiedges
+    ratios   = [ ]
+    for eta in etavals:
+      for phi in phivals:
+        etaPhiVal = etaPhiHist.GetBinContent(etaPhiHist.FindBin(eta,phi))
+        etaPhiAvg = etaPhiAvgHist.GetBinContent(etaPhiAvgHist.FindBin(eta,phi))
+        ratios.append(etaPhiVal/etaPhiAvg if etaPhiAvg>0. else num.nan)
+    return { prefix+'fit':      num.array([fit.Eval(pt) for pt in ptnodes],dtype=num.float64),
+             prefix+'uncedges': num.array(uncedges,dtype=num.float64), prefix+'uncerrs':  num.array(uncerrs,dtype=num.float64),
+             prefix+'etaedges': num.array(etaedges,dtype=num.float64), prefix+'phiedges': num.array(phiedges,dtype=num.float64),
+             prefix+'ratios':   num.array(ratios,dtype=num.float64) }
+    
+def buildPayload(filename, trigger, id, ptstep):
+    """Read the efficiencies of all WPs and DMs of a trigger from a file, and return their arrays."""
+    file    = ensureTFile(filename,'r')
+    names   = set(key.GetName() for key in file.GetListOfKeys())
+    nsteps  = max(1,int(math.ceil((ptmax-ptmin)/ptstep)))
+    ptnodes = num.linspace(ptmin,ptmax,nsteps+1)
+    payload = { 'ptnodes': ptnodes }
+    for wp in wps:
+      for dm in dms:
+        for type in ['DATA','MC']:
+          name = '%s_%s%s_dm%d_%s'%(trigger,wp,id,dm,type)
+          if name+'_fit' not in names: continue
+          payload.update(getEfficiencyArrays(extractTH1(file,name+'_fit'),extractTH1(file,name+'_errorBand'),
+                                             extractTH1(file,name),extractTH1(file,name+'_AVG'),ptnodes,'%s_dm%d_%s_'%(wp,dm,type)))
+    file.Close()
+    return payload
+    
+
+
 class TauTriggerSFs(object):
     
     def __new__(self,*args,**kwargs):
@@ -17,8 +125,10 @@ class TauTriggerSFs(object):
           return TauTriggerSFs2016(*args,**kwargs) #TauTriggerSFs2016.__new__(*args,**kwargs)
         return object.__new__(TauTriggerSFs)
     
-    def __init__(self, trigger, wp='medium', id='MVAv2', year=2016):
-        """Load tau trigger histograms from files."""
+    def __init__(self, trigger, wp='medium', id='MVAv2', year=2016, ptstep=0.1):
+        """Load tau trigger efficiencies from files. The fit functions are tabulated in pT steps of
+        at most ptstep. The efficiencies of all WPs of the trigger are loaded once, and shared by
+        the instances for other WPs, e.g. tight and vtight."""
         print "Loading TauTriggerSFs for %s (%s WP)..."%(trigger,wp)
         
         trigger = trigger.replace('tautau','ditau').replace('eletau','etau')
@@ -29,38 +139,26 @@ class TauTriggerSFs(object):
         assert(year in [2016,2017,2018]), "You must choose a year from: 2016, 2017, or 2018."
         print "Loading Efficiencies for trigger %s usingTau %s ID WP %s for year %i"%(trigger,id,wp,year)
         
+        # LOOK-UP TABLES: of all WPs, cached per year, and shared by all instances
         # Assume this is in CMSSW with the below path structure
+        cacheyear = year
         if year==2018: year = 2017
-        file = ensureTFile( path+'%d/tauTriggerEfficiencies%i.root'%(year,year), 'r' )
-        
-        self.fit_data = { }
-        self.fit_mc   = { }
-        self.fitUnc_data = { }
-        self.fitUnc_mc   = { }
-        self.effEtaPhi_data = { }
-        self.effEtaPhi_mc   = { }
-        self.effEtaPhiAvg_data = { }
-        self.effEtaPhiAvg_mc   = { }
-        for dm in [0,1,10]:
-          
-          # Load the TF1s containing the analytic best-fit results.
-          self.fit_data[dm] = extractTH1(file,'%s_%s%s_dm%d_DATA_fit'%(trigger,wp,id,dm))
-          self.fit_mc[dm]   = extractTH1(file,'%s_%s%s_dm%d_MC_fit'%(  trigger,wp,id,dm))
-          
-          # Load the TH1s containing the analytic best-fit result in 1 GeV incriments and the associated uncertainty.
-          self.fitUnc_data[dm] = extractTH1(file,'%s_%s%s_dm%d_DATA_errorBand'%(trigger,wp,id,dm))
-          self.fitUnc_mc[dm]   = extractTH1(file,'%s_%s%s_dm%d_MC_errorBand'%(  trigger,wp,id,dm))
-          
-          # Load the TH2s containing the eta phi efficiency corrections
-          self.effEtaPhi_data[dm] = extractTH1(file,'%s_%s%s_dm%d_DATA'%(trigger,wp,id,dm))
-          self.effEtaPhi_mc[dm]   = extractTH1(file,'%s_%s%s_dm%d_MC'%(  trigger,wp,id,dm))
-          
-          # Eta Phi Averages
-          self.effEtaPhiAvg_data[dm] = extractTH1(file,'%s_%s%s_dm%d_DATA_AVG'%(trigger,wp,id,dm))
-          self.effEtaPhiAvg_mc[dm]   = extractTH1(file,'%s_%s%s_dm%d_MC_AVG'%(  trigger,wp,id,dm))
-        
-        file.Close()
+        filename = path+'%d/tauTriggerEfficiencies%i.root'%(year,year)
+        key      = getPayloadKey('TauTriggerSFs',filename,trigger,id,str(ptstep))
+        if key not in payloads:
+          payloads[key] = loadPayload(key,[filename],lambda: buildPayload(filename,trigger,id,ptstep),year=cacheyear)
+        payload = payloads[key]
+        if '%s_dm0_DATA_fit'%(wp) not in payload:
+          print '>>> ERROR! TauTriggerSFs: Did not find efficiencies for trigger %s, WP %s in file %s!'%(trigger,wp,filename)
+          exit(1)
+        
+        self.eff_data = { }
+        self.eff_mc   = { }
+        for dm in dms:
+          self.eff_data[dm] = TauTriggerEfficiency.fromPayload(payload,'%s_dm%d_DATA_'%(wp,dm))
+          self.eff_mc[dm]   = TauTriggerEfficiency.fromPayload(payload,'%s_dm%d_MC_'%(wp,dm))
         
+        self.filename = filename
         self.trigger = trigger
         self.year = year
         self.wp = wp
@@ -69,8 +167,8 @@ class TauTriggerSFs(object):
     
     def ptCheck( self, pt ):
         """Make sure we stay on our histograms."""
-        if pt > 450:  pt = 450
-        elif pt < 20: pt = 20
+        if pt > ptmax:  pt = ptmax
+        elif pt < ptmin: pt = ptmin
         return pt
         
     def dmCheck( self, dm ):
@@ -79,17 +177,12 @@ class TauTriggerSFs(object):
         if dm==11: dm = 10
         return dm
         
-    def getEfficiency( self, pt, eta, phi, fit, uncHist, etaPhiHist, etaPhiAvgHist, uncert='Nominal' ):
+    def getEfficiency( self, pt, eta, phi, efficiency, uncert='Nominal' ):
         pt = self.ptCheck(pt)
-        eff = fit.Eval(pt)
         
         # Shift the pt dependent efficiency by the fit uncertainty if requested
         if uncert != 'Nominal':
             assert( uncert in ['Up', 'Down'] ), "Uncertainties are provided using 'Up'/'Down'"
-            if uncert == 'Up':
-                eff += uncHist.GetBinError( uncHist.FindBin(pt) )
-            else: # must be Down
-                eff -= uncHist.GetBinError( uncHist.FindBin(pt) )
         
         # Adjust SF based on (eta, phi) location
         # keep eta barrel boundaries within SF region
@@ -98,56 +191,66 @@ class TauTriggerSFs(object):
         if eta == 2.1:    eta = 2.09
         elif eta == -2.1: eta = -2.09
         
-        etaPhiVal = etaPhiHist.GetBinContent( etaPhiHist.FindBin( eta, phi ) )
-        etaPhiAvg = etaPhiAvgHist.GetBinContent( etaPhiAvgHist.FindBin( eta, phi ) )
-        if etaPhiAvg <= 0.0:
-            print "One of the provided tau (eta, phi) values (%3.3f, %3.3f) is outside the boundary of triggering taus" % (eta, phi)
-            print "Returning efficiency = 0.0"
-            return 0.0
-        eff *= etaPhiVal / etaPhiAvg
-        if eff > 1.: eff = 1.
-        if eff < 0.: eff = 0. # Some efficiency fits go negative at very low tau pT, prevent that.
-        return eff
+        return efficiency.eval(pt,eta,phi,uncert)
+        
+    def getEfficiencyArrays( self, pt, eta, phi, dm, efficiencies ):
+        """Get the nominal, up and down efficiencies for arrays of taus, from the efficiencies per DM."""
+        pt  = num.clip(num.asarray(pt,dtype=num.float64),ptmin,ptmax)
+        eta = num.asarray(eta,dtype=num.float64)
+        eta = num.where(eta==2.1,2.09,num.where(eta==-2.1,-2.09,eta))
+        phi = num.asarray(phi,dtype=num.float64)
+        dm  = num.asarray(dm)
+        dm  = num.where(dm==2,1,num.where(dm==11,10,dm))
+        assert(num.in1d(dm,dms).all()), "Efficiencies only provided for DMs 0, 1, 10. You provided DMs %s" % num.unique(dm)
+        effs = tuple(num.zeros(len(pt)) for uncert in ['Nominal','Up','Down'])
+        for idm in dms:
+          taus = dm==idm
+          if not taus.any(): continue
+          for eff, values in zip(effs,efficiencies[idm].evalArrays(pt[taus],eta[taus],phi[taus])):
+            eff[taus] = values
+        return effs
         
     
     def getTriggerEfficiencyData(self, pt, eta, phi, dm):
         """Return the data efficiency or the +/- 1 sigma uncertainty shifted efficiency."""
         dm = self.dmCheck(dm)
         assert(dm in [0,1,10]), "Efficiencies only provided for DMs 0, 1, 10. You provided DM %i" % dm
-        return self.getEfficiency(pt,eta,phi,self.fit_data[dm],self.fitUnc_data[dm], \
-                                  self.effEtaPhi_data[dm], self.effEtaPhiAvg_data[dm])
+        return self.getEfficiency(pt,eta,phi,self.eff_data[dm])
         
     def getTriggerEfficiencyDataUncertUp(self, pt, eta, phi, dm):
         dm = self.dmCheck(dm)
         assert(dm in [0,1,10]), "Efficiencies only provided for DMs 0, 1, 10. You provided DM %i" % dm
-        return self.getEfficiency(pt,eta,phi,self.fit_data[dm],self.fitUnc_data[dm], \
-                                  self.effEtaPhi_data[dm], self.effEtaPhiAvg_data[dm], 'Up')
+        return self.getEfficiency(pt,eta,phi,self.eff_data[dm],'Up')
         
     def getTriggerEfficiencyDataUncertDown(self, pt, eta, phi, dm):
         dm = self.dmCheck(dm)
         assert(dm in [0,1,10]), "Efficiencies only provided for DMs 0, 1, 10. You provided DM %i" % dm
-        return self.getEfficiency(pt,eta,phi,self.fit_data[dm],self.fitUnc_data[dm], \
-                                  self.effEtaPhi_data[dm], self.effEtaPhiAvg_data[dm], 'Down')
+        return self.getEfficiency(pt,eta,phi,self.eff_data[dm],'Down')
+        
+    def getTriggerEfficienciesData(self, pt, eta, phi, dm):
+        """Return the nominal, up and down data efficiencies for arrays of taus."""
+        return self.getEfficiencyArrays(pt,eta,phi,dm,self.eff_data)
         
     
     def getTriggerEfficiencyMC(self, pt, eta, phi, dm):
         """Return the MC efficiency or the +/- 1 sigma uncertainty shifted efficiency."""
         dm = self.dmCheck(dm)
         assert(dm in [0,1,10]), "Efficiencies only provided for DMs 0, 1, 10. You provided DM %i" % dm
-        return self.getEfficiency(pt,eta,phi,self.fit_mc[dm],self.fitUnc_mc[dm], \
-                                  self.effEtaPhi_mc[dm], self.effEtaPhiAvg_mc[dm])
+        return self.getEfficiency(pt,eta,phi,self.eff_mc[dm])
         
     def getTriggerEfficiencyMCUncertUp(self, pt, eta, phi, dm):
         dm = self.dmCheck(dm)
         assert(dm in [0,1,10]), "Efficiencies only provided for DMs 0, 1, 10. You provided DM %i" % dm
-        return self.getEfficiency(pt,eta,phi,self.fit_mc[dm],self.fitUnc_mc[dm], \
-                                  self.effEtaPhi_mc[dm], self.effEtaPhiAvg_mc[dm], 'Up')
+        return self.getEfficiency(pt,eta,phi,self.eff_mc[dm],'Up')
         
     def getTriggerEfficiencyMCUncertDown(self, pt, eta, phi, dm):
         dm = self.dmCheck(dm)
         assert(dm in [0,1,10]), "Efficiencies only provided for DMs 0, 1, 10. You provided DM %i" % dm
-        return self.getEfficiency(pt,eta,phi,self.fit_mc[dm],self.fitUnc_mc[dm], \
-                                  self.effEtaPhi_mc[dm], self.effEtaPhiAvg_mc[dm], 'Down')
+        return self.getEfficiency(pt,eta,phi,self.eff_mc[dm],'Down')
+        
+    def getTriggerEfficienciesMC(self, pt, eta, phi, dm):
+        """Return the nominal, up and down MC efficiencies for arrays of taus."""
+        return self.getEfficiencyArrays(pt,eta,phi,dm,self.eff_mc)
         
     
     def getTriggerSF(self, pt, eta, phi, dm, genmatch=5):
@@ -192,6 +295,21 @@ class TauTriggerSFs(object):
             return sf * (1. + deltaSF)
         else: # must be Down
             return sf * (1. - deltaSF)
+        
+    def getTriggerSFs(self, pt, eta, phi, dm):
+        """Return the nominal data/MC scale factors, and the ones with +1/-1 sigma uncertainty,
+        for arrays of taus, as getTriggerSF and getTriggerScaleFactorUncert."""
+        effData, effDataUp, effDataDown = self.getTriggerEfficienciesData(pt,eta,phi,dm)
+        effMC,   effMCUp,   effMCDown   = self.getTriggerEfficienciesMC(pt,eta,phi,dm)
+        low = effMC < 1e-5
+        if low.any():
+          print "Eff MC is suspiciously low for %d taus. Please contact Tau POG." % num.count_nonzero(low)
+        with num.errstate(divide='ignore',invalid='ignore'):
+          relDataDiff = (effData - effDataDown) / effData
+          relMCDiff   = (effMC - effMCDown) / effMC
+          deltaSF     = num.sqrt( relDataDiff**2 + relMCDiff**2 )
+          sf          = effData / effMC
+        return tuple(num.where(low,0.,values) for values in [sf,sf*(1.+deltaSF),sf*(1.-deltaSF)])
     
 
 
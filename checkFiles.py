@@ -23,7 +23,7 @@ if __name__ == '__main__':
     parser = ArgumentParser(prog="checkFiles",description=description,epilog="Good luck!")
     parser.add_argument('-y', '--year',     dest='years', choices=[2016,2017,2018], type=int, nargs='+', default=[2017], action='store',
                                             help="select year" )
-    parser.add_argument('-c', '--channel',  dest='channels', choices=['mutau','eletau','tautau','mumu'], nargs='+', default=['tautau'], action='store' )
+    parser.add_argument('-c', '--channel',  dest='channels', choices=['mutau','eletau','tautau','mumu','elemu'], nargs='+', default=['tautau'], action='store' )
     parser.add_argument('-m', '--make',     dest='make', default=False, action='store_true',
                                             help="hadd all output files" )
     parser.add_argument('-a', '--hadd',     dest='haddother', default=False, action='store_true',
@@ -47,12 +47,12 @@ if __name__ == '__main__':
                                             help="veto this sample" )
     parser.add_argument('-t', '--type',     dest='type', choices=['data','mc'], type=str, default=None, action='store',
                                             help="filter data or MC to submit" )
-    parser.add_argument('-T', '--tes',      dest='tes', type=float, default=1.0, action='store',
-                                            help="tau energy scale" )
-    parser.add_argument('-L', '--ltf',      dest='ltf', type=float, default=1.0, action='store',
-                                            help="lepton to tau fake energy scale" )
-    parser.add_argument('-J', '--jtf',      dest='jtf', type=float, default=1.0, action='store',
-                                            help="jet to tau fake energy scale" )
+    parser.add_argument('-T', '--tes',      dest='tes', type=float, nargs='+', default=[1.0], action='store',
+                                            help="tau energy scale(s), each value is checked as a separate variation" )
+    parser.add_argument('-L', '--ltf',      dest='ltf', type=float, nargs='+', default=[1.0], action='store',
+                                            help="lepton to tau fake energy scale(s)" )
+    parser.add_argument('-J', '--jtf',      dest='jtf', type=float, nargs='+', default=[1.0], action='store',
+                                            help="jet to tau fake energy scale(s)" )
     parser.add_argument('-M', '--Zmass',    dest='Zmass', action='store_true', default=False,
                                             help="use Z mass window for dimuon spectrum" )
     parser.add_argument('-l', '--tag',      dest='tag', type=str, default="", action='store',
@@ -144,22 +144,18 @@ def main(args):
   
   years      = args.years
   channels   = args.channels
-  outtag     = args.tag
-  intag      = ""
+  tag        = args.tag
   tes        = args.tes
   ltf        = args.ltf
   jtf        = args.jtf
   Zmass      = args.Zmass
   #submitted  = getSubmittedJobs()
   
-  if outtag and '_' not in outtag[0]:
-    outtag = '_'+outtag
-  if tes!=1.: intag += "_TES%.3f"%(tes)
-  if ltf!=1.: intag += "_LTF%.3f"%(ltf)
-  if jtf!=1.: intag += "_JTF%.3f"%(jtf)
-  if Zmass:   intag += "_Zmass"
-  intag  = intag.replace('.','p')
-  outtag = intag+outtag
+  if tag and '_' not in tag[0]:
+    tag = '_'+tag
+  
+  # OUTPUT of each channel and variation, as written by job.py
+  outputs = [ (channel,intag) for channel in channels for intag in getOutputTags(channel,tes,ltf,jtf,Zmass) ]
   
   for year in years:
     indir      = "output_%s/"%(year)
@@ -189,7 +185,8 @@ def main(args):
       print 'samplelist = %s\n'%(samplelist)
     
     # CHECK samples
-    for channel in channels:
+    for channel, intag in outputs:
+      outtag = intag+tag
       print header(year,channel,intag)
       
       # HADD samples
@@ -486,6 +483,34 @@ def ensureDirectory(dirname):
       print '>>> failed to make directory "%s"'%(dirname)
   return dirname
   
+shifted_channels = [ 'mutau' ] # channels applying the energy scale shifts in job.py
+
+def getVariations(tes,ltf,jtf):
+  """Return the energy scale variations (tes,ltf,jtf), one per requested value of each scale,
+  with the other scales nominal, e.g. "-T 0.97 1.03 -L 0.97" gives three variations."""
+  variations = [ ]
+  for i, values in enumerate([tes,ltf,jtf]):
+    if values==[1.0]: continue
+    for value in values:
+      variation = [1.0,1.0,1.0]
+      variation[i] = value
+      if tuple(variation) not in variations:
+        variations.append(tuple(variation))
+  return variations or [(1.0,1.0,1.0)]
+  
+def getOutputTags(channel,tes=[1.],ltf=[1.],jtf=[1.],Zmass=False):
+  """Return the tags of the output files job.py writes for a channel, one per variation."""
+  variations = getVariations(tes,ltf,jtf) if channel in shifted_channels else [(1.0,1.0,1.0)]
+  tags = [ ]
+  for vtes, vltf, vjtf in variations:
+    tag = ""
+    if vtes!=1.: tag += "_TES%.3f"%(vtes)
+    if vltf!=1.: tag += "_LTF%.3f"%(vltf)
+    if vjtf!=1.: tag += "_JTF%.3f"%(vjtf)
+    if Zmass:    tag += "_Zmass"
+    tags.append(tag.replace('.','p'))
+  return tags
+  
 headeri = 0
 def header(year,channel,tag=""):
   global headeri
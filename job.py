@@ -3,7 +3,7 @@ import os, sys
 import PhysicsTools
 from PhysicsTools.NanoAODTools.postprocessing.framework.postprocessor import * 
 from argparse import ArgumentParser
-from checkFiles import ensureDirectory
+from checkFiles import ensureDirectory, getVariations, shifted_channels
 
 infiles = "root://cms-xrd-global.cern.ch//store/user/arizzi/Nano01Fall17/DY1JetsToLL_M-50_TuneCP5_13TeV-madgraphMLM-pythia8/RunIIFall17MiniAOD-94X-Nano01Fall17/180205_160029/0000/test94X_NANO_70.root"
 
@@ -12,31 +12,48 @@ parser.add_argument('-i', '--infiles', dest='infiles', action='store', type=str,
 parser.add_argument('-o', '--outdir',  dest='outdir', action='store', type=str, default="outdir")
 parser.add_argument('-N', '--outfile', dest='outfile', action='store', type=str, default="noname")
 parser.add_argument('-n', '--nchunck', dest='nchunck', action='store', type=int, default='test')
-parser.add_argument('-c', '--channel', dest='channel', action='store', choices=['tautau','mutau','eletau','elemu','mumu'], type=str, default='tautau')
+parser.add_argument('-c', '--channel', dest='channels', action='store', choices=['tautau','mutau','eletau','elemu','mumu'], type=str, nargs='+', default=['tautau'],
+                                       help="channels to run on a single event loop, with one output file each")
 parser.add_argument('-t', '--type',    dest='type', action='store', choices=['data','mc'], default='mc')
 parser.add_argument('-y', '--year',    dest='year', action='store', choices=[2016,2017,2018], type=int, default=2017)
 parser.add_argument('-M', '--Zmass',   dest='Zmass', action='store_true', default=False)
-parser.add_argument('-T', '--tes',     dest='tes', action='store', type=float, default=1.0)
-parser.add_argument('-L', '--ltf',     dest='ltf', action='store', type=float, default=1.0)
-parser.add_argument('-J', '--jtf',     dest='jtf', action='store', type=float, default=1.0)
+parser.add_argument('-T', '--tes',     dest='tes', action='store', type=float, nargs='+', default=[1.0],
+                                       help="tau energy scale(s) of mutau, each value of -T, -L and -J is a separate variation, all run on a single event loop")
+parser.add_argument('-L', '--ltf',     dest='ltf', action='store', type=float, nargs='+', default=[1.0])
+parser.add_argument('-J', '--jtf',     dest='jtf', action='store', type=float, nargs='+', default=[1.0])
+parser.add_argument('-B', '--batch',   dest='batch', action='store_true', default=False,
+                                       help="process events in columnar batches with numpy (mutau only)")
+parser.add_argument('-r', '--trace',   dest='trace', action='store', type=int, default=0,
+                                       help="record the input branches read in the first N events of each file, and add them to the manifest of the channel and year")
+parser.add_argument('-P', '--nopresel', dest='preselect', action='store_false', default=True,
+                                       help="do not preselect events with the cut strings of the channels")
+parser.add_argument('-A', '--allbranches', dest='allbranches', action='store_true', default=False,
+                                       help="activate all branches kept by keep_and_drop.txt, instead of the branch manifests")
+parser.add_argument('-k', '--chunksize', dest='chunksize', action='store', type=int, default=1000,
+                                       help="number of selected events buffered before writing them to the output tree")
+parser.add_argument('-F', '--format',  dest='formats', action='store', choices=['root','parquet','hdf5','npz'], type=str, nargs='+', default=['root'],
+                                       help="output formats of the flat tree, beside the ROOT file with histograms")
+parser.add_argument('-p', '--profile', dest='timing', action='store_true', default=False,
+                                       help="time the stages of the producers, and write the 'timing' histograms next to the cutflow")
 args = parser.parse_args()
 
-channel  = args.channel
+channels = args.channels
 dataType = args.type
 infiles  = args.infiles
 outdir   = args.outdir
 outfile  = args.outfile
 nchunck  = args.nchunck
 year     = args.year
-tes      = args.tes
 kwargs   = {
   'year':  year,
-  'tes':   args.tes,
-  'ltf':   args.ltf,
-  'jtf':   args.jtf,
   'ZmassWindow': args.Zmass,
+  'chunksize': args.chunksize,
+  'formats':   args.formats,
+  'timing':    args.timing,
 }
 
+variations = getVariations(args.tes,args.ltf,args.jtf)
+
 if isinstance(infiles,str):
   infiles = infiles.split(',')
 
@@ -57,60 +74,119 @@ else:
   json = JSON+'Cert_314472-325175_13TeV_PromptReco_Collisions18_JSON.txt'
   #json = '/afs/cern.ch/cms/CAF/CMSCOMM/COMM_DQM/certification/Collisions18/13TeV/PromptReco/Cert_314472-325175_13TeV_PromptReco_Collisions18_JSON.txt'
 
-tag = ""
-if args.tes!=1: tag +="_TES%.3f"%(args.tes)
-if args.ltf!=1: tag +="_LTF%.3f"%(args.ltf)
-if args.jtf!=1: tag +="_JTF%.3f"%(args.jtf)
-if args.Zmass:  tag +="_Zmass"
-outfile = "%s_%s_%s%s.root"%(outfile,nchunck,channel,tag.replace('.','p'))
-postfix = "%s/%s"%(outdir,outfile)
+def getTag(tes,ltf,jtf):
+  tag = ""
+  if tes!=1: tag +="_TES%.3f"%(tes)
+  if ltf!=1: tag +="_LTF%.3f"%(ltf)
+  if jtf!=1: tag +="_JTF%.3f"%(jtf)
+  if args.Zmass:  tag +="_Zmass"
+  return tag.replace('.','p')
+
+jobs      = [ (channel,tes,ltf,jtf) for channel in channels for tes, ltf, jtf in (variations if channel in shifted_channels else [(1.0,1.0,1.0)]) ]
+outfiles  = [ "%s_%s_%s%s.root"%(outfile,nchunck,channel,getTag(tes,ltf,jtf)) for channel, tes, ltf, jtf in jobs ]
+postfixes = [ "%s/%s"%(outdir,outfile) for outfile in outfiles ]
 
 print '-'*80
 print "%-12s = %s"%('input files',infiles)
 print "%-12s = %s"%('output directory',outdir)
-print "%-12s = %s"%('output file',outfile)
+print "%-12s = %s"%('output files',outfiles)
 print "%-12s = %s"%('chunck',nchunck)
-print "%-12s = %s"%('channel',channel)
+print "%-12s = %s"%('channels',channels)
 print "%-12s = %s"%('dataType',dataType)
 print "%-12s = %s"%('year',kwargs['year'])
 print "%-12s = %s"%('tes',args.tes)
 print "%-12s = %s"%('ltf',args.ltf)
 print "%-12s = %s"%('jtf',args.jtf)
 print "%-12s = %s"%('Zmass',args.Zmass)
+print "%-12s = %s"%('batch',args.batch)
+print "%-12s = %s"%('trace',args.trace)
+print "%-12s = %s"%('preselect',args.preselect)
 print '-'*80
 
-module2run = None
-if channel=='tautau':
-    from modules.ModuleTauTau import *
-    module2run = lambda: TauTauProducer(postfix, dataType, **kwargs)
-
-elif channel=='mutau':
-    from modules.ModuleMuTau import *
-    module2run = lambda: MuTauProducer(postfix, dataType, **kwargs)
-
-elif channel=='eletau':
-    from modules.ModuleEleTau import *
-    module2run = lambda: EleTauProducer(postfix, dataType, **kwargs)
-
-elif channel=='mumu':
-    from modules.ModuleMuMu import *
-    module2run = lambda: MuMuProducer(postfix, dataType, **kwargs)
-
-elif channel=='elemu':
-    from modules.ModuleEleMu import *
-    module2run = lambda: EleMuProducer(postfix, dataType)
-else:
-    print 'Unkown channel !!!'
+def getProducer(channel,tes,ltf,jtf,postfix):
+  options = dict(kwargs,tes=tes,ltf=ltf,jtf=jtf)
+  if channel=='tautau':
+    from modules.ModuleTauTau import TauTauProducer
+    return TauTauProducer(postfix, dataType, **options)
+  elif channel=='mutau':
+    from modules.ModuleMuTau import MuTauProducer
+    return MuTauProducer(postfix, dataType, **options)
+  elif channel=='eletau':
+    from modules.ModuleEleTau import EleTauProducer
+    return EleTauProducer(postfix, dataType, **options)
+  elif channel=='mumu':
+    from modules.ModuleMuMu import MuMuProducer
+    return MuMuProducer(postfix, dataType, **options)
+  elif channel=='elemu':
+    from modules.ModuleEleMu import EleMuProducer
+    return EleMuProducer(postfix, dataType, chunksize=options['chunksize'], formats=options['formats'], timing=options['timing'])
+  print 'Unkown channel !!!'
+  sys.exit(0)
+
+def getProducers():
+  producers = [ getProducer(channel,tes,ltf,jtf,postfix) for (channel,tes,ltf,jtf), postfix in zip(jobs,postfixes) ]
+  if args.trace>0:
+    from modules.BranchTools import BranchTracer, getManifest
+    producers = [ BranchTracer(producer,getManifest(channel,year),args.trace) for (channel,tes,ltf,jtf), producer in zip(jobs,producers) ]
+  return producers
+
+def getBranchSelection(producers, cut=None):
+  """Return the manifest of input branches read by the channels, or keep_and_drop.txt
+  if it is not available. Manifests are created with the --trace option, and only contain
+  the branches read in the traced events, so the branches the producers may read in any
+  event (see getStaticBranches) are always added, and the branches of the preselection,
+  as they are read by ROOT."""
+  if args.allbranches or args.trace>0:
+    return "keep_and_drop.txt"
+  from modules.BranchTools import getManifest, combineManifests, getStaticBranches
+  manifests = [ getManifest(channel,year) for channel in channels ]
+  missing   = [ m for m in manifests if not os.path.isfile(m) ]
+  if missing:
+    print ">>> Warning! No branch manifest %s, activating all branches kept by keep_and_drop.txt"%(', '.join(missing))
+    return "keep_and_drop.txt"
+  extra = getStaticBranches(producers)
+  if cut:
+    from modules.PreselectionTools import getFormulaBranches
+    extra |= getFormulaBranches(cut)
+  return combineManifests(manifests,"%s/branches_%s_%s.txt"%(outdir,outfile,nchunck),extra=extra)
+
+def module2run(producers):
+  if len(producers)==1:
+    return producers[0]
+  from modules.ModuleMultiChannel import MultiChannelProducer
+  return MultiChannelProducer(producers) # share one event loop
+
+if args.batch:
+    if args.trace>0:
+      print '>>> ERROR! The batch mode reads only the branches the producers need, tracing is not needed'
+      sys.exit(1)
+    from modules.BatchTools import BatchProcessor
+    print "job.py: creating BatchProcessor..."
+    p = BatchProcessor(infiles, getProducers(), jsonInput=(json if dataType=='data' else None))
+    print "job.py: going to run BatchProcessor..."
+    p.run()
+    print "DONE"
     sys.exit(0)
 
 print "job.py: creating PostProcessor..."
+producers = getProducers()
+module    = module2run(producers)
+cut       = None
+if args.preselect and args.trace<=0:
+  from modules.PreselectionTools import Preselector, combinePreselections
+  cut = combinePreselections(producers)
+  if cut:
+    module = Preselector(module, producers, jsonInput=(json if dataType=='data' else None))
+branchsel = getBranchSelection(producers,cut)
+print "%-12s = %s"%('cut',cut)
+print "%-12s = %s"%('branchsel',branchsel)
 if dataType=='data':
-    p = PostProcessor(outdir, infiles, None, "keep_and_drop.txt", noOut=True, 
-                      modules=[module2run()], provenance=False, fwkJobReport=False,
-                      jsonInput=json, postfix=postfix)
+    p = PostProcessor(outdir, infiles, cut, branchsel, noOut=True, 
+                      modules=[module], provenance=False, fwkJobReport=False,
+                      jsonInput=json, postfix=postfixes[0])
 else:
-    p = PostProcessor(outdir, infiles, None, "keep_and_drop.txt", noOut=True,
-                      modules=[module2run()], provenance=False, fwkJobReport=False, postfix=postfix)
+    p = PostProcessor(outdir, infiles, cut, branchsel, noOut=True,
+                      modules=[module], provenance=False, fwkJobReport=False, postfix=postfixes[0])
 
 print "job.py: going to run PostProcessor..."
 p.run()
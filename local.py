@@ -16,6 +16,12 @@ parser.add_argument('-l', '--tag',      dest='tag', action='store', type=str, de
 parser.add_argument('-M', '--Zmass',    dest='Zmass', action='store_true', default=False)
 parser.add_argument('-Z', '--doZpt',    dest='doZpt', action='store_true', default=False)
 parser.add_argument('-R', '--doRecoil', dest='doRecoil', action='store_true', default=False)
+parser.add_argument('-B', '--batch',    dest='batch', action='store_true', default=False,
+                                        help="process events in columnar batches with numpy (mutau only)")
+parser.add_argument('-r', '--trace',    dest='trace', action='store', type=int, default=0,
+                                        help="record the input branches read in the first N events, and add them to the manifest of the channel and year")
+parser.add_argument('-p', '--profile',  dest='timing', action='store_true', default=False,
+                                        help="time the stages of the producer, and write the 'timing' histograms next to the cutflow")
 args = parser.parse_args()
 
 channel  = args.channel
@@ -32,6 +38,7 @@ kwargs = {
   'doZpt':       args.doZpt,
   'doRecoil':    args.doRecoil,
   'ZmassWindow': args.Zmass,
+  'timing':      args.timing,
 }
 
 if isinstance(infiles,str):
@@ -288,6 +295,13 @@ else:
     print 'Invalid channel name'
 
 #p = PostProcessor(".",["../../../crab/WZ_TuneCUETP8M1_13TeV-pythia8.root"],"Jet_pt>150","keep_and_drop.txt",[exampleModule()],provenance=True)
-p = PostProcessor(".", infiles, None, "keep_and_drop.txt", noOut=True, modules=[module2run()], provenance=False, postfix=postfix)
+if args.batch:
+  from modules.BatchTools import BatchProcessor
+  p = BatchProcessor(infiles, [module2run()])
+elif args.trace>0:
+  from modules.BranchTools import BranchTracer, getManifest
+  p = PostProcessor(".", infiles, None, "keep_and_drop.txt", noOut=True, modules=[BranchTracer(module2run(),getManifest(channel,year),args.trace)], provenance=False, postfix=postfix)
+else:
+  p = PostProcessor(".", infiles, None, "keep_and_drop.txt", noOut=True, modules=[module2run()], provenance=False, postfix=postfix)
 
 p.run()
@@ -0,0 +1,317 @@
+# Tools to process nanoAOD trees in columnar batches of events with numpy,
+# instead of one event at a time through the nanoAOD-tools Event proxy.
+import time
+import numpy as num
+import ROOT
+from ROOT import TFile
+from TreeProducerCommon import redirectedBranches
+from Kinematics import deltaPhiArray, deltaRArray
+
+
+class EventBatch(object):
+    """Columnar container for a range of entries of a nanoAOD tree.
+    Flat branches (e.g. MET_pt) are stored as arrays of length nevents,
+    jagged branches (e.g. Muon_pt) as flat arrays of all objects in the batch,
+    with the number of objects per event in the length branch (e.g. nMuon).
+    Floating-point branches are stored as double precision, so comparisons
+    and arithmetic behave as in the per-event PyROOT loop."""
+
+    def __init__(self, arrays, nevents, start=0, chars=None):
+        self.__dict__['arrays']  = arrays
+        self.__dict__['nevents'] = nevents
+        self.__dict__['start']   = start
+        self.__dict__['chars']   = set(chars or [ ]) # UChar_t branches
+        self.__dict__['_cache']  = { }
+
+    def __len__(self):
+        return self.nevents
+
+    def __getattr__(self, name):
+        if name in self.arrays:
+          return self.arrays[name]
+        raise AttributeError("EventBatch: No branch '%s' in batch!"%(name))
+
+    def __setattr__(self, name, value):
+        self.arrays[name] = value
+
+    def __contains__(self, name):
+        return name in self.arrays
+
+    def counts(self, prefix):
+        """Number of objects per event in a collection."""
+        return self.arrays['n'+prefix]
+
+    def offsets(self, prefix):
+        """Index of the first object of each event in the flat arrays of a collection,
+        with a last element equal to the total number of objects."""
+        key = ('offsets',prefix)
+        if key not in self._cache:
+          offsets = num.zeros(self.nevents+1,dtype=num.int64)
+          num.cumsum(self.counts(prefix),out=offsets[1:])
+          self._cache[key] = offsets
+        return self._cache[key]
+
+    def eventIndex(self, prefix):
+        """Index of the parent event for each object of a collection."""
+        key = ('eventIndex',prefix)
+        if key not in self._cache:
+          self._cache[key] = num.repeat(num.arange(self.nevents),self.counts(prefix))
+        return self._cache[key]
+
+    def localIndex(self, prefix):
+        """Index of each object within its own event, as used by the per-event loop."""
+        key = ('localIndex',prefix)
+        if key not in self._cache:
+          self._cache[key] = num.arange(len(self.eventIndex(prefix))) - self.offsets(prefix)[self.eventIndex(prefix)]
+        return self._cache[key]
+
+    def isJagged(self, name):
+        """Check if a branch belongs to a collection with a length branch."""
+        prefix = name.split('_')[0]
+        return name!='n'+prefix and ('n'+prefix) in self.arrays and '_' in name
+
+    def select(self, mask):
+        """Return new batch with only the events passing a boolean mask."""
+        mask    = num.asarray(mask,dtype=bool)
+        arrays  = { }
+        masks   = { }
+        for name, array in self.arrays.iteritems():
+          if self.isJagged(name):
+            prefix = name.split('_')[0]
+            if prefix not in masks:
+              masks[prefix] = mask[self.eventIndex(prefix)]
+            arrays[name] = array[masks[prefix]]
+          else:
+            arrays[name] = array[mask]
+        return EventBatch(arrays,int(mask.sum()),self.start,self.chars)
+
+    def event(self, index):
+        """Return a per-event view of this batch."""
+        return BatchEvent(self,index)
+
+    def getEventValue(self, name, index):
+        """Get the value of a branch for a single event in the batch."""
+        array = self.arrays[name]
+        if self.isJagged(name):
+          offsets = self.offsets(name.split('_')[0])
+          value   = array[offsets[index]:offsets[index+1]]
+          if name in self.chars:
+            value = CharArray(value)
+          return value
+        return array[index].item()
+
+
+
+class CharArray(object):
+    """Wrap an unsigned char array to return single characters, like PyROOT
+    does for UChar_t branches, such that ord(event.Tau_idAntiMu[i]) still works."""
+
+    def __init__(self, array):
+        self.array = array
+
+    def __len__(self):
+        return len(self.array)
+
+    def __getitem__(self, index):
+        return chr(self.array[index])
+
+
+
+class BatchEvent(object):
+    """View of a single event in an EventBatch, mimicking the nanoAOD-tools Event
+    interface, so the per-event helpers (Collection, genmatch, getBoson, ...)
+    can be reused for the few events that pass the vectorized selections."""
+
+    def __init__(self, batch, index):
+        self.__dict__['_batch'] = batch
+        self.__dict__['_index'] = index
+
+    def __getattr__(self, name):
+        if name[:2]=='__' and name[-2:]=='__':
+          raise AttributeError(name)
+        if name not in self._batch:
+          raise RuntimeError("Unknown branch %s"%(name))
+        value = self._batch.getEventValue(name,self._index)
+        self.__dict__[name] = value
+        return value
+
+
+
+def readBatch(tree, branches, start, stop):
+    """Read a range of entries of a tree into an EventBatch with root_numpy."""
+    from root_numpy import tree2array
+    nevents   = stop-start
+    available = set(b.GetName() for b in tree.GetListOfBranches())
+    toread    = [ ]
+    renamed   = { }
+    constants = { }
+    redirects = dict(redirectedBranches)
+    for branch in branches:
+      if branch in available:
+        toread.append(branch)
+      elif branch in redirects:
+        oldbranch = redirects[branch]
+        if isinstance(oldbranch,str):
+          if oldbranch in available:
+            toread.append(oldbranch)
+            renamed[oldbranch] = branch
+        else:
+          constants[branch] = oldbranch
+
+    # add length branches of collections
+    for branch in toread[:]:
+      leaf  = tree.GetLeaf(branch)
+      count = leaf.GetLeafCount() if leaf else None
+      if count and count.GetName() not in toread:
+        toread.append(count.GetName())
+
+    arrays = { }
+    chars  = [ ]
+    data   = tree2array(tree,branches=toread,start=start,stop=stop)
+    for branch in toread:
+      array = data[branch]
+      leaf  = tree.GetLeaf(branch)
+      if leaf.GetLeafCount():
+        array = num.concatenate(array)
+      if array.dtype.kind=='f':
+        array = array.astype(num.float64)
+      elif array.dtype==num.uint8:
+        chars.append(renamed.get(branch,branch))
+      arrays[renamed.get(branch,branch)] = array
+    for branch, value in constants.iteritems():
+      arrays[branch] = num.full(nevents,value,dtype=type(value))
+
+    return EventBatch(arrays,nevents,start,chars)
+
+
+def iterateBatches(tree, branches, chunksize=10000, maxevents=-1):
+    """Iterate over a tree in batches of whole clusters of at least chunksize entries."""
+    nentries = tree.GetEntries()
+    if maxevents>0:
+      nentries = min(nentries,maxevents)
+    clusters = tree.GetClusterIterator(0)
+    start    = clusters.Next()
+    while start<nentries:
+      stop = clusters.GetNextEntry()
+      while stop-start<chunksize and stop<nentries:
+        clusters.Next()
+        stop = clusters.GetNextEntry()
+      stop = min(stop,nentries)
+      yield readBatch(tree,branches,start,stop)
+      start = clusters.Next()
+
+
+def getJSONMask(batch, jsonFilter):
+    """Get mask of events in a batch that pass the golden JSON."""
+    runlumis = num.stack((batch.run.astype(num.int64),batch.luminosityBlock.astype(num.int64)),axis=1)
+    unique, inverse = num.unique(runlumis,axis=0,return_inverse=True)
+    passed = num.array([jsonFilter.filterRunLumi(int(r),int(l)) for r, l in unique],dtype=bool)
+    return passed[inverse]
+
+
+
+def pairIndices(eventA, eventB, nevents, triangular=False):
+    """Build all pairs of objects A and B within the same event, given the event index
+    of each object in A and B, both sorted by event. Return the index in A and B of
+    each pair in the same order as the nested loop "for a in A: for b in B".
+    If triangular, A and B are the same list, and only pairs with a<b are kept."""
+    countsB  = num.bincount(eventB,minlength=nevents)
+    offsetsB = num.zeros(nevents+1,dtype=num.int64)
+    num.cumsum(countsB,out=offsetsB[1:])
+    npartner = countsB[eventA]
+    indexA   = num.repeat(num.arange(len(eventA)),npartner)
+    starts   = num.repeat(num.cumsum(npartner)-npartner,npartner)
+    indexB   = offsetsB[eventA[indexA]] + num.arange(len(indexA)) - starts
+    if triangular:
+      keep   = indexA<indexB
+      indexA = indexA[keep]
+      indexB = indexB[keep]
+    return indexA, indexB
+
+
+def firstPerEvent(events, nevents):
+    """Return mask of events that have an object, and the index of the first object
+    per event, for a list of object event indices sorted by event."""
+    unique, first = num.unique(events,return_index=True)
+    hasone = num.zeros(nevents,dtype=bool)
+    hasone[unique] = True
+    return hasone, first
+
+
+def anyPerEvent(mask, events, nevents):
+    """Check per event if any of its objects pass a mask."""
+    return num.bincount(events[mask],minlength=nevents)>0
+
+
+def fillHist(hist, values, weights=None):
+    """Fill a histogram with an array of values, like calling Fill for each value."""
+    values  = num.ascontiguousarray(values,dtype=num.float64)
+    if len(values)==0: return
+    if weights is None:
+      weights = num.ones(len(values),dtype=num.float64)
+    else:
+      weights = num.ascontiguousarray(weights,dtype=num.float64)
+    hist.FillN(len(values),values,weights)
+
+
+
+class BatchProcessor(object):
+    """Run producers with an analyzeBatch method over a list of nanoAOD files,
+    in columnar batches, instead of the nanoAOD-tools PostProcessor's event loop.
+    Each producer sees every event of the batch, independently of the others."""
+
+    def __init__(self, infiles, modules, jsonInput=None, chunksize=10000, maxevents=-1):
+        self.infiles    = infiles
+        self.modules    = modules
+        self.chunksize  = chunksize
+        self.maxevents  = maxevents
+        self.jsonFilter = None
+        if jsonInput:
+          from PhysicsTools.NanoAODTools.postprocessing.framework.preskimming import JSONFilter
+          self.jsonFilter = JSONFilter(jsonInput)
+        for module in modules:
+          assert hasattr(module,'analyzeBatch'), "BatchProcessor: Module %s has no analyzeBatch method!"%(module.__class__.__name__)
+
+    def getBranches(self):
+        """Get list of branches needed by all modules."""
+        branches = [ 'run', 'luminosityBlock' ]
+        for module in self.modules:
+          for branch in module.batchBranches:
+            if branch not in branches:
+              branches.append(branch)
+        return branches
+
+    def run(self):
+        """Process all input files."""
+        start0   = time.time()
+        branches = self.getBranches()
+        nentries = 0 # input entries, for the maximum number of events, as the PostProcessor
+        nevents  = 0 # events passing the JSON filter
+        for module in self.modules:
+          module.beginJob()
+        for filename in self.infiles:
+          print ">>> BatchProcessor: processing %s..."%(filename)
+          file = TFile.Open(filename)
+          if not file or file.IsZombie():
+            print ">>> ERROR! BatchProcessor.run: Could not open file %s!"%(filename)
+            exit(1)
+          tree = file.Get('Events')
+          for module in self.modules:
+            module.beginFile(file,None,tree,None)
+          maxevents = self.maxevents-nentries if self.maxevents>0 else -1
+          for batch in iterateBatches(tree,branches,self.chunksize,maxevents):
+            nentries += len(batch)
+            if self.jsonFilter:
+              batch = batch.select(getJSONMask(batch,self.jsonFilter))
+            for module in self.modules:
+              module.analyzeBatch(batch)
+            nevents += len(batch)
+          for module in self.modules:
+            module.endFile(file,None,tree,None)
+          file.Close()
+          if self.maxevents>0 and nentries>=self.maxevents: break
+        for module in self.modules:
+          module.endJob()
+        elapsed = time.time()-start0
+        print ">>> BatchProcessor: processed %d events (%d entries) in %.1f seconds (%.1f events/s)"%(nevents,nentries,elapsed,nevents/elapsed if elapsed>0 else 0.)
+
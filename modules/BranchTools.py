@@ -0,0 +1,173 @@
+# Tools to trace which input branches a producer reads, and to save them in a manifest,
+# so production jobs only activate (and decompress) those branches of the nanoAOD tree.
+import os
+from PhysicsTools.NanoAODTools.postprocessing.framework.eventloop import Module
+from TreeProducerCommon import redirectedBranches, tauIDBranches
+import SelectionTools
+from SelectionTools import Selection, PairSelection
+from GenTools import genmatchBranches, genbosonBranches
+
+manifestdir = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),'branches')
+alwaysKeep  = [ 'run', 'luminosityBlock', 'event' ] # needed by the JSON filter
+commonBranches = [ # event variables, MET filters and b tagging read by the producers
+  'PV_npvs', 'PV_npvsGood', 'fixedGridRhoFastjetAll', 'Flag_*',
+  'MET_pt', 'MET_phi', 'MET_covXX', 'MET_covXY', 'MET_covYY', 'MET_significance', 'PuppiMET_pt', 'PuppiMET_phi',
+  'Jet_btagDeepB',
+] + tauIDBranches
+objectBranches = [ 'pt', 'eta', 'phi', 'mass', 'charge' ] # of selected objects, e.g. for the DeltaR cleaning
+mcBranches = [ # inputs of the gen-level variables, weights and corrections of MC
+  'genWeight', 'Pileup_nTrueInt', 'Pileup_nPU', 'LHE_Njets', 'LHE_NpLO', 'LHE_NpNLO', 'GenMET_pt', 'GenMET_phi',
+  'Muon_genPartFlav', 'Electron_genPartFlav', 'Tau_genPartFlav', 'Jet_partonFlavour', 'Jet_hadronFlavour',
+  'nGenPart', 'GenPart_mass', 'GenPart_genPartIdxMother',
+  'nGenVisTau', 'GenVisTau_pt', 'GenVisTau_mass', 'GenVisTau_status', 'GenVisTau_genPartIdxMother',
+] + genmatchBranches + genbosonBranches
+
+
+def getManifest(channel, year):
+    """Return the path of the branch manifest of a channel and year."""
+    return os.path.join(manifestdir,"%s_%s.txt"%(channel,year))
+
+
+def readManifest(filename):
+    """Read the set of branches kept by a manifest."""
+    branches = set()
+    with open(filename) as file:
+      for line in file:
+        line = line.split('#')[0].split()
+        if len(line)==2 and line[0]=='keep':
+          branches.add(line[1])
+    return branches
+
+
+def writeManifest(filename, branches, comment=""):
+    """Write a manifest in the keep-and-drop format of the PostProcessor,
+    that drops all branches, except the given ones."""
+    dirname = os.path.dirname(filename)
+    if dirname and not os.path.exists(dirname):
+      os.makedirs(dirname)
+    with open(filename,'w') as file:
+      if comment:
+        file.write("# %s\n"%(comment))
+      file.write("drop *\n")
+      for branch in sorted(set(branches)|set(alwaysKeep)):
+        file.write("keep %s\n"%(branch))
+
+
+def combineManifests(manifests, filename, extra=[ ]):
+    """Write the union of several manifests, e.g. to run several channels in one job,
+    and some extra branches."""
+    branches = set(extra)
+    for manifest in manifests:
+      branches |= readManifest(manifest)
+    writeManifest(filename,branches,comment="combination of %s"%(', '.join(os.path.basename(m) for m in manifests)))
+    return filename
+
+
+def getStaticBranches(producers):
+    """Return the input branches the producers may read, independently of the events: the
+    branches of their object selections, of the lepton vetos and of their triggers, all
+    branches of the pair collections, as their variables are filled, and the inputs of the
+    gen-level tools and corrections of MC, and of the batch mode, if defined. A traced manifest
+    only has the branches read in the traced events, so these are always added, e.g. for a cut
+    evaluated only after a rare object passed the previous ones. Wildcards (*) are allowed."""
+    redirects  = dict(redirectedBranches)
+    selections = [ s for s in vars(SelectionTools).values() if isinstance(s,Selection) ] # e.g. lepton vetos
+    branches   = set(alwaysKeep+commonBranches)
+    for producer in producers:
+      for attr in vars(producer).values():
+        if isinstance(attr,Selection):
+          selections.append(attr)
+        elif isinstance(attr,PairSelection):
+          branches.update([attr.prefix1+'_*',attr.prefix2+'_*'])
+      branches.update(getattr(producer,'triggers',[ ]))
+      branches.update(getattr(producer,'batchBranches',[ ]))
+      if not getattr(producer,'isData',True):
+        branches.update(mcBranches)
+    for selection in selections:
+      branches.add('n'+selection.prefix)
+      branches.update(selection.branches())
+      branches.update(selection.prefix+'_'+var for var in objectBranches)
+    for branch in list(branches):
+      if isinstance(redirects.get(branch,None),str):
+        branches.add(redirects[branch])
+    return branches
+
+
+def getInputBranches(tree, names):
+    """Return the branches of a tree needed to read the given attributes of an event:
+    redirected branches are replaced by the old one (see checkBranches), and the length
+    branch is added for branches of a collection (e.g. nTau for Tau_pt)."""
+    available = set(b.GetName() for b in tree.GetListOfBranches())
+    redirects = dict(redirectedBranches)
+    branches  = set()
+    for name in names:
+      if name in available:
+        branches.add(name)
+      elif isinstance(redirects.get(name,None),str) and redirects[name] in available:
+        branches.add(redirects[name])
+    for branch in list(branches):
+      leaf  = tree.GetLeaf(branch)
+      count = leaf.GetLeafCount() if leaf else None
+      if count:
+        branches.add(count.GetName())
+    return branches
+
+
+
+class TracedEvent(object):
+    """Wrap an event to record the names of all attributes read from it."""
+
+    def __init__(self, event, accessed):
+        self.__dict__['_event']    = event
+        self.__dict__['_accessed'] = accessed
+
+    def __getattr__(self, name):
+        self._accessed.add(name)
+        return getattr(self._event,name)
+
+    def __setattr__(self, name, value):
+        setattr(self._event,name,value)
+
+
+
+class BranchTracer(Module):
+    """Run a producer on the first nevents events of each input file, and record which input
+    branches it reads. At the end of the job, they are added to the manifest, so branches
+    read only in some samples (e.g. data or MC) are kept by tracing both.
+    Branches read only in rare cases (e.g. after a short-circuited 'or' of triggers) are missed
+    if they never occur in the traced events, so jobs add getStaticBranches to the manifest."""
+
+    def __init__(self, module, manifest, nevents=-1):
+        self.module   = module
+        self.manifest = manifest
+        self.nevents  = nevents
+        self.accessed = set()
+        self.branches = set()
+        self.ntraced  = 0
+
+    def beginJob(self):
+        self.module.beginJob()
+
+    def endJob(self):
+        self.module.endJob()
+        if os.path.exists(self.manifest):
+          self.branches |= readManifest(self.manifest)
+        writeManifest(self.manifest,self.branches,comment="traced with BranchTracer")
+        print ">>> BranchTracer: wrote %d branches to %s"%(len(set(self.branches)|set(alwaysKeep)),self.manifest)
+
+    def beginFile(self, inputFile, outputFile, inputTree, wrappedOutputTree):
+        self.ntraced = 0
+        self.module.beginFile(inputFile,outputFile,inputTree,wrappedOutputTree)
+
+    def endFile(self, inputFile, outputFile, inputTree, wrappedOutputTree):
+        self.module.endFile(inputFile,outputFile,inputTree,wrappedOutputTree)
+        self.branches |= getInputBranches(inputTree,self.accessed)
+        self.accessed.clear()
+
+    def analyze(self, event):
+        """process the event with the producer, recording which branches it reads"""
+        if self.nevents>=0 and self.ntraced>=self.nevents:
+          return False
+        self.ntraced += 1
+        return self.module.analyze(TracedEvent(event,self.accessed))
+
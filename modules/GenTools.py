@@ -0,0 +1,151 @@
+# Tools to match reconstructed taus to generator-level particles with arrays,
+# for all taus of an event, or of a batch of events at once.
+import numpy as num
+from BatchTools import EventBatch, BatchEvent, pairIndices, firstPerEvent, anyPerEvent, deltaRArray
+from SelectionTools import getCache, getObjectValues, getObjectIndices, getEventIndex
+from Kinematics import getMomentum, getMass
+
+genmatchBranches = [
+  'Tau_eta', 'Tau_phi',
+  'GenPart_pt', 'GenPart_eta', 'GenPart_phi', 'GenPart_pdgId', 'GenPart_status', 'GenPart_statusFlags',
+  'GenVisTau_eta', 'GenVisTau_phi',
+]
+genbosonBranches = [
+  'GenPart_pt', 'GenPart_eta', 'GenPart_phi', 'GenPart_mass', 'GenPart_pdgId', 'GenPart_status', 'GenPart_statusFlags',
+]
+
+
+def getGenMatches(event, idxs=None, dRmax=0.2):
+    """Match reco taus to gen particles like genmatch, for a list of tau indices, sorted by
+    event, or all taus. The DeltaR between all taus and gen particles is computed at once.
+    Return an array of the genmatch codes:
+      1: prompt electron, 2: prompt muon, 3: electron from tau decay, 4: muon from tau decay,
+      5: real tau, 0: no match (jet).
+    The result is cached in the event, e.g. for several energy scale variations. For a single
+    event, the codes are memoized per tau index, so only taus not matched before are matched."""
+    isBatch   = isinstance(event,EventBatch)
+    idxs      = getObjectIndices(event,'Tau') if idxs is None else num.asarray(idxs,dtype=num.int64)
+    cache     = getCache(event)
+    if isBatch:
+      key     = ('genmatch',dRmax,idxs.tostring())
+      if key not in cache:
+        cache[key] = matchGenParticles(event,idxs,len(event),dRmax)
+      return cache[key].copy()
+    memo      = cache.setdefault(('genmatch',dRmax),{ })
+    idxs      = idxs.tolist()
+    missing   = [i for i in idxs if i not in memo]
+    if missing:
+      memo.update(zip(missing,matchGenParticles(event,num.array(missing,dtype=num.int64),1,dRmax).tolist()))
+    return num.array([memo[i] for i in idxs],dtype=num.int64)
+    
+
+def getGenMatch(event, itau, dRmax=0.2):
+    """Get the genmatch code of a single tau of an event, see getGenMatches."""
+    return int(getGenMatches(event,[itau],dRmax)[0])
+    
+
+def matchGenParticles(event, idxs, nevents, dRmax):
+    """Compute the genmatch codes of a list of taus, see getGenMatches."""
+    ntaus     = len(idxs)
+    genmatch  = num.zeros(ntaus,dtype=num.int64)
+    if ntaus==0:
+      return genmatch
+    tevt      = getEventIndex(event,'Tau',idxs)
+    eta_reco  = getObjectValues(event,'Tau_eta',idxs)
+    phi_reco  = getObjectValues(event,'Tau_phi',idxs)
+    
+    # lepton -> tau fakes: prompt electrons and muons, or electrons and muons from a prompt tau decay;
+    # the closest one within dRmax wins, the first one in case of a tie
+    gidxs     = getObjectIndices(event,'GenPart')
+    PID       = abs(getObjectValues(event,'GenPart_pdgId',gidxs,dtype=num.int64))
+    status    = getObjectValues(event,'GenPart_status',gidxs,dtype=num.int64)
+    flags     = getObjectValues(event,'GenPart_statusFlags',gidxs,dtype=num.int64)
+    isPrompt  = (flags & (1 << 0))>0 # isPrompt
+    isTauProd = (flags & (1 << 5))>0 # isDirectPromptTauDecayProduct
+    leptons   = ((PID==11) | (PID==13)) & (isPrompt | isTauProd)
+    leptons  &= ~((status!=1) & (PID!=13))
+    leptons  &= ~(getObjectValues(event,'GenPart_pt',gidxs) < 8)
+    codes     = num.where(isPrompt,num.where(PID==11,1,2),num.where(PID==11,3,4))[leptons]
+    gidxs     = gidxs[leptons]
+    
+    pos1, pos2 = pairIndices(tevt,getEventIndex(event,'GenPart',gidxs),nevents)
+    dR        = deltaRArray(eta_reco[pos1],phi_reco[pos1],
+                            getObjectValues(event,'GenPart_eta',gidxs)[pos2],getObjectValues(event,'GenPart_phi',gidxs)[pos2])
+    match     = dR < dRmax
+    pos1, pos2, dR = pos1[match], pos2[match], dR[match]
+    order     = num.lexsort((num.arange(len(dR)),dR,pos1))
+    hasmatch, best = firstPerEvent(pos1[order],ntaus)
+    dR_min    = num.full(ntaus,dRmax)
+    dR_min[hasmatch]   = dR[order[best]]
+    genmatch[hasmatch] = codes[pos2[order[best]]]
+    
+    # real tau leptons
+    vidxs     = getObjectIndices(event,'GenVisTau')
+    pos1, pos2 = pairIndices(tevt,getEventIndex(event,'GenVisTau',vidxs),nevents)
+    dR        = deltaRArray(eta_reco[pos1],phi_reco[pos1],
+                            getObjectValues(event,'GenVisTau_eta',vidxs)[pos2],getObjectValues(event,'GenVisTau_phi',vidxs)[pos2])
+    genmatch[anyPerEvent(dR < dR_min[pos1],pos1,ntaus)] = 5
+    
+    return genmatch
+    
+
+
+def getGenBosons(event):
+    """Compute the generator-level bosons and top quarks of an event, or of all events of a batch,
+    in one pass over the GenPart arrays, like getBoson, getZBoson and getTTPt in RecoilCorrectionTool,
+    without building a Python object per particle. Return a dictionary of arrays with a value per event:
+      boson_px, boson_py, boson_pt, boson_m:  full Z/W/H boson, for recoil corrections,
+      bosonvis_px, bosonvis_py:               visible boson, without neutrinos,
+      zboson_pt, zboson_m:                    Z boson from the leptons, for Z pT reweighting,
+      toppt1, toppt2:                         pT of the top quarks, -1 if not found.
+    The result is cached in the event. For an event of a batch, it is taken from the batch."""
+    if isinstance(event,BatchEvent):
+      index = event._index
+      return dict((key,values[index:index+1]) for key, values in getGenBosons(event._batch).iteritems())
+    cache = getCache(event)
+    if 'genbosons' not in cache:
+      cache['genbosons'] = sumGenBosons(event,len(event) if isinstance(event,EventBatch) else 1)
+    return cache['genbosons']
+    
+
+def sumGenBosons(event, nevents):
+    """Sum the four-momenta of the gen particles of the bosons, see getGenBosons.
+    The momenta are computed and added in the same order as TLorentzVector."""
+    gidxs     = getObjectIndices(event,'GenPart')
+    gevt      = getEventIndex(event,'GenPart',gidxs)
+    PID       = abs(getObjectValues(event,'GenPart_pdgId',gidxs,dtype=num.int64))
+    status    = getObjectValues(event,'GenPart_status',gidxs,dtype=num.int64)
+    flags     = getObjectValues(event,'GenPart_statusFlags',gidxs,dtype=num.int64)
+    px, py, pz, energy = getMomentum(getObjectValues(event,'GenPart_pt',gidxs),getObjectValues(event,'GenPart_eta',gidxs),
+                                     getObjectValues(event,'GenPart_phi',gidxs),getObjectValues(event,'GenPart_mass',gidxs))
+    fromHard  = (flags & (1 << 8))>0 # fromHardProcess
+    tauProd   = (flags & (1 << 10))>0 # isDirectHardProcessTauDecayProduct
+    leptons   = (PID==11) | (PID==13)
+    neutrinos = (PID==12) | (PID==14) | (PID==16)
+    bosons    = { }
+    for name, particles in [('boson',    ((leptons | neutrinos) & (status==1) & fromHard) | tauProd),
+                            ('zboson',   (leptons & (status==1) & fromHard) | ((PID==15) & (status==2) & fromHard))]:
+      sums = [num.bincount(gevt[particles],weights=values[particles],minlength=nevents) for values in [px,py,pz,energy]]
+      bosons[name+'_px'], bosons[name+'_py'] = sums[0], sums[1]
+      bosons[name+'_pt'] = num.sqrt(sums[0]*sums[0]+sums[1]*sums[1])
+      bosons[name+'_m']  = getMass(*sums)
+    visible   = (((leptons & (status==1) & fromHard) | tauProd) & ~neutrinos)
+    bosons['bosonvis_px'] = num.bincount(gevt[visible],weights=px[visible],minlength=nevents)
+    bosons['bosonvis_py'] = num.bincount(gevt[visible],weights=py[visible],minlength=nevents)
+    
+    # top quarks: the highest pT, and the second one, as in getTTPt, for events with more than two
+    tops      = (PID==6) & (status==62)
+    tevt, tpt = gevt[tops], getObjectValues(event,'GenPart_pt',gidxs)[tops]
+    toppt1    = num.full(nevents,-1.)
+    toppt2    = num.full(nevents,-1.)
+    if len(tevt):
+      last    = num.append(tevt[1:]!=tevt[:-1],True) # last top quark of each event
+      before  = num.full(nevents,-1.) # highest pT before the last top quark
+      num.maximum.at(toppt1,tevt,tpt)
+      num.maximum.at(before,tevt[~last],tpt[~last])
+      tevt, tpt = tevt[last], tpt[last]
+      several = before[tevt]>=0
+      toppt2[tevt[several]] = num.where(tpt>before[tevt],before[tevt],tpt)[several]
+    bosons['toppt1'], bosons['toppt2'] = toppt1, toppt2
+    return bosons
+
@@ -0,0 +1,109 @@
+# Kinematic variables computed directly from the pT, eta, phi and mass of objects,
+# without TLorentzVector or TVector3, for single values, or numpy arrays of them.
+import math
+from math import sqrt, pi
+import numpy as num
+
+
+def isArray(*values):
+  """Check if any of the values is a numpy array."""
+  return any(isinstance(value,num.ndarray) for value in values)
+
+
+def deltaR(eta1, phi1, eta2, phi2):
+    """Compute DeltaR."""
+    deta = eta1 - eta2
+    dphi = deltaPhi(phi1, phi2)
+    return sqrt( deta*deta + dphi*dphi )
+
+def deltaPhi(phi1, phi2):
+    """Computes Delta phi, handling periodic limit conditions."""
+    res = phi1 - phi2
+    while res > pi:
+      res -= 2*pi
+    while res < -pi:
+      res += 2*pi
+    return res
+
+def deltaPhiArray(phi1, phi2):
+    """Vectorized Delta phi, handling periodic limit conditions for phi in [-pi,pi]."""
+    res = phi1 - phi2
+    res = num.where(res>pi,res-2*pi,res)
+    res = num.where(res<-pi,res+2*pi,res)
+    return res
+
+def deltaRArray(eta1, phi1, eta2, phi2):
+    """Vectorized DeltaR."""
+    deta = eta1 - eta2
+    dphi = deltaPhiArray(phi1,phi2)
+    return num.sqrt(deta*deta + dphi*dphi)
+
+
+def getMomentum(pt, eta, phi, mass):
+    """Get px, py, pz and the energy, as TLorentzVector.SetPtEtaPhiM."""
+    lib    = num if isArray(pt,eta,phi,mass) else math
+    pt     = abs(pt)
+    px, py, pz = pt*lib.cos(phi), pt*lib.sin(phi), pt*lib.sinh(eta)
+    p2     = px*px+py*py+pz*pz
+    if lib is num:
+      energy = num.where(mass>=0,num.sqrt(p2+mass*mass),num.sqrt(num.maximum(p2-mass*mass,0.)))
+    else:
+      energy = sqrt(p2+mass*mass) if mass>=0 else sqrt(max(p2-mass*mass,0.))
+    return px, py, pz, energy
+
+def getMass(px, py, pz, energy):
+    """Invariant mass of four-momenta, negative for space-like ones, as TLorentzVector.M."""
+    m2 = energy*energy - (px*px+py*py+pz*pz)
+    if isArray(m2):
+      return num.where(m2<0.,-num.sqrt(abs(m2)),num.sqrt(abs(m2)))
+    return -sqrt(-m2) if m2<0. else sqrt(m2)
+
+def getPtPhi(px, py):
+    """Get the pT and phi of a transverse momentum, as TLorentzVector.Pt and Phi."""
+    if isArray(px,py):
+      return num.sqrt(px*px+py*py), num.where((px==0.) & (py==0.),0.,num.arctan2(py,px))
+    return sqrt(px*px+py*py), (0. if px==0. and py==0. else math.atan2(py,px))
+
+
+def getPairMass(pt1, eta1, phi1, m1, pt2, eta2, phi2, m2):
+    """Invariant mass of the sum of two objects."""
+    px1, py1, pz1, e1 = getMomentum(pt1,eta1,phi1,m1)
+    px2, py2, pz2, e2 = getMomentum(pt2,eta2,phi2,m2)
+    return getMass(px1+px2,py1+py2,pz1+pz2,e1+e2)
+
+def getPairPt(pt1, phi1, pt2, phi2):
+    """Transverse momentum of the sum of two objects."""
+    lib = num if isArray(pt1,phi1,pt2,phi2) else math
+    pt1, pt2 = abs(pt1), abs(pt2)
+    px, py = pt1*lib.cos(phi1)+pt2*lib.cos(phi2), pt1*lib.sin(phi1)+pt2*lib.sin(phi2)
+    return lib.sqrt(px*px+py*py)
+
+def getTransverseMass(pt1, phi1, pt2, phi2):
+    """Transverse mass of two objects, e.g. a lepton and the MET."""
+    if isArray(pt1,phi1,pt2,phi2):
+      return num.sqrt( 2 * pt1 * pt2 * ( 1 - num.cos(deltaPhiArray(phi1, phi2)) ) )
+    return sqrt( 2 * pt1 * pt2 * ( 1 - math.cos(deltaPhi(phi1, phi2)) ) )
+
+def getPZeta(pt1, phi1, pt2, phi2, metpx, metpy):
+    """Compute the projections of the visible momentum of two legs, and of the MET, on the
+    bisector of the legs in the transverse plane (zeta axis). Return pzeta_miss, pzeta_vis."""
+    lib = num if isArray(pt1,phi1,pt2,phi2,metpx,metpy) else math
+    pt1, pt2   = abs(pt1), abs(pt2)
+    px1, py1   = pt1*lib.cos(phi1), pt1*lib.sin(phi1)
+    px2, py2   = pt2*lib.cos(phi2), pt2*lib.sin(phi2)
+    ux, uy     = getUnit(px1,py1,lib)
+    vx, vy     = getUnit(px2,py2,lib)
+    zetax, zetay = getUnit(ux+vx,uy+vy,lib)
+    pzeta_vis  = (px1*zetax + py1*zetay) + (px2*zetax + py2*zetay)
+    pzeta_miss = metpx*zetax + metpy*zetay
+    return pzeta_miss, pzeta_vis
+
+def getUnit(x, y, lib=math):
+    """Get the unit vector of a vector in the transverse plane, or the vector itself if it is zero, as TVector3.Unit."""
+    mag2 = x*x+y*y
+    if lib is num:
+      norm = num.where(mag2>0,1./num.sqrt(num.where(mag2>0,mag2,1.)),1.)
+    else:
+      norm = 1./sqrt(mag2) if mag2>0 else 1.
+    return x*norm, y*norm
+
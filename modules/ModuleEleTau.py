@@ -4,6 +4,11 @@ from PhysicsTools.NanoAODTools.postprocessing.framework.datamodel import Collect
 from PhysicsTools.NanoAODTools.postprocessing.framework.eventloop import Module
 
 from TreeProducerEleTau import *
+from SelectionTools import *
+from PreselectionTools import getPreselection, projectTotals
+from TimingTools import getStageTimer
+from GenTools import getGenMatch, getGenBosons
+from Kinematics import getPtPhi, getPairMass, getPairPt, getTransverseMass, getPZeta
 from CorrectionTools.ElectronSFs import *
 from CorrectionTools.PileupWeightTool import *
 from CorrectionTools.LeptonTauFakeSFs import *
@@ -16,7 +21,8 @@ class EleTauProducer(Module):
     def __init__(self, name, dataType, **kwargs):
         
         self.name           = name
-        self.out            = TreeProducerEleTau(name)
+        self.out            = TreeProducerEleTau(name,chunksize=kwargs.get('chunksize',1000),formats=kwargs.get('formats',['root']))
+        self.timer          = getStageTimer(name,['trigger','electrons','taus','pairs','vetos','jets','gen','weights','fill'],kwargs.get('timing',False))
         self.isData         = dataType=='data'
         self.year           = kwargs.get('year',     2017 )
         self.tes            = kwargs.get('tes',      1.0  )
@@ -31,21 +37,31 @@ class EleTauProducer(Module):
         
         self.vlooseIso      = getVLooseTauIso(year)
         if year==2016:
+          self.triggers     = ['HLT_Ele25_eta2p1_WPTight_Gsf','HLT_Ele27_WPTight_Gsf']
           self.trigger      = lambda e: e.HLT_Ele25_eta2p1_WPTight_Gsf or e.HLT_Ele27_WPTight_Gsf #or e.HLT_Ele45_WPLoose_Gsf_L1JetTauSeeded #or e.HLT_Ele24_eta2p1_WPLoose_Gsf_LooseIsoPFTau20_SingleL1 or e.HLT_Ele24_eta2p1_WPLoose_Gsf_LooseIsoPFTau20 or e.HLT_Ele24_eta2p1_WPLoose_Gsf_LooseIsoPFTau30
           self.eleCutPt     = 26
         elif year==2017:
+          self.triggers     = ['HLT_Ele35_WPTight_Gsf','HLT_Ele32_WPTight_Gsf_L1DoubleEG','HLT_Ele32_WPTight_Gsf']
           self.trigger      = lambda e: e.HLT_Ele35_WPTight_Gsf or e.HLT_Ele32_WPTight_Gsf_L1DoubleEG or e.HLT_Ele32_WPTight_Gsf
           self.eleCutPt     = 36
         else:
+          self.triggers     = ['HLT_Ele32_WPTight_Gsf','HLT_Ele35_WPTight_Gsf']
           self.trigger      = lambda e: e.HLT_Ele32_WPTight_Gsf or e.HLT_Ele35_WPTight_Gsf
           self.eleCutPt     = 33
         self.tauCutPt       = 20
+        self.eleSel         = getElectronSelection(self.eleCutPt,mvaWP='WP80')
+        self.tauSel         = getTauSelection(year)
+        self.jetSel         = getJetSelection(30)
+        self.pairSel        = PairSelection('Electron','pfRelIso03_all','Tau','rawMVAoldDM2017v2',LeptonTauPair)
+        self.preselection   = getPreselection(self.isData,self.triggers,self.eleSel.formula(),
+                                              Selection('Tau',self.tauSel.cuts+[('pt','>=',self.tauCutPt)]).formula())
+        self.preselected    = False # cutflow before the trigger filled by fillTotals
         
         if not self.isData:
           self.eleSFs       = ElectronSFs(year=year)
           self.puTool       = PileupWeightTool(year=year)
           self.ltfSFs       = LeptonTauFakeSFs('loose','tight',year=year)
-          self.btagTool     = BTagWeightTool('DeepCSV','medium',channel='mutau',year=year)
+          self.btagTool     = BTagWeightTool('DeepCSV','medium',channel='mutau',year=year,sigmas=['up','down'])
           if self.doZpt: 
             self.zptTool    = ZptCorrectionTool(year=year)
           if self.doRecoil:
@@ -75,6 +91,7 @@ class EleTauProducer(Module):
     def endJob(self):
         if not self.isData:
           self.btagTool.setDirectory(self.out.outputfile,'btag')
+        self.timer.endJob(self.out)
         self.out.endJob()
         
     def beginFile(self, inputFile, outputFile, inputTree, wrappedOutputTree):
@@ -84,28 +101,37 @@ class EleTauProducer(Module):
     def endFile(self, inputFile, outputFile, inputTree, wrappedOutputTree):        
         pass
         
+    def fillTotals(self, tree, elist=None):
+        """Fill the cutflow before the trigger for all entries of the input tree,
+        if the events are preselected by the PostProcessor (see PreselectionTools)."""
+        projectTotals(tree,self.out.cutflow,self.isData,self.Nocut,self.TotalWeighted,self.TotalWeighted_no0PU,elist=elist)
+        
     def analyze(self, event):
         """process event, return True (go to next module) or False (fail, go to next event)"""
         sys.stdout.flush()
+        self.timer.start()
         
         #####################################
-        self.out.cutflow.Fill(self.Nocut)
-        if self.isData:
-          self.out.cutflow.Fill(self.TotalWeighted, 1.)
-          if event.PV_npvs>0:
-            self.out.cutflow.Fill(self.TotalWeighted_no0PU, 1.)
-          else:
-            return False
-        else:
-          self.out.cutflow.Fill(self.TotalWeighted, event.genWeight)
-          if event.Pileup_nTrueInt>0:
-            self.out.cutflow.Fill(self.TotalWeighted_no0PU, event.genWeight)
+        if not self.preselected:
+          self.out.cutflow.Fill(self.Nocut)
+          if self.isData:
+            self.out.cutflow.Fill(self.TotalWeighted, 1.)
+            if event.PV_npvs>0:
+              self.out.cutflow.Fill(self.TotalWeighted_no0PU, 1.)
+            else:
+              return False
           else:
-            return False
+            self.out.cutflow.Fill(self.TotalWeighted, event.genWeight)
+            if event.Pileup_nTrueInt>0:
+              self.out.cutflow.Fill(self.TotalWeighted_no0PU, event.genWeight)
+            else:
+              return False
         #####################################
         
         
-        if not self.trigger(event):
+        triggered = self.trigger(event)
+        self.timer.lap('trigger')
+        if not triggered:
             return False
         
         #####################################
@@ -113,16 +139,8 @@ class EleTauProducer(Module):
         #####################################
         
         
-        idx_goodelectrons = [ ]
-        for ielectron in range(event.nElectron):
-            if event.Electron_pt[ielectron] < self.eleCutPt: continue
-            if abs(event.Electron_eta[ielectron]) > 2.1: continue
-            if abs(event.Electron_dz[ielectron]) > 0.2: continue
-            if abs(event.Electron_dxy[ielectron]) > 0.045: continue
-            if event.Electron_convVeto[ielectron] !=1: continue
-            if ord(event.Electron_lostHits[ielectron]) > 1: continue
-            if event.Electron_mvaFall17V2Iso_WP80[ielectron] < 0.5: continue
-            idx_goodelectrons.append(ielectron)
+        idx_goodelectrons = self.eleSel.indices(event)
+        self.timer.lap('electrons')
         
         if len(idx_goodelectrons)==0:
             return False
@@ -132,16 +150,10 @@ class EleTauProducer(Module):
         #####################################
         
         
-        Tau_genmatch = { } # bug in Tau_genPartFlav
-        idx_goodtaus = [ ]
-        for itau in range(event.nTau):
-            if not self.vlooseIso(event,itau): continue
-            if abs(event.Tau_eta[itau]) > 2.3: continue
-            if abs(event.Tau_dz[itau]) > 0.2: continue
-            if event.Tau_decayMode[itau] not in [0,1,10]: continue
-            if abs(event.Tau_charge[itau])!=1: continue
-            if not self.isData:
-              Tau_genmatch[itau] = genmatch(event,itau)
+        idx_goodtaus  = [ ]
+        idx_loosetaus = self.tauSel.indices(event)
+        for itau in idx_loosetaus:
+            #if not self.isData:
               #if self.tes!=1.0 and Tau_genmatch[itau]==5:
               #  event.Tau_pt[itau]   *= self.tes
               #  event.Tau_mass[itau] *= self.tes
@@ -155,6 +167,7 @@ class EleTauProducer(Module):
             ###if ord(event.Tau_idAntiEle[itau])<1: continue
             ###if ord(event.Tau_idAntiMu[itau])<1: continue
             idx_goodtaus.append(itau)
+        self.timer.lap('taus')
         
         if len(idx_goodtaus)==0:
             return False
@@ -164,23 +177,13 @@ class EleTauProducer(Module):
         #####################################
         
         
-        electrons = Collection(event, 'Electron')
-        taus  = Collection(event, 'Tau')
-        ltaus = [ ]
-        for idx1 in idx_goodelectrons:
-            for idx2 in idx_goodtaus:
-                dR = taus[idx2].p4().DeltaR(electrons[idx1].p4())
-                if dR < 0.5: continue
-                ltau = LeptonTauPair(idx1, event.Electron_pt[idx1], event.Electron_pfRelIso03_all[idx1],
-                                     idx2, event.Tau_pt[idx2],      event.Tau_rawMVAoldDM2017v2[idx2])
-                ltaus.append(ltau)
-        
-        if len(ltaus)==0:
+        ltau = self.pairSel.best(event,idx_goodelectrons,idx_goodtaus)
+        self.timer.lap('pairs')
+        if ltau==None:
             return False
         
-        ltau     = bestDiLepton(ltaus)
-        electron = electrons[ltau.id1].p4()
-        tau      = taus[ltau.id2].p4()
+        electron_pt, electron_eta, electron_phi, electron_mass = event.Electron_pt[ltau.id1], event.Electron_eta[ltau.id1], event.Electron_phi[ltau.id1], event.Electron_mass[ltau.id1]
+        tau_pt, tau_eta, tau_phi, tau_mass = event.Tau_pt[ltau.id2], event.Tau_eta[ltau.id2], event.Tau_phi[ltau.id2], event.Tau_mass[ltau.id2]
         #print 'chosen tau1 (idx, pt) = ', ltau.id1, ltau.tau1_pt, 'check', electron.p4().Pt()
         #print 'chosen tau2 (idx, pt) = ', ltau.id2, ltau.tau2_pt, 'check', tau.p4().Pt()
         
@@ -192,6 +195,7 @@ class EleTauProducer(Module):
         # VETOS
         self.out.extramuon_veto[0], self.out.extraelec_veto[0], self.out.dilepton_veto[0] = extraLeptonVetos(event, [-1], [ltau.id1], self.channel)
         self.out.lepton_vetos[0] = self.out.extramuon_veto[0] or self.out.extraelec_veto[0] or self.out.dilepton_veto[0]
+        self.timer.lap('vetos')
         ###if self.doTight and (self.out.lepton_vetos[0] or event.Electron_pfRelIso03_all[ltau.id1]>0.10 or\
         ###                     ord(event.Tau_idAntiMu[ltau.id2]<1 or ord(event.Tau_idAntiEle[ltau.id2]<8):
         ###  return False
@@ -200,15 +204,12 @@ class EleTauProducer(Module):
         # JETS
         jetIds  = [ ]
         bjetIds = [ ]
-        jets    = Collection(event, 'Jet')
         nfjets  = 0
         ncjets  = 0
         nbtag   = 0
-        for ijet in range(event.nJet):
-            if event.Jet_pt[ijet] < 30: continue
-            if abs(event.Jet_eta[ijet]) > 4.7: continue
-            if electron.DeltaR(jets[ijet].p4()) < 0.5: continue
-            if tau.DeltaR(jets[ijet].p4()) < 0.5: continue
+        for ijet in self.jetSel.indices(event):
+            if deltaR(electron_eta,electron_phi,event.Jet_eta[ijet],event.Jet_phi[ijet]) < 0.5: continue
+            if deltaR(tau_eta,tau_phi,event.Jet_eta[ijet],event.Jet_phi[ijet]) < 0.5: continue
             jetIds.append(ijet)
             
             if abs(event.Jet_eta[ijet]) > 2.4:
@@ -222,6 +223,7 @@ class EleTauProducer(Module):
         
         if not self.isData and self.vlooseIso(event,ltau.id2) and event.Electron_pfRelIso03_all[ltau.id1]<0.50:
           self.btagTool.fillEfficiencies(event,jetIds)
+        self.timer.lap('jets')
         
         
         # EVENT
@@ -294,21 +296,21 @@ class EleTauProducer(Module):
         self.out.idMVAoldDM2017v1_2[0]         = ord(event.Tau_idMVAoldDM2017v1[ltau.id2])
         self.out.idMVAoldDM2017v2_2[0]         = ord(event.Tau_idMVAoldDM2017v2[ltau.id2])
         self.out.idMVAnewDM2017v2_2[0]         = ord(event.Tau_idMVAnewDM2017v2[ltau.id2])
+        self.timer.lap('fill')
         
         
         # GENERATOR      
         if not self.isData:
           self.out.genPartFlav_1[0]     = ord(event.Electron_genPartFlav[ltau.id1])
-          self.out.genPartFlav_2[0]     = Tau_genmatch[ltau.id2] # ord(event.Tau_genPartFlav[ltau.id2])
+          self.out.genPartFlav_2[0]     = getGenMatch(event,ltau.id2) # bug in Tau_genPartFlav
           
-          genvistau = Collection(event, 'GenVisTau')
           dRmax  = 1000
           gendm  = -1
           genpt  = -1
           geneta = -1
           genphi = -1
           for igvt in range(event.nGenVisTau):
-            dR = genvistau[igvt].p4().DeltaR(tau)
+            dR = deltaR(event.GenVisTau_eta[igvt],event.GenVisTau_phi[igvt],tau_eta,tau_phi)
             if dR < 0.5 and dR < dRmax:
               dRmax  = dR
               gendm  = event.GenVisTau_status[igvt]
@@ -320,36 +322,46 @@ class EleTauProducer(Module):
           self.out.genvistaupt_2[0]  = genpt
           self.out.genvistaueta_2[0] = geneta
           self.out.genvistauphi_2[0] = genphi
+        self.timer.lap('gen')
         
         
         # WEIGHTS
-        met = TLorentzVector()
-        met.SetPxPyPzE(event.MET_pt*cos(event.MET_phi),event.MET_pt*sin(event.MET_phi),0,event.MET_pt)
+        met_pt  = event.MET_pt # corrected below for recoil, without overwriting the event
+        met_phi = event.MET_phi
+        metpx   = met_pt*cos(met_phi)
+        metpy   = met_pt*sin(met_phi)
         if not self.isData:
           if self.doRecoil:
-            boson, boson_vis         = getBoson(event)
-            self.recoilTool.CorrectPFMETByMeanResolution(met,boson,boson_vis,len(jetIds))
-            event.MET_pt             = met.Pt()
-            event.MET_phi            = met.Phi()
-            self.out.m_genboson[0]   = boson.M()
-            self.out.pt_genboson[0]  = boson.Pt()
+            genbosons                = getGenBosons(event)
+            metpx, metpy             = self.recoilTool.CorrectPFMET(metpx,metpy,genbosons['boson_px'][0],genbosons['boson_py'][0],
+                                                                    genbosons['bosonvis_px'][0],genbosons['bosonvis_py'][0],len(jetIds))
+            met_pt, met_phi          = getPtPhi(metpx,metpy)
+            self.out.m_genboson[0]   = genbosons['boson_m'][0]
+            self.out.pt_genboson[0]  = genbosons['boson_pt'][0]
             if self.doZpt:
-              self.out.zptweight[0]  = self.zptTool.getZptWeight(boson.Pt(),boson.M())
+              self.out.zptweight[0]  = self.zptTool.getZptWeight(genbosons['boson_pt'][0],genbosons['boson_m'][0])
           elif self.doZpt:
-            zboson = getZBoson(event)
-            self.out.m_genboson[0]   = zboson.M()
-            self.out.pt_genboson[0]  = zboson.Pt()
-            self.out.zptweight[0]    = self.zptTool.getZptWeight(zboson.Pt(),zboson.M())
+            genbosons                = getGenBosons(event)
+            self.out.m_genboson[0]   = genbosons['zboson_m'][0]
+            self.out.pt_genboson[0]  = genbosons['zboson_pt'][0]
+            self.out.zptweight[0]    = self.zptTool.getZptWeight(genbosons['zboson_pt'][0],genbosons['zboson_m'][0])
           elif self.doTTpt:
-            toppt1, toppt2           = getTTPt(event)
-            self.out.ttptweight[0]   = getTTptWeight(toppt1,toppt2)
+            genbosons                = getGenBosons(event)
+            self.out.ttptweight[0]   = getTTptWeight(genbosons['toppt1'][0],genbosons['toppt2'][0])
           self.out.genweight[0]      = event.genWeight
-          self.out.puweight[0]       = self.puTool.getWeight(event.Pileup_nTrueInt)
+          puweights                  = self.puTool.getWeights(event.Pileup_nTrueInt)
+          self.out.puweight[0]       = puweights[0]
+          self.out.puweight_up[0]    = puweights[1]
+          self.out.puweight_down[0]  = puweights[2]
           self.out.trigweight[0]     = self.eleSFs.getTriggerSF(self.out.pt_1[0], self.out.eta_1[0])
           self.out.idisoweight_1[0]  = self.eleSFs.getIdIsoSF(self.out.pt_1[0],self.out.eta_1[0])
           self.out.idisoweight_2[0]  = self.ltfSFs.getSF(self.out.genPartFlav_2[0],self.out.eta_2[0])
-          self.out.btagweight[0]     = self.btagTool.getWeight(event,jetIds)
+          btagweights                = self.btagTool.getWeightVariations(event,jetIds)
+          self.out.btagweight[0]     = btagweights['medium','central']
+          self.out.btagweight_up[0]  = btagweights['medium','up']
+          self.out.btagweight_down[0] = btagweights['medium','down']
           self.out.weight[0]         = self.out.genweight[0]*self.out.puweight[0]*self.out.trigweight[0]*self.out.idisoweight_1[0]*self.out.idisoweight_2[0]
+        self.timer.lap('weights')
         
         
         # JETS
@@ -395,29 +407,26 @@ class EleTauProducer(Module):
           self.out.bpt_2[0]          = -9.
           self.out.beta_2[0]         = -9.
         
-        self.out.met[0]              = event.MET_pt
-        self.out.metphi[0]           = event.MET_phi
-        self.out.pfmt_1[0]           = sqrt( 2 * self.out.pt_1[0] * self.out.met[0] * ( 1 - cos(deltaPhi(self.out.phi_1[0], self.out.metphi[0])) ) );
-        self.out.pfmt_2[0]           = sqrt( 2 * self.out.pt_2[0] * self.out.met[0] * ( 1 - cos(deltaPhi(self.out.phi_2[0], self.out.metphi[0])) ) );
+        self.out.met[0]              = met_pt
+        self.out.metphi[0]           = met_phi
+        self.out.pfmt_1[0]           = getTransverseMass(self.out.pt_1[0],self.out.phi_1[0],self.out.met[0],self.out.metphi[0])
+        self.out.pfmt_2[0]           = getTransverseMass(self.out.pt_2[0],self.out.phi_2[0],self.out.met[0],self.out.metphi[0])
         
-        self.out.m_vis[0]            = (electron + tau).M()
-        self.out.pt_ll[0]            = (electron + tau).Pt()
-        self.out.dR_ll[0]            = electron.DeltaR(tau)
+        self.out.m_vis[0]            = getPairMass(electron_pt,electron_eta,electron_phi,electron_mass,tau_pt,tau_eta,tau_phi,tau_mass)
+        self.out.pt_ll[0]            = getPairPt(electron_pt,electron_phi,tau_pt,tau_phi)
+        self.out.dR_ll[0]            = deltaR(electron_eta,electron_phi,tau_eta,tau_phi)
         self.out.dphi_ll[0]          = deltaPhi(self.out.phi_1[0], self.out.phi_2[0])
         self.out.deta_ll[0]          = abs(self.out.eta_1[0] - self.out.eta_2[0])
         
         
         # PZETA
-        leg1                         = TVector3(electron.Px(), electron.Py(), 0.)
-        leg2                         = TVector3(tau.Px(), tau.Py(), 0.)
-        zetaAxis                     = TVector3(leg1.Unit() + leg2.Unit()).Unit()
-        pzeta_vis                    = leg1*zetaAxis + leg2*zetaAxis
-        pzeta_miss                   = met.Vect()*zetaAxis
+        pzeta_miss, pzeta_vis        = getPZeta(electron_pt,electron_phi,tau_pt,tau_phi,metpx,metpy)
         self.out.pzetamiss[0]        = pzeta_miss
         self.out.pzetavis[0]         = pzeta_vis
         self.out.dzeta[0]            = pzeta_miss - 0.85*pzeta_vis
         
         
-        self.out.tree.Fill()
+        self.out.fill()
+        self.timer.lap('fill')
         return True
         
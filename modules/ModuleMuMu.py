@@ -4,6 +4,11 @@ from PhysicsTools.NanoAODTools.postprocessing.framework.datamodel import Collect
 from PhysicsTools.NanoAODTools.postprocessing.framework.eventloop import Module
 
 from TreeProducerMuMu import *
+from SelectionTools import *
+from PreselectionTools import getPreselection, projectTotals
+from TimingTools import getStageTimer
+from GenTools import getGenMatches, getGenBosons
+from Kinematics import getPtPhi, getPairMass, getPairPt, getTransverseMass, getPZeta
 from CorrectionTools.MuonSFs import *
 from CorrectionTools.PileupWeightTool import *
 from CorrectionTools.RecoilCorrectionTool import *
@@ -15,7 +20,8 @@ class MuMuProducer(Module):
     def __init__(self, name, dataType, **kwargs):
         
         self.name           = name
-        self.out            = TreeProducerMuMu(name)
+        self.out            = TreeProducerMuMu(name,chunksize=kwargs.get('chunksize',1000),formats=kwargs.get('formats',['root']))
+        self.timer          = getStageTimer(name,['trigger','muons','pairs','jets','vetos','taus','weights','fill'],kwargs.get('timing',False))
         self.isData         = dataType=='data'
         self.year           = kwargs.get('year',        2017 )
         self.tes            = kwargs.get('tes',         1.0  )
@@ -31,20 +37,29 @@ class MuMuProducer(Module):
         self.vlooseIso      = getVLooseTauIso(year)
         self.filter         = getMETFilters(year,self.isData)
         if year==2016:
+          self.triggers     = ['HLT_IsoMu22','HLT_IsoMu22_eta2p1','HLT_IsoTkMu22','HLT_IsoTkMu22_eta2p1']
           self.trigger      = lambda e: e.HLT_IsoMu22 or e.HLT_IsoMu22_eta2p1 or e.HLT_IsoTkMu22 or e.HLT_IsoTkMu22_eta2p1 #or e.HLT_IsoMu19_eta2p1_LooseIsoPFTau20_SingleL1
           self.muon1CutPt   = lambda e: 23
         elif year==2017:
+          self.triggers     = ['HLT_IsoMu24','HLT_IsoMu27']
           self.trigger      = lambda e: e.HLT_IsoMu24 or e.HLT_IsoMu27 #or e.HLT_IsoMu20_eta2p1_LooseChargedIsoPFTau27_eta2p1_CrossL1
           self.muon1CutPt   = lambda e: 25 if e.HLT_IsoMu24 else 28
         else:
+          self.triggers     = ['HLT_IsoMu24','HLT_IsoMu27']
           self.trigger      = lambda e: e.HLT_IsoMu24 or e.HLT_IsoMu27 #or e.HLT_IsoMu20_eta2p1_LooseChargedIsoPFTau27_eta2p1_CrossL1
           self.muon1CutPt   = lambda e: 25
         self.muon2CutPt     = 15
+        self.muonSel        = getMuonSelection(self.muon2CutPt,isocut=0.15) # lower pT cut
+        self.tauSel         = getJetFakeTauSelection(20)
+        self.jetSel         = getJetSelection(20) # 20 for tau -> j fake measurement
+        self.pairSel        = PairSelection('Muon','pfRelIso04_all','Muon','pfRelIso04_all')
+        self.preselection   = getPreselection(self.isData,self.triggers,self.muonSel.formula(nmin=2))
+        self.preselected    = False # cutflow before the trigger filled by fillTotals
         
         if not self.isData:
           self.muSFs        = MuonSFs(year=year)
           self.puTool       = PileupWeightTool(year=year)
-          self.btagTool     = BTagWeightTool('DeepCSV','medium',channel='mutau',year=year)
+          self.btagTool     = BTagWeightTool('DeepCSV','medium',channel='mutau',year=year,sigmas=['up','down'])
           if self.doZpt:
             self.zptTool    = ZptCorrectionTool(year=year)
           if self.doRecoil:
@@ -74,6 +89,7 @@ class MuMuProducer(Module):
     def endJob(self):
         if not self.isData:
           self.btagTool.setDirectory(self.out.outputfile,'btag')
+        self.timer.endJob(self.out)
         self.out.endJob()
         
     def beginFile(self, inputFile, outputFile, inputTree, wrappedOutputTree):
@@ -83,29 +99,38 @@ class MuMuProducer(Module):
     def endFile(self, inputFile, outputFile, inputTree, wrappedOutputTree):        
         pass
         
+    def fillTotals(self, tree, elist=None):
+        """Fill the cutflow before the trigger for all entries of the input tree,
+        if the events are preselected by the PostProcessor (see PreselectionTools)."""
+        projectTotals(tree,self.out.cutflow,self.isData,self.Nocut,self.TotalWeighted,self.TotalWeighted_no0PU,pileup=self.out.pileup,elist=elist)
+        
     def analyze(self, event):
         """process event, return True (go to next module) or False (fail, go to next event)"""
         sys.stdout.flush()
+        self.timer.start()
         
         #####################################
-        self.out.cutflow.Fill(self.Nocut)
-        if self.isData:
-          self.out.cutflow.Fill(self.TotalWeighted, 1.)
-          if event.PV_npvs>0:
-            self.out.cutflow.Fill(self.TotalWeighted_no0PU, 1.)
-          else:
-            return False
-        else:
-          self.out.cutflow.Fill(self.TotalWeighted, event.genWeight)
-          self.out.pileup.Fill(event.Pileup_nTrueInt)
-          if event.Pileup_nTrueInt>0:
-            self.out.cutflow.Fill(self.TotalWeighted_no0PU, event.genWeight)
+        if not self.preselected:
+          self.out.cutflow.Fill(self.Nocut)
+          if self.isData:
+            self.out.cutflow.Fill(self.TotalWeighted, 1.)
+            if event.PV_npvs>0:
+              self.out.cutflow.Fill(self.TotalWeighted_no0PU, 1.)
+            else:
+              return False
           else:
-            return False
+            self.out.cutflow.Fill(self.TotalWeighted, event.genWeight)
+            self.out.pileup.Fill(event.Pileup_nTrueInt)
+            if event.Pileup_nTrueInt>0:
+              self.out.cutflow.Fill(self.TotalWeighted_no0PU, event.genWeight)
+            else:
+              return False
         #####################################
         
         
-        if not self.trigger(event):
+        triggered = self.trigger(event)
+        self.timer.lap('trigger')
+        if not triggered:
             return False
         
         #####################################
@@ -113,15 +138,8 @@ class MuMuProducer(Module):
         #####################################
         
         
-        idx_goodmuons = [ ]
-        for imuon in range(event.nMuon):
-            if event.Muon_pt[imuon] < self.muon2CutPt: continue # lower pT cut
-            if abs(event.Muon_eta[imuon]) > 2.4: continue
-            if abs(event.Muon_dz[imuon]) > 0.2: continue
-            if abs(event.Muon_dxy[imuon]) > 0.045: continue
-            if event.Muon_pfRelIso04_all[imuon] > 0.15: continue
-            if not event.Muon_mediumId[imuon]: continue
-            idx_goodmuons.append(imuon)
+        idx_goodmuons = self.muonSel.indices(event)
+        self.timer.lap('muons')
         
         if len(idx_goodmuons) < 1:
             return False
@@ -139,25 +157,15 @@ class MuMuProducer(Module):
         #####################################
         
         
-        muons = Collection(event, 'Muon')
-        dileptons = [ ]
-        for idx1 in idx_goodmuons:
-          for idx2 in idx_goodmuons:
-              if idx1 >= idx2: continue
-              muon1 = muons[idx1].p4()
-              muon2 = muons[idx2].p4()
-              if muon1.DeltaR(muon2) < 0.5: continue
-              if self.inZmassWindow and not (70<(muon1+muon2).M()<110): continue # Z mass
-              dilepton = DiLeptonBasicClass(idx1, event.Muon_pt[idx1], event.Muon_pfRelIso04_all[idx1], 
-                                            idx2, event.Muon_pt[idx2], event.Muon_pfRelIso04_all[idx2])
-              dileptons.append(dilepton)
-        
-        if len(dileptons)==0:
+        inZmassWindow = (lambda i, j: 70<getPairMass(event.Muon_pt[i],event.Muon_eta[i],event.Muon_phi[i],event.Muon_mass[i],
+                                                     event.Muon_pt[j],event.Muon_eta[j],event.Muon_phi[j],event.Muon_mass[j])<110) if self.inZmassWindow else None
+        dilepton = self.pairSel.best(event,idx_goodmuons,idx_goodmuons,require=inZmassWindow)
+        self.timer.lap('pairs')
+        if dilepton==None:
             return False
         
-        dilepton = bestDiLepton(dileptons)
-        muon1    = muons[dilepton.id1].p4()
-        muon2    = muons[dilepton.id2].p4()
+        muon1_pt, muon1_eta, muon1_phi, muon1_mass = event.Muon_pt[dilepton.id1], event.Muon_eta[dilepton.id1], event.Muon_phi[dilepton.id1], event.Muon_mass[dilepton.id1]
+        muon2_pt, muon2_eta, muon2_phi, muon2_mass = event.Muon_pt[dilepton.id2], event.Muon_eta[dilepton.id2], event.Muon_phi[dilepton.id2], event.Muon_mass[dilepton.id2]
         
         #####################################
         self.out.cutflow.Fill(self.GoodDiLepton)
@@ -167,15 +175,12 @@ class MuMuProducer(Module):
         # JETS
         jetIds  = [ ]
         bjetIds = [ ]
-        jets    = Collection(event, 'Jet')
         nfjets  = 0
         ncjets  = 0
         nbtag   = 0
-        for ijet in range(event.nJet):
-            if event.Jet_pt[ijet] < 20: continue # 20 for tau -> j fake measurement
-            if abs(event.Jet_eta[ijet]) > 4.7: continue
-            if muon1.DeltaR(jets[ijet].p4()) < 0.5: continue
-            if muon2.DeltaR(jets[ijet].p4()) < 0.5: continue
+        for ijet in self.jetSel.indices(event):
+            if deltaR(muon1_eta,muon1_phi,event.Jet_eta[ijet],event.Jet_phi[ijet]) < 0.5: continue
+            if deltaR(muon2_eta,muon2_phi,event.Jet_eta[ijet],event.Jet_phi[ijet]) < 0.5: continue
             jetIds.append(ijet)
             
             if abs(event.Jet_eta[ijet]) > 2.4:
@@ -189,11 +194,13 @@ class MuMuProducer(Module):
         
         if not self.isData and event.Muon_pfRelIso04_all[dilepton.id1]<0.50 and event.Muon_pfRelIso04_all[dilepton.id2]<0.50:
           self.btagTool.fillEfficiencies(event,jetIds)
+        self.timer.lap('jets')
         
         
         # VETOS
         self.out.extramuon_veto[0], self.out.extraelec_veto[0], self.out.dilepton_veto[0] = extraLeptonVetos(event, [dilepton.id1, dilepton.id2], [-1], self.channel)
         self.out.lepton_vetos[0] = self.out.extramuon_veto[0] or self.out.extraelec_veto[0] or self.out.dilepton_veto[0]
+        self.timer.lap('vetos')
         
         
         # EVENT
@@ -244,22 +251,16 @@ class MuMuProducer(Module):
         self.out.dz_2[0]                       = event.Muon_dz[dilepton.id2]         
         self.out.q_2[0]                        = event.Muon_charge[dilepton.id2]
         self.out.pfRelIso04_all_2[0]           = event.Muon_pfRelIso04_all[dilepton.id2]
+        self.timer.lap('fill')
         
         
         # TAU for jet -> tau fake rate measurement
         maxId = -1
         maxPt = 20
-        taus  = Collection(event, 'Tau')
-        for itau in range(event.nTau):
+        for itau in self.tauSel.indices(event):
           if event.Tau_pt[itau] < maxPt: continue
-          if muon1.DeltaR(taus[itau].p4())<0.5: continue
-          if muon2.DeltaR(taus[itau].p4())<0.5: continue
-          if abs(event.Tau_eta[itau])>2.3: continue
-          if abs(event.Tau_dz[itau])>0.2: continue
-          if event.Tau_decayMode[itau] not in [0,1,10,11]: continue
-          if abs(event.Tau_charge[itau])!=1: continue
-          if ord(event.Tau_idAntiEle[itau])<1: continue # VLoose
-          if ord(event.Tau_idAntiMu[itau])<1: continue # Loose
+          if deltaR(muon1_eta,muon1_phi,event.Tau_eta[itau],event.Tau_phi[itau])<0.5: continue
+          if deltaR(muon2_eta,muon2_phi,event.Tau_eta[itau],event.Tau_phi[itau])<0.5: continue
           #if not self.vlooseIso(event,itau): continue
           maxId = itau
           maxPt = event.Tau_pt[itau]
@@ -276,7 +277,7 @@ class MuMuProducer(Module):
           self.out.idMVAnewDM2017v2_3[0]       = ord(event.Tau_idMVAnewDM2017v2[maxId])
           self.out.idIso_3[0]                  = Tau_idIso(event,maxId)
           if not self.isData:
-            self.out.genPartFlav_3[0]          = genmatch(event,maxId) #ord(event.Tau_genPartFlav[maxId])
+            self.out.genPartFlav_3[0]          = getGenMatches(event,[maxId])[0] #ord(event.Tau_genPartFlav[maxId])
         else:
           self.out.pt_3[0]                     = -1
           self.out.eta_3[0]                    = -9
@@ -290,36 +291,46 @@ class MuMuProducer(Module):
           self.out.idMVAnewDM2017v2_3[0]       = -1
           self.out.idIso_3[0]                  = -1
           self.out.genPartFlav_3[0]            = -1
+        self.timer.lap('taus')
         
         
         # WEIGHTS
-        met = TLorentzVector()
-        met.SetPxPyPzE(event.MET_pt*cos(event.MET_phi),event.MET_pt*sin(event.MET_phi),0,event.MET_pt)
+        met_pt  = event.MET_pt # corrected below for recoil, without overwriting the event
+        met_phi = event.MET_phi
+        metpx   = met_pt*cos(met_phi)
+        metpy   = met_pt*sin(met_phi)
         if not self.isData:
           if self.doRecoil:
-            boson, boson_vis        = getBoson(event)
-            self.recoilTool.CorrectTByMeanResolution(met,boson,boson_vis,len(jetIds))
-            event.MET_pt            = met.Pt()
-            event.MET_phi           = met.Phi()
-            self.out.m_genboson[0]  = boson.M()
-            self.out.pt_genboson[0] = boson.Pt()
+            genbosons               = getGenBosons(event)
+            metpx, metpy            = self.recoilTool.CorrectPFMET(metpx,metpy,genbosons['boson_px'][0],genbosons['boson_py'][0],
+                                                                   genbosons['bosonvis_px'][0],genbosons['bosonvis_py'][0],len(jetIds))
+            met_pt, met_phi         = getPtPhi(metpx,metpy)
+            self.out.m_genboson[0]  = genbosons['boson_m'][0]
+            self.out.pt_genboson[0] = genbosons['boson_pt'][0]
             if self.doZpt:
-              self.out.zptweight[0] = self.zptTool.getZptWeight(boson.Pt(),boson.M())
+              self.out.zptweight[0] = self.zptTool.getZptWeight(genbosons['boson_pt'][0],genbosons['boson_m'][0])
           elif self.doZpt:
-            zboson = getZBoson(event)
-            self.out.m_genboson[0]  = zboson.M()
-            self.out.pt_genboson[0] = zboson.Pt()
-            self.out.zptweight[0]   = self.zptTool.getZptWeight(zboson.Pt(),zboson.M())
+            genbosons               = getGenBosons(event)
+            self.out.m_genboson[0]  = genbosons['zboson_m'][0]
+            self.out.pt_genboson[0] = genbosons['zboson_pt'][0]
+            self.out.zptweight[0]   = self.zptTool.getZptWeight(genbosons['zboson_pt'][0],genbosons['zboson_m'][0])
           elif self.doTTpt:
-            toppt1, toppt2          = getTTPt(event)
-            self.out.ttptweight[0]  = getTTptWeight(toppt1,toppt2)
+            genbosons               = getGenBosons(event)
+            self.out.ttptweight[0]  = getTTptWeight(genbosons['toppt1'][0],genbosons['toppt2'][0])
           self.out.genweight[0]     = event.genWeight
-          self.out.puweight[0]      = self.puTool.getWeight(event.Pileup_nTrueInt)
+          puweights                 = self.puTool.getWeights(event.Pileup_nTrueInt)
+          self.out.puweight[0]      = puweights[0]
+          self.out.puweight_up[0]   = puweights[1]
+          self.out.puweight_down[0] = puweights[2]
           self.out.trigweight[0]    = self.muSFs.getTriggerSF(self.out.pt_1[0],self.out.eta_1[0])
           self.out.idisoweight_1[0] = self.muSFs.getIdIsoSF(self.out.pt_1[0],self.out.eta_1[0])
           self.out.idisoweight_2[0] = self.muSFs.getIdIsoSF(self.out.pt_2[0],self.out.eta_2[0])
-          self.out.btagweight[0]    = self.btagTool.getWeight(event,jetIds)
+          btagweights               = self.btagTool.getWeightVariations(event,jetIds)
+          self.out.btagweight[0]    = btagweights['medium','central']
+          self.out.btagweight_up[0] = btagweights['medium','up']
+          self.out.btagweight_down[0] = btagweights['medium','down']
           self.out.weight[0]        = self.out.genweight[0]*self.out.puweight[0]*self.out.trigweight[0]*self.out.idisoweight_1[0]*self.out.idisoweight_2[0]
+        self.timer.lap('weights')
         
         
         # JETS
@@ -365,29 +376,26 @@ class MuMuProducer(Module):
           self.out.bpt_2[0]         = -9.
           self.out.beta_2[0]        = -9.
         
-        self.out.met[0]             = event.MET_pt
-        self.out.metphi[0]          = event.MET_phi
-        self.out.pfmt_1[0]          = sqrt( 2 * self.out.pt_1[0] * event.MET_pt * ( 1 - cos(deltaPhi(self.out.phi_1[0], event.MET_phi))  ));
-        self.out.pfmt_2[0]          = sqrt( 2 * self.out.pt_2[0] * event.MET_pt * ( 1 - cos(deltaPhi(self.out.phi_2[0], event.MET_phi))  ));
+        self.out.met[0]             = met_pt
+        self.out.metphi[0]          = met_phi
+        self.out.pfmt_1[0]          = getTransverseMass(self.out.pt_1[0],self.out.phi_1[0],met_pt,met_phi)
+        self.out.pfmt_2[0]          = getTransverseMass(self.out.pt_2[0],self.out.phi_2[0],met_pt,met_phi)
         
-        self.out.m_vis[0]           = (muon1 + muon2).M()
-        self.out.pt_ll[0]           = (muon1 + muon2).Pt()
-        self.out.dR_ll[0]           = muon1.DeltaR(muon2)
+        self.out.m_vis[0]           = getPairMass(muon1_pt,muon1_eta,muon1_phi,muon1_mass,muon2_pt,muon2_eta,muon2_phi,muon2_mass)
+        self.out.pt_ll[0]           = getPairPt(muon1_pt,muon1_phi,muon2_pt,muon2_phi)
+        self.out.dR_ll[0]           = deltaR(muon1_eta,muon1_phi,muon2_eta,muon2_phi)
         self.out.dphi_ll[0]         = deltaPhi(self.out.phi_1[0], self.out.phi_2[0])
         self.out.deta_ll[0]         = abs(self.out.eta_1[0] - self.out.eta_2[0])
         
         
         # PZETA
-        leg1                        = TVector3(muon1.Px(), muon1.Py(), 0.)
-        leg2                        = TVector3(muon2.Px(), muon2.Py(), 0.)
-        zetaAxis                    = TVector3(leg1.Unit() + leg2.Unit()).Unit()
-        pzeta_vis                   = leg1*zetaAxis + leg2*zetaAxis
-        pzeta_miss                  = met.Vect()*zetaAxis
+        pzeta_miss, pzeta_vis       = getPZeta(muon1_pt,muon1_phi,muon2_pt,muon2_phi,metpx,metpy)
         self.out.pzetamiss[0]       = pzeta_miss
         self.out.pzetavis[0]        = pzeta_vis
         self.out.dzeta[0]           = pzeta_miss - 0.85*pzeta_vis
         
         
-        self.out.tree.Fill() 
+        self.out.fill()
+        self.timer.lap('fill')
         return True
         
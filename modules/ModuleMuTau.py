@@ -1,9 +1,16 @@
 import sys
 import ROOT
+import numpy as num
 from PhysicsTools.NanoAODTools.postprocessing.framework.datamodel import Collection
 from PhysicsTools.NanoAODTools.postprocessing.framework.eventloop import Module
 
 from TreeProducerMuTau import *
+from SelectionTools import *
+from PreselectionTools import getPreselection, projectTotals
+from TimingTools import getStageTimer
+from GenTools import getGenMatches, getGenMatch, getGenBosons
+from BatchTools import fillHist, anyPerEvent, deltaRArray
+from Kinematics import getPtPhi, getPairMass, getPairPt, getTransverseMass, getPZeta
 from CorrectionTools.MuonSFs import *
 from CorrectionTools.PileupWeightTool import *
 from CorrectionTools.LeptonTauFakeSFs import *
@@ -16,43 +23,81 @@ class MuTauProducer(Module):
     def __init__(self, name, dataType, **kwargs):
         
         self.name           = name
-        self.out            = TreeProducerMuTau(name)
+        self.out            = TreeProducerMuTau(name,chunksize=kwargs.get('chunksize',1000),formats=kwargs.get('formats',['root']))
+        self.timer          = getStageTimer(name,['trigger','muons','taus','pairs','vetos','jets','gen','weights','fill'],kwargs.get('timing',False))
         self.isData         = dataType=='data'
         self.year           = kwargs.get('year',     2017 )
         self.tes            = kwargs.get('tes',      1.0  )
         self.ltf            = kwargs.get('ltf',      1.0  )
         self.jtf            = kwargs.get('jtf',      1.0  )
+        self.shiftTaus      = self.tes!=1.0 or self.ltf!=1.0 or self.jtf!=1.0
         self.doZpt          = kwargs.get('doZpt',    'DY' in name )
         self.doRecoil       = kwargs.get('doRecoil', ('DY' in name or re.search(r"W\d?Jets",name)) and self.year>2016)
         self.doTTpt         = kwargs.get('doTTpt',   'TT' in name )
-        self.doTight        = kwargs.get('doTight',  self.tes!=1 or self.ltf!=1 or self.jtf!=1)
+        self.doTight        = kwargs.get('doTight',  self.shiftTaus)
         self.channel        = 'mutau'
         year, channel       = self.year, self.channel
         
         self.vlooseIso      = getVLooseTauIso(year)
         self.filter         = getMETFilters(year,self.isData)
         if year==2016:
-          self.trigger      = lambda e: e.HLT_IsoMu22 or e.HLT_IsoMu22_eta2p1 or e.HLT_IsoTkMu22 or e.HLT_IsoTkMu22_eta2p1 #or e.HLT_IsoMu19_eta2p1_LooseIsoPFTau20_SingleL1
+          self.triggers     = ['HLT_IsoMu22','HLT_IsoMu22_eta2p1','HLT_IsoTkMu22','HLT_IsoTkMu22_eta2p1']
+          self.trigger      = lambda e: e.HLT_IsoMu22 | e.HLT_IsoMu22_eta2p1 | e.HLT_IsoTkMu22 | e.HLT_IsoTkMu22_eta2p1 #| e.HLT_IsoMu19_eta2p1_LooseIsoPFTau20_SingleL1
           self.muonCutPt    = lambda e: 23
         elif year==2017:
-          self.trigger      = lambda e: e.HLT_IsoMu24 or e.HLT_IsoMu27 #or e.HLT_IsoMu20_eta2p1_LooseChargedIsoPFTau27_eta2p1_CrossL1
-          self.muonCutPt    = lambda e: 25 if e.HLT_IsoMu24 else 28
+          self.triggers     = ['HLT_IsoMu24','HLT_IsoMu27']
+          self.trigger      = lambda e: e.HLT_IsoMu24 | e.HLT_IsoMu27 #| e.HLT_IsoMu20_eta2p1_LooseChargedIsoPFTau27_eta2p1_CrossL1
+          self.muonCutPt    = lambda e: num.where(e.HLT_IsoMu24,25,28)
         else:
-          self.trigger      = lambda e: e.HLT_IsoMu24 or e.HLT_IsoMu27 #or e.HLT_IsoMu20_eta2p1_LooseChargedIsoPFTau27_eta2p1_CrossL1
+          self.triggers     = ['HLT_IsoMu24','HLT_IsoMu27']
+          self.trigger      = lambda e: e.HLT_IsoMu24 | e.HLT_IsoMu27 #| e.HLT_IsoMu20_eta2p1_LooseChargedIsoPFTau27_eta2p1_CrossL1
           self.muonCutPt    = lambda e: 25
         self.tauCutPt       = 20
+        self.muonSel        = getMuonSelection(self.muonCutPt)
+        self.tauSel         = getTauSelection(year)
+        self.jetSel         = getJetSelection(30)
+        self.pairSel        = PairSelection('Muon','pfRelIso04_all','Tau','rawMVAoldDM2017v2',LeptonTauPair)
+        looseTauPt          = 0.99*self.tauCutPt/max(1.,self.tes,self.ltf,self.jtf) # before energy scale shifts
+        self.preselection   = getPreselection(self.isData,self.triggers,self.muonSel.formula(pt=23),
+                                              Selection('Tau',self.tauSel.cuts+[('pt','>=',looseTauPt)]).formula())
+        self.preselected    = False # cutflow before the trigger filled by fillTotals
         
         if not self.isData:
           self.muSFs        = MuonSFs(year=year)
           self.puTool       = PileupWeightTool(year=year)
           self.ltfSFs       = LeptonTauFakeSFs('tight','vloose',year=year)
-          self.btagTool     = BTagWeightTool('DeepCSV','medium',channel=channel,year=year)
+          self.btagTool     = BTagWeightTool('DeepCSV','medium',channel=channel,year=year,sigmas=['up','down'])
           if self.doZpt:
             self.zptTool    = ZptCorrectionTool(year=year)
           if self.doRecoil:
             self.recoilTool = RecoilCorrectionTool(year=year)
         self.deepcsv_wp     = BTagWPs('DeepCSV',year=year)
         
+        # input branches for the columnar batch mode (see analyzeBatch)
+        self.batchBranches  = [
+          'run', 'luminosityBlock', 'event', 'PV_npvs', 'PV_npvsGood',
+          'genWeight', 'Pileup_nTrueInt', 'Pileup_nPU', 'LHE_Njets',
+          'MET_pt', 'MET_phi', 'GenMET_pt', 'GenMET_phi',
+          'HLT_IsoMu22', 'HLT_IsoMu22_eta2p1', 'HLT_IsoTkMu22', 'HLT_IsoTkMu22_eta2p1', 'HLT_IsoMu24', 'HLT_IsoMu27',
+          'Flag_goodVertices', 'Flag_HBHENoiseFilter', 'Flag_HBHENoiseIsoFilter', 'Flag_globalSuperTightHalo2016Filter',
+          'Flag_EcalDeadCellTriggerPrimitiveFilter', 'Flag_BadPFMuonFilter', 'Flag_BadChargedCandidateFilter',
+          'Flag_eeBadScFilter', 'Flag_ecalBadCalibFilter', 'Flag_ecalBadCalibFilterV2',
+          'Muon_pt', 'Muon_eta', 'Muon_phi', 'Muon_mass', 'Muon_dxy', 'Muon_dz', 'Muon_charge',
+          'Muon_mediumId', 'Muon_isPFcand', 'Muon_pfRelIso04_all', 'Muon_genPartFlav',
+          'Electron_pt', 'Electron_eta', 'Electron_phi', 'Electron_dxy', 'Electron_dz', 'Electron_charge',
+          'Electron_pfRelIso03_all', 'Electron_convVeto', 'Electron_lostHits',
+          'Electron_mvaFall17V2Iso_WPL', 'Electron_mvaFall17V2Iso_WP90',
+          'Tau_pt', 'Tau_eta', 'Tau_phi', 'Tau_mass', 'Tau_dxy', 'Tau_dz', 'Tau_charge', 'Tau_decayMode',
+          'Tau_leadTkPtOverTauPt', 'Tau_chargedIso', 'Tau_neutralIso', 'Tau_photonsOutsideSignalCone', 'Tau_puCorr',
+          'Tau_rawAntiEle', 'Tau_rawIso', 'Tau_rawMVAoldDM', 'Tau_rawMVAoldDM2017v1', 'Tau_rawMVAoldDM2017v2', 'Tau_rawMVAnewDM2017v2',
+          'Tau_idAntiEle', 'Tau_idAntiMu', 'Tau_idDecayMode', 'Tau_idDecayModeNewDMs',
+          'Tau_idMVAoldDM', 'Tau_idMVAoldDM2017v1', 'Tau_idMVAoldDM2017v2', 'Tau_idMVAnewDM2017v2',
+          'Jet_pt', 'Jet_eta', 'Jet_phi', 'Jet_mass', 'Jet_btagDeepB', 'Jet_partonFlavour',
+          'GenPart_pt', 'GenPart_eta', 'GenPart_phi', 'GenPart_mass', 'GenPart_pdgId', 'GenPart_status',
+          'GenPart_statusFlags', 'GenPart_genPartIdxMother',
+          'GenVisTau_pt', 'GenVisTau_eta', 'GenVisTau_phi', 'GenVisTau_mass', 'GenVisTau_status',
+        ]
+        
         self.Nocut = 0
         self.Trigger = 1
         self.GoodMuons = 2
@@ -76,6 +121,7 @@ class MuTauProducer(Module):
     def endJob(self):
         if not self.isData:
           self.btagTool.setDirectory(self.out.outputfile,'btag')
+        self.timer.endJob(self.out)
         self.out.endJob()
         
     def beginFile(self, inputFile, outputFile, inputTree, wrappedOutputTree):
@@ -85,29 +131,49 @@ class MuTauProducer(Module):
     def endFile(self, inputFile, outputFile, inputTree, wrappedOutputTree):
         pass
         
+    def fillTotals(self, tree, elist=None):
+        """Fill the cutflow before the trigger for all entries of the input tree,
+        if the events are preselected by the PostProcessor (see PreselectionTools)."""
+        projectTotals(tree,self.out.cutflow,self.isData,self.Nocut,self.TotalWeighted,self.TotalWeighted_no0PU,pileup=self.out.pileup,elist=elist)
+        
     def analyze(self, event):
         """process event, return True (go to next module) or False (fail, go to next event)"""
         sys.stdout.flush()
+        shifted = [ ]
+        self.timer.start()
+        try:
+          return self.analyzeEvent(event,shifted)
+        finally:
+          for itau, pt, mass in shifted: # undo energy scale shifts for other modules on this event
+            event.Tau_pt[itau]   = pt
+            event.Tau_mass[itau] = mass
+        
+    def analyzeEvent(self, event, shifted):
+        """Select and fill the event. The tau energy scale shifts are applied in place, and the
+        original values of the shifted taus are appended to the list "shifted"."""
         
         #####################################
-        self.out.cutflow.Fill(self.Nocut)
-        if self.isData:
-          self.out.cutflow.Fill(self.TotalWeighted, 1.)
-          if event.PV_npvs>0:
-            self.out.cutflow.Fill(self.TotalWeighted_no0PU, 1.)
-          else:
-            return False
-        else:
-          self.out.cutflow.Fill(self.TotalWeighted, event.genWeight)
-          self.out.pileup.Fill(event.Pileup_nTrueInt)
-          if event.Pileup_nTrueInt>0:
-            self.out.cutflow.Fill(self.TotalWeighted_no0PU, event.genWeight)
+        if not self.preselected:
+          self.out.cutflow.Fill(self.Nocut)
+          if self.isData:
+            self.out.cutflow.Fill(self.TotalWeighted, 1.)
+            if event.PV_npvs>0:
+              self.out.cutflow.Fill(self.TotalWeighted_no0PU, 1.)
+            else:
+              return False
           else:
-            return False
+            self.out.cutflow.Fill(self.TotalWeighted, event.genWeight)
+            self.out.pileup.Fill(event.Pileup_nTrueInt)
+            if event.Pileup_nTrueInt>0:
+              self.out.cutflow.Fill(self.TotalWeighted_no0PU, event.genWeight)
+            else:
+              return False
         #####################################
         
         
-        if not self.trigger(event):
+        triggered = self.trigger(event)
+        self.timer.lap('trigger')
+        if not triggered:
             return False
         
         #####################################
@@ -115,15 +181,8 @@ class MuTauProducer(Module):
         #####################################
         
         
-        idx_goodmuons = [ ]
-        for imuon in range(event.nMuon):
-            if event.Muon_pt[imuon] < self.muonCutPt(event): continue
-            if abs(event.Muon_eta[imuon]) > 2.4: continue
-            if abs(event.Muon_dz[imuon]) > 0.2: continue
-            if abs(event.Muon_dxy[imuon]) > 0.045: continue
-            if not event.Muon_mediumId[imuon]: continue
-            #if event.Muon_pfRelIso04_all[imuon]>0.50: continue
-            idx_goodmuons.append(imuon)
+        idx_goodmuons = self.muonSel.indices(event)
+        self.timer.lap('muons')
         
         if len(idx_goodmuons)==0:
             return False
@@ -133,16 +192,15 @@ class MuTauProducer(Module):
         #####################################
         
         
-        Tau_genmatch = { } # bug in Tau_genPartFlav
-        idx_goodtaus = [ ]
-        for itau in range(event.nTau):
-            if not self.vlooseIso(event,itau): continue
-            if abs(event.Tau_eta[itau]) > 2.3: continue
-            if abs(event.Tau_dz[itau]) > 0.2: continue
-            if event.Tau_decayMode[itau] not in [0,1,10]: continue
-            if abs(event.Tau_charge[itau])!=1: continue
-            if not self.isData:
-              Tau_genmatch[itau] = genmatch(event,itau,self.out)
+        Tau_genmatch  = { } # bug in Tau_genPartFlav
+        idx_goodtaus  = [ ]
+        idx_loosetaus = self.tauSel.indices(event)
+        shiftTaus     = self.shiftTaus and not self.isData
+        if shiftTaus: # matched before the pT cut only to shift the energy scale; otherwise only the selected tau
+          Tau_genmatch = dict(zip(idx_loosetaus,getGenMatches(event,idx_loosetaus).tolist()))
+        for itau in idx_loosetaus:
+            if shiftTaus:
+              shifted.append((itau,event.Tau_pt[itau],event.Tau_mass[itau]))
               if self.tes!=1.0 and Tau_genmatch[itau]==5:
                 event.Tau_pt[itau]   *= self.tes
                 event.Tau_mass[itau] *= self.tes
@@ -156,6 +214,7 @@ class MuTauProducer(Module):
             ###if ord(event.Tau_idAntiEle[itau])<1: continue
             ###if ord(event.Tau_idAntiMu[itau])<1: continue
             idx_goodtaus.append(itau)
+        self.timer.lap('taus')
         
         if len(idx_goodtaus)==0:
             return False
@@ -165,22 +224,13 @@ class MuTauProducer(Module):
         #####################################
         
         
-        muons = Collection(event, 'Muon')
-        taus  = Collection(event, 'Tau')
-        ltaus = [ ]
-        for idx1 in idx_goodmuons:
-          for idx2 in idx_goodtaus:
-              if taus[idx2].p4().DeltaR(muons[idx1].p4())<0.5: continue
-              ltau = LeptonTauPair(idx1, event.Muon_pt[idx1], event.Muon_pfRelIso04_all[idx1],
-                                   idx2, event.Tau_pt[idx2],  event.Tau_rawMVAoldDM2017v2[idx2])
-              ltaus.append(ltau)
-        
-        if len(ltaus)==0:
+        ltau = self.pairSel.best(event,idx_goodmuons,idx_goodtaus)
+        self.timer.lap('pairs')
+        if ltau==None:
             return False
         
-        ltau = bestDiLepton(ltaus)
-        muon = muons[ltau.id1].p4()
-        tau  = taus[ltau.id2].p4()
+        muon_eta, muon_phi = event.Muon_eta[ltau.id1], event.Muon_phi[ltau.id1]
+        tau_eta,  tau_phi  = event.Tau_eta[ltau.id2],  event.Tau_phi[ltau.id2]
         #print 'chosen tau1 (idx, pt) = ', ltau.id1, ltau.tau1_pt, 'check', muon.Pt()
         #print 'chosen tau2 (idx, pt) = ', ltau.id2, ltau.tau2_pt, 'check', tau.Pt()
         
@@ -192,6 +242,7 @@ class MuTauProducer(Module):
         # VETOS
         self.out.extramuon_veto[0], self.out.extraelec_veto[0], self.out.dilepton_veto[0] = extraLeptonVetos(event, [ltau.id1], [-1], self.channel)
         self.out.lepton_vetos[0] = self.out.extramuon_veto[0] or self.out.extraelec_veto[0] or self.out.dilepton_veto[0]
+        self.timer.lap('vetos')
         if self.doTight and (self.out.lepton_vetos[0] or event.Muon_pfRelIso04_all[ltau.id1]>0.15 or\
                              ord(event.Tau_idAntiMu[ltau.id2])<2 or ord(event.Tau_idAntiEle[ltau.id2])<1):
           return False
@@ -200,15 +251,11 @@ class MuTauProducer(Module):
         # JETS
         jetIds  = [ ]
         bjetIds = [ ]
-        jets    = Collection(event, 'Jet')
         nfjets  = 0
         ncjets  = 0
-        nbtag   = 0
-        for ijet in range(event.nJet):
-            if event.Jet_pt[ijet] < 30: continue
-            if abs(event.Jet_eta[ijet]) > 4.7: continue
-            if muon.DeltaR(jets[ijet].p4()) < 0.5: continue
-            if tau.DeltaR(jets[ijet].p4()) < 0.5: continue
+        for ijet in self.jetSel.indices(event):
+            if deltaR(muon_eta,muon_phi,event.Jet_eta[ijet],event.Jet_phi[ijet]) < 0.5: continue
+            if deltaR(tau_eta,tau_phi,event.Jet_eta[ijet],event.Jet_phi[ijet]) < 0.5: continue
             jetIds.append(ijet)
             
             if abs(event.Jet_eta[ijet]) > 2.4:
@@ -217,10 +264,167 @@ class MuTauProducer(Module):
               ncjets += 1
             
             if event.Jet_btagDeepB[ijet] > self.deepcsv_wp.medium:
-              nbtag += 1
               bjetIds.append(ijet)
+        self.timer.lap('jets')
+        
+        tau_genmatch = -1 if self.isData else getGenMatch(event,ltau.id2)
+        self.timer.lap('gen')
+        
+        self.fillEvent(event,ltau.id1,ltau.id2,tau_genmatch,jetIds,bjetIds,nfjets,ncjets)
+        return True
+        
+    def analyzeBatch(self, batch):
+        """Process a batch of events with vectorized selections, equivalent to calling
+        analyze for each event. Only the selected events are filled one by one."""
+        self.timer.start()
+        nevents = len(batch)
+        passed  = num.ones(nevents,dtype=bool)
+        
+        #####################################
+        fillHist(self.out.cutflow,num.full(nevents,self.Nocut))
+        if self.isData:
+          fillHist(self.out.cutflow,num.full(nevents,self.TotalWeighted))
+          passed &= batch.PV_npvs>0
+          fillHist(self.out.cutflow,num.full(passed.sum(),self.TotalWeighted_no0PU))
+        else:
+          fillHist(self.out.cutflow,num.full(nevents,self.TotalWeighted),batch.genWeight)
+          fillHist(self.out.pileup,batch.Pileup_nTrueInt)
+          passed &= batch.Pileup_nTrueInt>0
+          fillHist(self.out.cutflow,num.full(passed.sum(),self.TotalWeighted_no0PU),batch.genWeight[passed])
+        #####################################
+        
+        
+        passed &= self.trigger(batch)
+        self.timer.lap('trigger')
+        
+        #####################################
+        fillHist(self.out.cutflow,num.full(passed.sum(),self.Trigger))
+        #####################################
         
-        if not self.isData and self.vlooseIso(event,ltau.id2) and event.Muon_pfRelIso04_all[ltau.id1]<0.50:
+        
+        mevt        = batch.eventIndex('Muon')
+        goodmuons   = self.muonSel.mask(batch,passed[mevt])
+        passed     &= anyPerEvent(goodmuons,mevt,nevents)
+        self.timer.lap('muons')
+        
+        #####################################
+        fillHist(self.out.cutflow,num.full(passed.sum(),self.GoodMuons))
+        #####################################
+        
+        
+        tevt        = batch.eventIndex('Tau')
+        goodtaus    = self.tauSel.mask(batch,passed[tevt])
+        Tau_genmatch = num.full(len(tevt),-1,dtype=int) # bug in Tau_genPartFlav
+        if not self.isData and self.shiftTaus:
+          Tau_genmatch[goodtaus] = getGenMatches(batch,num.nonzero(goodtaus)[0])
+          scale = num.ones(len(tevt))
+          scale[goodtaus & (Tau_genmatch==5)] = self.tes
+          scale[goodtaus & (Tau_genmatch>0) & (Tau_genmatch<5)] = self.ltf
+          scale[goodtaus & (Tau_genmatch==0)] = self.jtf
+          Tau_pt, Tau_mass = batch.Tau_pt, batch.Tau_mass # restored at the end for other modules
+          if (scale!=1.0).any(): # the per-event loop writes back into the float branches
+            batch.Tau_pt   = (batch.Tau_pt*scale).astype(num.float32).astype(num.float64)
+            batch.Tau_mass = (batch.Tau_mass*scale).astype(num.float32).astype(num.float64)
+        goodtaus   &= ~(batch.Tau_pt < self.tauCutPt)
+        passed     &= anyPerEvent(goodtaus,tevt,nevents)
+        self.timer.lap('taus')
+        
+        #####################################
+        fillHist(self.out.cutflow,num.full(passed.sum(),self.GoodTaus))
+        #####################################
+        
+        
+        # PAIRS
+        idx_goodmuons = num.nonzero(goodmuons & passed[mevt])[0]
+        idx_goodtaus  = num.nonzero(goodtaus & passed[tevt])[0]
+        imuon, itau   = self.pairSel.candidates(batch,idx_goodmuons,idx_goodtaus)
+        haspair, imuon, itau = self.pairSel.bestIndices(batch,imuon,itau)
+        passed       &= haspair
+        events        = num.nonzero(passed)[0]
+        self.timer.lap('pairs')
+        
+        #####################################
+        fillHist(self.out.cutflow,num.full(passed.sum(),self.GoodDiLepton))
+        #####################################
+        
+        
+        # VETOS
+        extramuon_veto, extraelec_veto, dilepton_veto = extraLeptonVetos(batch,imuon,[ ],self.channel,mask=passed)
+        lepton_vetos = extramuon_veto | extraelec_veto | dilepton_veto
+        if self.doTight:
+          tight = ~(lepton_vetos[events] | (batch.Muon_pfRelIso04_all[imuon]>0.15) |\
+                    (batch.Tau_idAntiMu[itau]<2) | (batch.Tau_idAntiEle[itau]<1))
+          passed[events[~tight]] = False
+          events, imuon, itau = events[tight], imuon[tight], itau[tight]
+        self.timer.lap('vetos')
+        if not self.isData and not self.shiftTaus: # only the selected taus
+          Tau_genmatch[itau] = getGenMatches(batch,itau)
+          self.timer.lap('gen')
+        
+        
+        # JETS
+        jevt        = batch.eventIndex('Jet')
+        muon_eta, muon_phi = num.zeros(nevents), num.zeros(nevents)
+        tau_eta,  tau_phi  = num.zeros(nevents), num.zeros(nevents)
+        muon_eta[events], muon_phi[events] = batch.Muon_eta[imuon], batch.Muon_phi[imuon]
+        tau_eta[events],  tau_phi[events]  = batch.Tau_eta[itau],   batch.Tau_phi[itau]
+        goodjets    = self.jetSel.mask(batch,passed[jevt])
+        goodjets   &= ~(deltaRArray(muon_eta[jevt],muon_phi[jevt],batch.Jet_eta,batch.Jet_phi) < 0.5)
+        goodjets   &= ~(deltaRArray(tau_eta[jevt],tau_phi[jevt],batch.Jet_eta,batch.Jet_phi) < 0.5)
+        goodbjets   = goodjets & (batch.Jet_btagDeepB > self.deepcsv_wp.medium)
+        njets       = num.bincount(jevt[goodjets],minlength=nevents)
+        nfjets      = num.bincount(jevt[goodjets & (abs(batch.Jet_eta) > 2.4)],minlength=nevents)
+        nbjets      = num.bincount(jevt[goodbjets],minlength=nevents)
+        jlocal      = batch.localIndex('Jet')
+        jetIds      = num.split(jlocal[goodjets],num.cumsum(njets)[:-1])
+        bjetIds     = num.split(jlocal[goodbjets],num.cumsum(nbjets)[:-1])
+        self.timer.lap('jets')
+        btagweights = None
+        puweights   = None
+        recoilmet   = None
+        if not self.isData:
+          btagweights = self.btagTool.getWeights(batch,goodjets)
+          effevents   = num.zeros(nevents,dtype=bool) # events with a loosely isolated pair, see fillEvent
+          effevents[events] = ((batch.Tau_idMVAoldDM[itau]>0) | (batch.Tau_idMVAnewDM2017v2[itau]>0) |\
+                               (batch.Tau_idMVAoldDM2017v1[itau]>0) | (batch.Tau_idMVAoldDM2017v2[itau]>0)) &\
+                              (batch.Muon_pfRelIso04_all[imuon]<0.50)
+          self.btagTool.fillEfficienciesBatch(batch,goodjets & effevents[jevt])
+          puweights   = self.puTool.getWeightArrays(batch.Pileup_nTrueInt[events]) # only the selected events
+          if self.doRecoil:
+            genbosons = getGenBosons(batch)
+            met_pt, met_phi = batch.MET_pt[events], batch.MET_phi[events]
+            recoilmet = self.recoilTool.CorrectPFMETArrays(met_pt*num.cos(met_phi),met_pt*num.sin(met_phi),
+                                                           genbosons['boson_px'][events],genbosons['boson_py'][events],
+                                                           genbosons['bosonvis_px'][events],genbosons['bosonvis_py'][events],njets[events])
+        self.timer.lap('weights')
+        
+        
+        # FILL selected events
+        mlocal = batch.localIndex('Muon')
+        tlocal = batch.localIndex('Tau')
+        for i, (ievt, idx1, idx2) in enumerate(zip(events,imuon,itau)):
+          event = batch.event(ievt)
+          self.out.extramuon_veto[0] = extramuon_veto[ievt]
+          self.out.extraelec_veto[0] = extraelec_veto[ievt]
+          self.out.dilepton_veto[0]  = dilepton_veto[ievt]
+          self.out.lepton_vetos[0]   = lepton_vetos[ievt]
+          self.fillEvent(event,int(mlocal[idx1]),int(tlocal[idx2]),int(Tau_genmatch[idx2]),jetIds[ievt].tolist(),bjetIds[ievt].tolist(),
+                         nfjets[ievt],njets[ievt]-nfjets[ievt],
+                         None if self.isData else dict((key,weights[ievt]) for key, weights in btagweights.iteritems()),
+                         None if self.isData else tuple(puweights[i]),
+                         None if recoilmet is None else (float(recoilmet[0][i]),float(recoilmet[1][i])))
+        if not self.isData and self.shiftTaus:
+          batch.Tau_pt, batch.Tau_mass = Tau_pt, Tau_mass
+        self.timer.lap('fill')
+        
+    def fillEvent(self, event, imuon, itau, tau_genmatch, jetIds, bjetIds, nfjets, ncjets, btagweights=None, puweights=None, recoilmet=None):
+        """Fill the output tree for an event with a selected muon-tau pair and jets.
+        The b tag weights are computed, and the b tag efficiencies filled, for the jets,
+        if the weights are not given (see analyzeBatch), as are the pileup weights and the MET recoil correction."""
+        muon_pt, muon_eta, muon_phi, muon_mass = event.Muon_pt[imuon], event.Muon_eta[imuon], event.Muon_phi[imuon], event.Muon_mass[imuon]
+        tau_pt,  tau_eta,  tau_phi,  tau_mass  = event.Tau_pt[itau],   event.Tau_eta[itau],   event.Tau_phi[itau],   event.Tau_mass[itau]
+        
+        if not self.isData and btagweights is None and self.vlooseIso(event,itau) and event.Muon_pfRelIso04_all[imuon]<0.50:
           self.btagTool.fillEfficiencies(event,jetIds)
         
         #eventSum = TLorentzVector()
@@ -259,61 +463,61 @@ class MuTauProducer(Module):
         
         
         # MUON
-        self.out.pt_1[0]                       = event.Muon_pt[ltau.id1]
-        self.out.eta_1[0]                      = event.Muon_eta[ltau.id1]
-        self.out.phi_1[0]                      = event.Muon_phi[ltau.id1]
-        self.out.m_1[0]                        = event.Muon_mass[ltau.id1]
-        self.out.dxy_1[0]                      = event.Muon_dxy[ltau.id1]
-        self.out.dz_1[0]                       = event.Muon_dz[ltau.id1]         
-        self.out.q_1[0]                        = event.Muon_charge[ltau.id1]
-        self.out.pfRelIso04_all_1[0]           = event.Muon_pfRelIso04_all[ltau.id1]
+        self.out.pt_1[0]                       = event.Muon_pt[imuon]
+        self.out.eta_1[0]                      = event.Muon_eta[imuon]
+        self.out.phi_1[0]                      = event.Muon_phi[imuon]
+        self.out.m_1[0]                        = event.Muon_mass[imuon]
+        self.out.dxy_1[0]                      = event.Muon_dxy[imuon]
+        self.out.dz_1[0]                       = event.Muon_dz[imuon]         
+        self.out.q_1[0]                        = event.Muon_charge[imuon]
+        self.out.pfRelIso04_all_1[0]           = event.Muon_pfRelIso04_all[imuon]
         
         
         # TAU
-        self.out.pt_2[0]                       = event.Tau_pt[ltau.id2]
-        self.out.eta_2[0]                      = event.Tau_eta[ltau.id2]
-        self.out.phi_2[0]                      = event.Tau_phi[ltau.id2]
-        self.out.m_2[0]                        = event.Tau_mass[ltau.id2]
-        self.out.dxy_2[0]                      = event.Tau_dxy[ltau.id2]
-        self.out.dz_2[0]                       = event.Tau_dz[ltau.id2]         
-        self.out.leadTkPtOverTauPt_2[0]        = event.Tau_leadTkPtOverTauPt[ltau.id2]
-        self.out.chargedIso_2[0]               = event.Tau_chargedIso[ltau.id2]
-        self.out.neutralIso_2[0]               = event.Tau_neutralIso[ltau.id2]
-        self.out.photonsOutsideSignalCone_2[0] = event.Tau_photonsOutsideSignalCone[ltau.id2]
-        self.out.puCorr_2[0]                   = event.Tau_puCorr[ltau.id2]
-        self.out.rawAntiEle_2[0]               = event.Tau_rawAntiEle[ltau.id2]
-        self.out.q_2[0]                        = event.Tau_charge[ltau.id2]
-        self.out.decayMode_2[0]                = event.Tau_decayMode[ltau.id2]
-        ###self.out.rawAntiEleCat_2[0]            = event.Tau_rawAntiEleCat[ltau.id2]
-        self.out.idAntiEle_2[0]                = ord(event.Tau_idAntiEle[ltau.id2])
-        self.out.idAntiMu_2[0]                 = ord(event.Tau_idAntiMu[ltau.id2])
-        self.out.idDecayMode_2[0]              = event.Tau_idDecayMode[ltau.id2]
-        self.out.idDecayModeNewDMs_2[0]        = event.Tau_idDecayModeNewDMs[ltau.id2]
-        self.out.rawIso_2[0]                   = event.Tau_rawIso[ltau.id2]
-        self.out.rawMVAoldDM_2[0]              = event.Tau_rawMVAoldDM[ltau.id2]
-        self.out.rawMVAoldDM2017v1_2[0]        = event.Tau_rawMVAoldDM2017v1[ltau.id2]
-        self.out.rawMVAoldDM2017v2_2[0]        = event.Tau_rawMVAoldDM2017v2[ltau.id2]
-        self.out.rawMVAnewDM2017v2_2[0]        = event.Tau_rawMVAnewDM2017v2[ltau.id2]
-        self.out.idMVAoldDM_2[0]               = ord(event.Tau_idMVAoldDM[ltau.id2])
-        self.out.idMVAoldDM2017v1_2[0]         = ord(event.Tau_idMVAoldDM2017v1[ltau.id2])
-        self.out.idMVAoldDM2017v2_2[0]         = ord(event.Tau_idMVAoldDM2017v2[ltau.id2])
-        self.out.idMVAnewDM2017v2_2[0]         = ord(event.Tau_idMVAnewDM2017v2[ltau.id2])
-        self.out.idIso_2[0]                    = Tau_idIso(event,ltau.id2)
+        self.out.pt_2[0]                       = event.Tau_pt[itau]
+        self.out.eta_2[0]                      = event.Tau_eta[itau]
+        self.out.phi_2[0]                      = event.Tau_phi[itau]
+        self.out.m_2[0]                        = event.Tau_mass[itau]
+        self.out.dxy_2[0]                      = event.Tau_dxy[itau]
+        self.out.dz_2[0]                       = event.Tau_dz[itau]         
+        self.out.leadTkPtOverTauPt_2[0]        = event.Tau_leadTkPtOverTauPt[itau]
+        self.out.chargedIso_2[0]               = event.Tau_chargedIso[itau]
+        self.out.neutralIso_2[0]               = event.Tau_neutralIso[itau]
+        self.out.photonsOutsideSignalCone_2[0] = event.Tau_photonsOutsideSignalCone[itau]
+        self.out.puCorr_2[0]                   = event.Tau_puCorr[itau]
+        self.out.rawAntiEle_2[0]               = event.Tau_rawAntiEle[itau]
+        self.out.q_2[0]                        = event.Tau_charge[itau]
+        self.out.decayMode_2[0]                = event.Tau_decayMode[itau]
+        ###self.out.rawAntiEleCat_2[0]            = event.Tau_rawAntiEleCat[itau]
+        self.out.idAntiEle_2[0]                = ord(event.Tau_idAntiEle[itau])
+        self.out.idAntiMu_2[0]                 = ord(event.Tau_idAntiMu[itau])
+        self.out.idDecayMode_2[0]              = event.Tau_idDecayMode[itau]
+        self.out.idDecayModeNewDMs_2[0]        = event.Tau_idDecayModeNewDMs[itau]
+        self.out.rawIso_2[0]                   = event.Tau_rawIso[itau]
+        self.out.rawMVAoldDM_2[0]              = event.Tau_rawMVAoldDM[itau]
+        self.out.rawMVAoldDM2017v1_2[0]        = event.Tau_rawMVAoldDM2017v1[itau]
+        self.out.rawMVAoldDM2017v2_2[0]        = event.Tau_rawMVAoldDM2017v2[itau]
+        self.out.rawMVAnewDM2017v2_2[0]        = event.Tau_rawMVAnewDM2017v2[itau]
+        self.out.idMVAoldDM_2[0]               = ord(event.Tau_idMVAoldDM[itau])
+        self.out.idMVAoldDM2017v1_2[0]         = ord(event.Tau_idMVAoldDM2017v1[itau])
+        self.out.idMVAoldDM2017v2_2[0]         = ord(event.Tau_idMVAoldDM2017v2[itau])
+        self.out.idMVAnewDM2017v2_2[0]         = ord(event.Tau_idMVAnewDM2017v2[itau])
+        self.out.idIso_2[0]                    = Tau_idIso(event,itau)
+        self.timer.lap('fill')
         
         
         # GENERATOR
         if not self.isData:
-          self.out.genPartFlav_1[0]  = ord(event.Muon_genPartFlav[ltau.id1])
-          self.out.genPartFlav_2[0]  = Tau_genmatch[ltau.id2] # ord(event.Tau_genPartFlav[ltau.id2])
+          self.out.genPartFlav_1[0]  = ord(event.Muon_genPartFlav[imuon])
+          self.out.genPartFlav_2[0]  = tau_genmatch # ord(event.Tau_genPartFlav[itau])
           
-          genvistau = Collection(event, 'GenVisTau')
           dRmax  = 1000
           gendm  = -1
           genpt  = -1
           geneta = -1
           genphi = -1
           for igvt in range(event.nGenVisTau):
-            dR = genvistau[igvt].p4().DeltaR(tau)
+            dR = deltaR(event.GenVisTau_eta[igvt],event.GenVisTau_phi[igvt],tau_eta,tau_phi)
             if dR < 0.5 and dR < dRmax:
               dRmax  = dR
               gendm  = event.GenVisTau_status[igvt]
@@ -325,36 +529,50 @@ class MuTauProducer(Module):
           self.out.genvistaupt_2[0]  = genpt
           self.out.genvistaueta_2[0] = geneta
           self.out.genvistauphi_2[0] = genphi
+        self.timer.lap('gen')
         
         
         # WEIGHTS
-        met = TLorentzVector()
-        met.SetPxPyPzE(event.MET_pt*cos(event.MET_phi),event.MET_pt*sin(event.MET_phi),0,event.MET_pt)
+        met_pt  = event.MET_pt # corrected below for recoil, without overwriting the event
+        met_phi = event.MET_phi
+        metpx   = met_pt*cos(met_phi)
+        metpy   = met_pt*sin(met_phi)
         if not self.isData:
           if self.doRecoil:
-            boson, boson_vis         = getBoson(event)
-            self.recoilTool.CorrectPFMETByMeanResolution(met,boson,boson_vis,len(jetIds))
-            event.MET_pt             = met.Pt()
-            event.MET_phi            = met.Phi()
-            self.out.m_genboson[0]   = boson.M()
-            self.out.pt_genboson[0]  = boson.Pt()
+            genbosons                = getGenBosons(event)
+            if recoilmet is None:
+              recoilmet              = self.recoilTool.CorrectPFMET(metpx,metpy,genbosons['boson_px'][0],genbosons['boson_py'][0],
+                                                                    genbosons['bosonvis_px'][0],genbosons['bosonvis_py'][0],len(jetIds))
+            metpx, metpy             = recoilmet
+            met_pt, met_phi          = getPtPhi(metpx,metpy)
+            self.out.m_genboson[0]   = genbosons['boson_m'][0]
+            self.out.pt_genboson[0]  = genbosons['boson_pt'][0]
             if self.doZpt:
-              self.out.zptweight[0]  = self.zptTool.getZptWeight(boson.Pt(),boson.M())
+              self.out.zptweight[0]  = self.zptTool.getZptWeight(genbosons['boson_pt'][0],genbosons['boson_m'][0])
           elif self.doZpt:
-            zboson = getZBoson(event)
-            self.out.m_genboson[0]   = zboson.M()
-            self.out.pt_genboson[0]  = zboson.Pt()
-            self.out.zptweight[0]    = self.zptTool.getZptWeight(zboson.Pt(),zboson.M())
+            genbosons                = getGenBosons(event)
+            self.out.m_genboson[0]   = genbosons['zboson_m'][0]
+            self.out.pt_genboson[0]  = genbosons['zboson_pt'][0]
+            self.out.zptweight[0]    = self.zptTool.getZptWeight(genbosons['zboson_pt'][0],genbosons['zboson_m'][0])
           elif self.doTTpt:
-            toppt1, toppt2           = getTTPt(event)
-            self.out.ttptweight[0]   = getTTptWeight(toppt1,toppt2)
+            genbosons                = getGenBosons(event)
+            self.out.ttptweight[0]   = getTTptWeight(genbosons['toppt1'][0],genbosons['toppt2'][0])
           self.out.genweight[0]      = event.genWeight
-          self.out.puweight[0]       = self.puTool.getWeight(event.Pileup_nTrueInt)
+          if puweights is None:
+            puweights = self.puTool.getWeights(event.Pileup_nTrueInt)
+          self.out.puweight[0]       = puweights[0]
+          self.out.puweight_up[0]    = puweights[1]
+          self.out.puweight_down[0]  = puweights[2]
           self.out.trigweight[0]     = self.muSFs.getTriggerSF(self.out.pt_1[0],self.out.eta_1[0])
           self.out.idisoweight_1[0]  = self.muSFs.getIdIsoSF(self.out.pt_1[0],self.out.eta_1[0])
           self.out.idisoweight_2[0]  = self.ltfSFs.getSF(self.out.genPartFlav_2[0],self.out.eta_2[0])
-          self.out.btagweight[0]     = self.btagTool.getWeight(event,jetIds)
+          if btagweights is None:
+            btagweights = self.btagTool.getWeightVariations(event,jetIds)
+          self.out.btagweight[0]     = btagweights['medium','central']
+          self.out.btagweight_up[0]  = btagweights['medium','up']
+          self.out.btagweight_down[0] = btagweights['medium','down']
           self.out.weight[0]         = self.out.genweight[0]*self.out.puweight[0]*self.out.trigweight[0]*self.out.idisoweight_1[0]*self.out.idisoweight_2[0]
+        self.timer.lap('weights')
         
         
         # JETS
@@ -362,7 +580,7 @@ class MuTauProducer(Module):
         self.out.njets50[0]          = len([j for j in jetIds if event.Jet_pt[j]>50])
         self.out.nfjets[0]           = nfjets
         self.out.ncjets[0]           = ncjets
-        self.out.nbtag[0]            = nbtag
+        self.out.nbtag[0]            = len(bjetIds)
         
         if len(jetIds)>0:
           self.out.jpt_1[0]          = event.Jet_pt[jetIds[0]]
@@ -400,29 +618,25 @@ class MuTauProducer(Module):
           self.out.bpt_2[0]          = -9.
           self.out.beta_2[0]         = -9.
         
-        self.out.met[0]              = event.MET_pt
-        self.out.metphi[0]           = event.MET_phi
-        self.out.pfmt_1[0]           = sqrt( 2 * self.out.pt_1[0] * event.MET_pt * ( 1 - cos(deltaPhi(self.out.phi_1[0], event.MET_phi))  ))
-        self.out.pfmt_2[0]           = sqrt( 2 * self.out.pt_2[0] * event.MET_pt * ( 1 - cos(deltaPhi(self.out.phi_2[0], event.MET_phi))  ))
+        self.out.met[0]              = met_pt
+        self.out.metphi[0]           = met_phi
+        self.out.pfmt_1[0]           = getTransverseMass(self.out.pt_1[0],self.out.phi_1[0],met_pt,met_phi)
+        self.out.pfmt_2[0]           = getTransverseMass(self.out.pt_2[0],self.out.phi_2[0],met_pt,met_phi)
         
-        self.out.m_vis[0]            = (muon + tau).M()
-        self.out.pt_ll[0]            = (muon + tau).Pt()
-        self.out.dR_ll[0]            = muon.DeltaR(tau)
+        self.out.m_vis[0]            = getPairMass(muon_pt,muon_eta,muon_phi,muon_mass,tau_pt,tau_eta,tau_phi,tau_mass)
+        self.out.pt_ll[0]            = getPairPt(muon_pt,muon_phi,tau_pt,tau_phi)
+        self.out.dR_ll[0]            = deltaR(muon_eta,muon_phi,tau_eta,tau_phi)
         self.out.dphi_ll[0]          = deltaPhi(self.out.phi_1[0], self.out.phi_2[0])
         self.out.deta_ll[0]          = abs(self.out.eta_1[0] - self.out.eta_2[0])
         
         
         # PZETA
-        leg1                         = TVector3(muon.Px(), muon.Py(), 0.)
-        leg2                         = TVector3(tau.Px(),  tau.Py(),  0.)
-        zetaAxis                     = TVector3(leg1.Unit() + leg2.Unit()).Unit()
-        pzeta_vis                    = leg1*zetaAxis + leg2*zetaAxis
-        pzeta_miss                   = met.Vect()*zetaAxis
+        pzeta_miss, pzeta_vis        = getPZeta(muon_pt,muon_phi,tau_pt,tau_phi,metpx,metpy)
         self.out.pzetamiss[0]        = pzeta_miss
         self.out.pzetavis[0]         = pzeta_vis
         self.out.dzeta[0]            = pzeta_miss - 0.85*pzeta_vis
         
         
-        self.out.tree.Fill()
-        return True
+        self.out.fill()
+        self.timer.lap('fill')
         
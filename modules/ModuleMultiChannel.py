@@ -0,0 +1,35 @@
+from PhysicsTools.NanoAODTools.postprocessing.framework.eventloop import Module
+
+
+class MultiChannelProducer(Module):
+    """Run the producers of several channels or energy scale variations on a single event
+    loop, each writing its own output file. Unlike a chain of modules in the PostProcessor,
+    every producer sees every event, independently of whether the previous producers
+    selected it. Producers must undo any changes they make to the event."""
+        
+    def __init__(self, producers):
+        self.producers = producers
+        
+    def beginJob(self):
+        for producer in self.producers:
+          producer.beginJob()
+        
+    def endJob(self):
+        for producer in self.producers:
+          producer.endJob()
+        
+    def beginFile(self, inputFile, outputFile, inputTree, wrappedOutputTree):
+        for producer in self.producers:
+          producer.beginFile(inputFile,outputFile,inputTree,wrappedOutputTree)
+        
+    def endFile(self, inputFile, outputFile, inputTree, wrappedOutputTree):
+        for producer in self.producers:
+          producer.endFile(inputFile,outputFile,inputTree,wrappedOutputTree)
+        
+    def analyze(self, event):
+        """process event with all producers, return True if any of them selected it"""
+        passed = False
+        for producer in self.producers:
+          passed = producer.analyze(event) or passed
+        return passed
+        
@@ -4,6 +4,11 @@ from PhysicsTools.NanoAODTools.postprocessing.framework.datamodel import Collect
 from PhysicsTools.NanoAODTools.postprocessing.framework.eventloop import Module
 
 from TreeProducerTauTau import *
+from SelectionTools import *
+from PreselectionTools import getPreselection, projectTotals
+from TimingTools import getStageTimer
+from GenTools import getGenMatches, getGenBosons
+from Kinematics import getPtPhi, getPairMass, getPairPt, getTransverseMass, getPZeta
 from CorrectionTools.TauTriggerSFs import *
 from CorrectionTools.PileupWeightTool import *
 from CorrectionTools.LeptonTauFakeSFs import *
@@ -16,7 +21,8 @@ class TauTauProducer(Module):
     def __init__(self, name, dataType, **kwargs):
         
         self.name           = name
-        self.out            = TreeProducerTauTau(name)
+        self.out            = TreeProducerTauTau(name,chunksize=kwargs.get('chunksize',1000),formats=kwargs.get('formats',['root']))
+        self.timer          = getStageTimer(name,['trigger','taus','pairs','vetos','jets','gen','weights','fill'],kwargs.get('timing',False))
         self.isData         = dataType=='data'
         self.year           = kwargs.get('year',     2017 )
         self.tes            = kwargs.get('tes',      1.0  )
@@ -32,26 +38,37 @@ class TauTauProducer(Module):
         self.vlooseIso      = getVLooseTauIso(year)
         if year==2016:
           if self.isData:
+            self.triggers   = ['HLT_DoubleMediumIsoPFTau35_Trk1_eta2p1_Reg','HLT_DoubleMediumCombinedIsoPFTau35_Trk1_eta2p1_Reg']
             self.trigger    = lambda e: e.HLT_DoubleMediumIsoPFTau35_Trk1_eta2p1_Reg \
                               if e.run<280919 else e.HLT_DoubleMediumCombinedIsoPFTau35_Trk1_eta2p1_Reg
           else:
+            self.triggers   = ['HLT_DoubleMediumIsoPFTau35_Trk1_eta2p1_Reg','HLT_DoubleMediumCombinedIsoPFTau35_Trk1_eta2p1_Reg']
             self.trigger    = lambda e: e.HLT_DoubleMediumIsoPFTau35_Trk1_eta2p1_Reg or e.HLT_DoubleMediumCombinedIsoPFTau35_Trk1_eta2p1_Reg
         elif year==2017:
+            self.triggers   = ['HLT_DoubleTightChargedIsoPFTau35_Trk1_TightID_eta2p1_Reg','HLT_DoubleTightChargedIsoPFTau40_Trk1_eta2p1_Reg','HLT_DoubleMediumChargedIsoPFTau40_Trk1_TightID_eta2p1_Reg']
             self.trigger    = lambda e: e.HLT_DoubleTightChargedIsoPFTau35_Trk1_TightID_eta2p1_Reg or e.HLT_DoubleTightChargedIsoPFTau40_Trk1_eta2p1_Reg or e.HLT_DoubleMediumChargedIsoPFTau40_Trk1_TightID_eta2p1_Reg
         else:
           if self.isData:
+            self.triggers   = ['HLT_DoubleTightChargedIsoPFTau35_Trk1_TightID_eta2p1_Reg','HLT_DoubleTightChargedIsoPFTau40_Trk1_eta2p1_Reg','HLT_DoubleMediumChargedIsoPFTau40_Trk1_TightID_eta2p1_Reg','HLT_DoubleMediumChargedIsoPFTauHPS35_Trk1_eta2p1_Reg']
             self.trigger    = lambda e: e.HLT_DoubleTightChargedIsoPFTau35_Trk1_TightID_eta2p1_Reg or e.HLT_DoubleTightChargedIsoPFTau40_Trk1_eta2p1_Reg or e.HLT_DoubleMediumChargedIsoPFTau40_Trk1_TightID_eta2p1_Reg \
                               if e.run<317509 else e.HLT_DoubleMediumChargedIsoPFTauHPS35_Trk1_eta2p1_Reg
           else:
+            self.triggers   = ['HLT_DoubleMediumChargedIsoPFTauHPS35_Trk1_eta2p1_Reg']
             self.trigger    = lambda e: e.HLT_DoubleMediumChargedIsoPFTauHPS35_Trk1_eta2p1_Reg
         self.tauCutPt       = 40
+        self.tauSel         = getTauSelection(year,etacut=2.1)
+        self.jetSel         = getJetSelection(30)
+        self.pairSel        = PairSelection('Tau','rawMVAoldDM','Tau','rawMVAoldDM',DiTauPair)
+        self.preselection   = getPreselection(self.isData,self.triggers,
+                                              Selection('Tau',self.tauSel.cuts+[('pt','>=',self.tauCutPt)]).formula(nmin=2))
+        self.preselected    = False # cutflow before the trigger filled by fillTotals
         
         if not self.isData:
           self.tauSFs       = TauTriggerSFs('tautau','tight',year=year)
           self.tauSFsVT     = TauTriggerSFs('tautau','vtight',year=year)
           self.ltfSFs       = LeptonTauFakeSFs('loose','vloose',year=year)
           self.puTool       = PileupWeightTool(year=year)
-          self.btagTool     = BTagWeightTool('DeepCSV','medium',channel='mutau',year=year)
+          self.btagTool     = BTagWeightTool('DeepCSV','medium',channel='mutau',year=year,sigmas=['up','down'])
           if self.doZpt:
             self.zptTool    = ZptCorrectionTool(year=year)
           if self.doRecoil:
@@ -89,6 +106,7 @@ class TauTauProducer(Module):
     def endJob(self):
         if not self.isData:
           self.btagTool.setDirectory(self.out.outputfile,'btag')
+        self.timer.endJob(self.out)
         self.out.endJob()
         
     def beginFile(self, inputFile, outputFile, inputTree, wrappedOutputTree):
@@ -98,9 +116,15 @@ class TauTauProducer(Module):
     def endFile(self, inputFile, outputFile, inputTree, wrappedOutputTree):        
         pass
         
+    def fillTotals(self, tree, elist=None):
+        """Fill the cutflow before the trigger for all entries of the input tree,
+        if the events are preselected by the PostProcessor (see PreselectionTools)."""
+        projectTotals(tree,self.out.cutflow,self.isData,self.Nocut,self.TotalWeighted,self.TotalWeighted_no0PU,pileup=self.out.pileup,elist=elist)
+        
     def analyze(self, event):
         """process event, return True (go to next module) or False (fail, go to next event)"""
         sys.stdout.flush()
+        self.timer.start()
         
         ##print '-'*80
         ngentauhads = 0
@@ -164,26 +188,29 @@ class TauTauProducer(Module):
         
         
         #####################################
-        self.out.cutflow.Fill(self.Nocut)
-        #if ngentauhads == 2:
-        #   self.out.cutflow.Fill(self.Nocut_GT)
-        if self.isData:
-          self.out.cutflow.Fill(self.TotalWeighted, 1.)
-          if event.PV_npvs>0:
-            self.out.cutflow.Fill(self.TotalWeighted_no0PU, 1.)
-          else:
-            return False
-        else:
-          self.out.cutflow.Fill(self.TotalWeighted, event.genWeight)
-          self.out.pileup.Fill(event.Pileup_nTrueInt)
-          if event.Pileup_nTrueInt>0:
-            self.out.cutflow.Fill(self.TotalWeighted_no0PU, event.genWeight)
+        if not self.preselected:
+          self.out.cutflow.Fill(self.Nocut)
+          #if ngentauhads == 2:
+          #   self.out.cutflow.Fill(self.Nocut_GT)
+          if self.isData:
+            self.out.cutflow.Fill(self.TotalWeighted, 1.)
+            if event.PV_npvs>0:
+              self.out.cutflow.Fill(self.TotalWeighted_no0PU, 1.)
+            else:
+              return False
           else:
-            return False
+            self.out.cutflow.Fill(self.TotalWeighted, event.genWeight)
+            self.out.pileup.Fill(event.Pileup_nTrueInt)
+            if event.Pileup_nTrueInt>0:
+              self.out.cutflow.Fill(self.TotalWeighted_no0PU, event.genWeight)
+            else:
+              return False
         #####################################        
         
         
-        if not self.trigger(event):
+        triggered = self.trigger(event)
+        self.timer.lap('trigger')
+        if not triggered:
             return False
         
         #####################################
@@ -193,21 +220,16 @@ class TauTauProducer(Module):
         #####################################
         
         
-        Tau_genmatch = { } # bug in Tau_genPartFlav
-        idx_goodtaus = [ ]
-        for itau in range(event.nTau):
-            if abs(event.Tau_eta[itau]) > 2.1: continue
-            if abs(event.Tau_dz[itau]) > 0.2: continue
-            if event.Tau_decayMode[itau] not in [0,1,10]: continue
-            if abs(event.Tau_charge[itau])!=1: continue
-            if not self.vlooseIso(event,itau): continue
-            if not self.isData:
-              Tau_genmatch[itau] = genmatch(event,itau)
+        idx_goodtaus  = [ ]
+        idx_loosetaus = self.tauSel.indices(event)
+        for itau in idx_loosetaus:
+            #if not self.isData:
               #if self.tes!=1.0:
               #  event.Tau_pt[itau]   *= self.tes
               #  event.Tau_mass[itau] *= self.tes
             if event.Tau_pt[itau] < self.tauCutPt: continue
             idx_goodtaus.append(itau)
+        self.timer.lap('taus')
         
         if len(idx_goodtaus)<2:
             return False
@@ -219,23 +241,13 @@ class TauTauProducer(Module):
         #####################################
         
         
-        taus = Collection(event, 'Tau')
-        ditaus = [ ]
-        for idx1 in idx_goodtaus:
-          for idx2 in idx_goodtaus:
-              if idx1 >= idx2: continue
-              dR = taus[idx1].p4().DeltaR(taus[idx2].p4())
-              if dR < 0.5: continue
-              ditau = DiTauPair(idx1, event.Tau_pt[idx1], event.Tau_rawMVAoldDM[idx1],
-                                idx2, event.Tau_pt[idx2], event.Tau_rawMVAoldDM[idx2])
-              ditaus.append(ditau)
-        
-        if len(ditaus)==0:
+        ditau = self.pairSel.best(event,idx_goodtaus,idx_goodtaus)
+        self.timer.lap('pairs')
+        if ditau==None:
             return False
         
-        ditau = bestDiLepton(ditaus)
-        tau1  = taus[ditau.id1].p4()
-        tau2  = taus[ditau.id2].p4()
+        tau1_pt, tau1_eta, tau1_phi, tau1_mass = event.Tau_pt[ditau.id1], event.Tau_eta[ditau.id1], event.Tau_phi[ditau.id1], event.Tau_mass[ditau.id1]
+        tau2_pt, tau2_eta, tau2_phi, tau2_mass = event.Tau_pt[ditau.id2], event.Tau_eta[ditau.id2], event.Tau_phi[ditau.id2], event.Tau_mass[ditau.id2]
         #print 'chosen tau1 (idx, pt) = ', ditau.id1, ditau.tau1_pt, 'check', tau1.p4().Pt()
         #print 'chosen tau2 (idx, pt) = ', ditau.id2, ditau.tau2_pt, 'check', tau2.p4().Pt()
         
@@ -249,20 +261,18 @@ class TauTauProducer(Module):
         # VETOS
         self.out.extramuon_veto[0], self.out.extraelec_veto[0], self.out.dilepton_veto[0]  = extraLeptonVetos(event, [-1], [-1], self.name)
         self.out.lepton_vetos[0] = self.out.extramuon_veto[0] or self.out.extraelec_veto[0] or self.out.dilepton_veto[0]
+        self.timer.lap('vetos')
         
         
         jetIds  = [ ]
         bjetIds = [ ]
-        jets    = Collection(event, 'Jet')
         #jets = filter(self.jetSel,jets):
         nfjets  = 0
         ncjets  = 0
         nbtag   = 0
-        for ijet in range(event.nJet):
-            if event.Jet_pt[ijet] < 30: continue
-            if abs(event.Jet_eta[ijet]) > 4.7: continue
-            if tau1.DeltaR(jets[ijet].p4()) < 0.5: continue
-            if tau2.DeltaR(jets[ijet].p4()) < 0.5: continue
+        for ijet in self.jetSel.indices(event):
+            if deltaR(tau1_eta,tau1_phi,event.Jet_eta[ijet],event.Jet_phi[ijet]) < 0.5: continue
+            if deltaR(tau2_eta,tau2_phi,event.Jet_eta[ijet],event.Jet_phi[ijet]) < 0.5: continue
             jetIds.append(ijet)
             
             if abs(event.Jet_eta[ijet]) > 2.4:
@@ -276,6 +286,7 @@ class TauTauProducer(Module):
         
         if not self.isData and self.vlooseIso(event,ditau.id1) and self.vlooseIso(event,ditau.id2):
           self.btagTool.fillEfficiencies(event,jetIds)
+        self.timer.lap('jets')
         
         #eventSum = TLorentzVector()
         #
@@ -385,28 +396,29 @@ class TauTauProducer(Module):
         self.out.idMVAoldDM2017v1_2[0]         = ord(event.Tau_idMVAoldDM2017v1[ditau.id2])
         self.out.idMVAoldDM2017v2_2[0]         = ord(event.Tau_idMVAoldDM2017v2[ditau.id2])
         self.out.idMVAnewDM2017v2_2[0]         = ord(event.Tau_idMVAnewDM2017v2[ditau.id2])
+        self.timer.lap('fill')
         
         
         # GENERATOR
         if not self.isData:
-          self.out.genPartFlav_1[0] = Tau_genmatch[ditau.id1]
-          self.out.genPartFlav_2[0] = Tau_genmatch[ditau.id2]
+          genmatch1, genmatch2      = getGenMatches(event,[ditau.id1,ditau.id2]).tolist() # bug in Tau_genPartFlav
+          self.out.genPartFlav_1[0] = genmatch1
+          self.out.genPartFlav_2[0] = genmatch2
           
-          genvistau = Collection(event, 'GenVisTau')
           dRmax1,  dRmax2  = .5, .5
           gendm1,  gendm2  = -1, -1
           genpt1,  genpt2  = -1, -1
           geneta1, geneta2 = -9, -9
           genphi1, genphi2 = -9, -9
           for igvt in range(event.nGenVisTau):
-            dR = genvistau[igvt].p4().DeltaR(tau1)
+            dR = deltaR(event.GenVisTau_eta[igvt],event.GenVisTau_phi[igvt],tau1_eta,tau1_phi)
             if dR<dRmax1:
               dRmax1  = dR
               gendm1  = event.GenVisTau_status[igvt]
               genpt1  = event.GenVisTau_pt[igvt]
               geneta1 = event.GenVisTau_eta[igvt]
               genphi1 = event.GenVisTau_phi[igvt]
-            dR = genvistau[igvt].p4().DeltaR(tau2)
+            dR = deltaR(event.GenVisTau_eta[igvt],event.GenVisTau_phi[igvt],tau2_eta,tau2_phi)
             if dR<dRmax2:
               dRmax2  = dR
               gendm2  = event.GenVisTau_status[igvt]
@@ -423,29 +435,32 @@ class TauTauProducer(Module):
           self.out.genvistaupt_2[0]  = genpt2
           self.out.genvistaueta_2[0] = geneta2
           self.out.genvistauphi_2[0] = genphi2
+        self.timer.lap('gen')
         
         
         # WEIGHTS
-        met = TLorentzVector()
-        met.SetPxPyPzE(event.MET_pt*cos(event.MET_phi),event.MET_pt*sin(event.MET_phi),0,event.MET_pt)
+        met_pt  = event.MET_pt # corrected below for recoil, without overwriting the event
+        met_phi = event.MET_phi
+        metpx   = met_pt*cos(met_phi)
+        metpy   = met_pt*sin(met_phi)
         if not self.isData:
           if self.doRecoil:
-            boson, boson_vis         = getBoson(event)
-            self.recoilTool.CorrectPFMETByMeanResolution(met,boson,boson_vis,len(jetIds))
-            event.MET_pt             = met.Pt()
-            event.MET_phi            = met.Phi()
-            self.out.m_genboson[0]   = boson.M()
-            self.out.pt_genboson[0]  = boson.Pt()
+            genbosons                = getGenBosons(event)
+            metpx, metpy             = self.recoilTool.CorrectPFMET(metpx,metpy,genbosons['boson_px'][0],genbosons['boson_py'][0],
+                                                                    genbosons['bosonvis_px'][0],genbosons['bosonvis_py'][0],len(jetIds))
+            met_pt, met_phi          = getPtPhi(metpx,metpy)
+            self.out.m_genboson[0]   = genbosons['boson_m'][0]
+            self.out.pt_genboson[0]  = genbosons['boson_pt'][0]
             if self.doZpt:
-              self.out.zptweight[0]  = self.zptTool.getZptWeight(boson.Pt(),boson.M())
+              self.out.zptweight[0]  = self.zptTool.getZptWeight(genbosons['boson_pt'][0],genbosons['boson_m'][0])
           elif self.doZpt:
-            zboson = getZBoson(event)
-            self.out.m_genboson[0]   = zboson.M()
-            self.out.pt_genboson[0]  = zboson.Pt()
-            self.out.zptweight[0]    = self.zptTool.getZptWeight(zboson.Pt(),zboson.M())
+            genbosons                = getGenBosons(event)
+            self.out.m_genboson[0]   = genbosons['zboson_m'][0]
+            self.out.pt_genboson[0]  = genbosons['zboson_pt'][0]
+            self.out.zptweight[0]    = self.zptTool.getZptWeight(genbosons['zboson_pt'][0],genbosons['zboson_m'][0])
           elif self.doTTpt:
-            toppt1, toppt2           = getTTPt(event)
-            self.out.ttptweight[0]   = getTTptWeight(toppt1,toppt2)
+            genbosons                = getGenBosons(event)
+            self.out.ttptweight[0]   = getTTptWeight(genbosons['toppt1'][0],genbosons['toppt2'][0])
           diTauLeg1SF                = self.tauSFs.getTriggerSF(  self.out.pt_1[0],self.out.eta_1[0],self.out.phi_1[0],self.out.decayMode_1[0],self.out.genPartFlav_1[0] )
           diTauLeg2SF                = self.tauSFs.getTriggerSF(  self.out.pt_2[0],self.out.eta_2[0],self.out.phi_2[0],self.out.decayMode_2[0],self.out.genPartFlav_2[0] )
           diTauLeg1SFVT              = self.tauSFsVT.getTriggerSF(self.out.pt_1[0],self.out.eta_1[0],self.out.phi_1[0],self.out.decayMode_1[0],self.out.genPartFlav_1[0] )
@@ -453,11 +468,18 @@ class TauTauProducer(Module):
           self.out.genweight[0]      = event.genWeight
           self.out.trigweight[0]     = diTauLeg1SF*diTauLeg2SF
           self.out.trigweightVT[0]   = diTauLeg1SFVT*diTauLeg2SFVT
-          self.out.puweight[0]       = self.puTool.getWeight(event.Pileup_nTrueInt)
+          puweights                  = self.puTool.getWeights(event.Pileup_nTrueInt)
+          self.out.puweight[0]       = puweights[0]
+          self.out.puweight_up[0]    = puweights[1]
+          self.out.puweight_down[0]  = puweights[2]
           self.out.idisoweight_1[0]  = self.ltfSFs.getSF(self.out.genPartFlav_1[0],self.out.eta_1[0])
           self.out.idisoweight_2[0]  = self.ltfSFs.getSF(self.out.genPartFlav_2[0],self.out.eta_2[0])
-          self.out.btagweight[0]     = self.btagTool.getWeight(event,jetIds)
+          btagweights                = self.btagTool.getWeightVariations(event,jetIds)
+          self.out.btagweight[0]     = btagweights['medium','central']
+          self.out.btagweight_up[0]  = btagweights['medium','up']
+          self.out.btagweight_down[0] = btagweights['medium','down']
           self.out.weight[0]         = self.out.genweight[0]*self.out.puweight[0]*self.out.trigweight[0]*self.out.idisoweight_1[0]*self.out.idisoweight_2[0]
+        self.timer.lap('weights')
         
         
         # JETS
@@ -503,29 +525,26 @@ class TauTauProducer(Module):
           self.out.bpt_2[0]          = -9.
           self.out.beta_2[0]         = -9.
         
-        self.out.met[0]              = event.MET_pt
-        self.out.metphi[0]           = event.MET_phi
-        self.out.pfmt_1[0]           = sqrt( 2 * self.out.pt_1[0] * self.out.met[0] * ( 1 - cos(deltaPhi(self.out.phi_1[0], self.out.metphi[0])) ) );
-        self.out.pfmt_2[0]           = sqrt( 2 * self.out.pt_2[0] * self.out.met[0] * ( 1 - cos(deltaPhi(self.out.phi_2[0], self.out.metphi[0])) ) );
+        self.out.met[0]              = met_pt
+        self.out.metphi[0]           = met_phi
+        self.out.pfmt_1[0]           = getTransverseMass(self.out.pt_1[0],self.out.phi_1[0],self.out.met[0],self.out.metphi[0])
+        self.out.pfmt_2[0]           = getTransverseMass(self.out.pt_2[0],self.out.phi_2[0],self.out.met[0],self.out.metphi[0])
         
-        self.out.m_vis[0]            = (tau1 + tau2).M()
-        self.out.pt_ll[0]            = (tau1 + tau2).Pt()
-        self.out.dR_ll[0]            = tau1.DeltaR(tau2)
+        self.out.m_vis[0]            = getPairMass(tau1_pt,tau1_eta,tau1_phi,tau1_mass,tau2_pt,tau2_eta,tau2_phi,tau2_mass)
+        self.out.pt_ll[0]            = getPairPt(tau1_pt,tau1_phi,tau2_pt,tau2_phi)
+        self.out.dR_ll[0]            = deltaR(tau1_eta,tau1_phi,tau2_eta,tau2_phi)
         self.out.dphi_ll[0]          = deltaPhi(self.out.phi_1[0], self.out.phi_2[0])
         self.out.deta_ll[0]          = abs(self.out.eta_1[0] - self.out.eta_2[0])
         
         
         # PZETA  
-        leg1                         = TVector3(tau1.Px(), tau1.Py(), 0.)
-        leg2                         = TVector3(tau2.Px(), tau2.Py(), 0.)
-        zetaAxis                     = TVector3(leg1.Unit() + leg2.Unit()).Unit()
-        pzeta_vis                    = leg1*zetaAxis + leg2*zetaAxis
-        pzeta_miss                   = met.Vect()*zetaAxis
+        pzeta_miss, pzeta_vis        = getPZeta(tau1_pt,tau1_phi,tau2_pt,tau2_phi,metpx,metpy)
         self.out.pzetamiss[0]        = pzeta_miss
         self.out.pzetavis[0]         = pzeta_vis
         self.out.dzeta[0]            = pzeta_miss - 0.85*pzeta_vis
         
         
-        self.out.tree.Fill() 
+        self.out.fill()
+        self.timer.lap('fill')
         return True
         
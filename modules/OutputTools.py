@@ -0,0 +1,152 @@
+# Tools to write the flat output of the tree producers to columnar file formats beside ROOT,
+# so it can be read directly into numpy or pandas, without converting a ROOT tree.
+import os, shutil, tempfile, zipfile
+from io import BytesIO
+import numpy as num
+
+
+def getHistArrays(hist):
+    """Return the bin contents of a TH1, including underflow and overflow,
+    and the bin edges, as numpy arrays."""
+    nbins    = hist.GetNbinsX()
+    contents = num.array([hist.GetBinContent(i) for i in xrange(nbins+2)],dtype=num.float64)
+    edges    = num.array([hist.GetXaxis().GetBinLowEdge(i) for i in xrange(1,nbins+2)],dtype=num.float64)
+    return contents, edges
+
+
+
+class ColumnWriter(object):
+    """Base class of the columnar output formats. The filled rows are passed in chunks
+    as numpy record arrays, with the same names and types as the branches of the tree.
+    Histograms are stored as arrays of their bin contents and edges,
+    named 'hist_<name>' and 'hist_<name>_edges'."""
+    ext = ""
+
+    def __init__(self, filename):
+        self.filename = os.path.splitext(filename)[0]+self.ext
+        print ">>> %s: writing %s"%(self.__class__.__name__,self.filename)
+
+    def write(self, rows):
+        """Write a chunk of rows."""
+        raise NotImplementedError
+
+    def close(self, hists=[ ]):
+        """Write the histograms, and close the file."""
+        raise NotImplementedError
+
+
+
+class NPZWriter(ColumnWriter):
+    """Write an uncompressed numpy .npz file, with one array per branch. As the number of rows
+    of an .npy array is in its header, the chunks are appended to a temporary raw file per branch
+    next to the output, which are copied into the .npz file at the end, so only one chunk
+    is held in memory."""
+    ext = ".npz"
+
+    def __init__(self, filename):
+        super(NPZWriter,self).__init__(filename)
+        self.tmpdir = tempfile.mkdtemp(prefix=os.path.basename(self.filename)+"_",dir=os.path.dirname(self.filename) or '.')
+        self.dtype  = None
+        self.nrows  = 0
+
+    def write(self, rows):
+        if self.dtype is None:
+          self.dtype = rows.dtype
+        for name in rows.dtype.names:
+          with open(os.path.join(self.tmpdir,name),'ab') as file:
+            num.ascontiguousarray(rows[name]).tofile(file)
+        self.nrows += len(rows)
+
+    def close(self, hists=[ ]):
+        with zipfile.ZipFile(self.filename,'w',zipfile.ZIP_STORED,allowZip64=True) as npz:
+          for name in (self.dtype.names if self.dtype else [ ]):
+            rawname = os.path.join(self.tmpdir,name)
+            npyname = rawname+".npy"
+            with open(npyname,'wb') as npyfile:
+              header = { 'descr': num.lib.format.dtype_to_descr(self.dtype[name]), 'fortran_order': False, 'shape': (self.nrows,) }
+              num.lib.format.write_array_header_1_0(npyfile,header)
+              with open(rawname,'rb') as rawfile:
+                shutil.copyfileobj(rawfile,npyfile)
+            os.remove(rawname)
+            npz.write(npyname,name+".npy")
+            os.remove(npyname)
+          for hist in hists:
+            for name, array in zip(['hist_'+hist.GetName(),'hist_%s_edges'%hist.GetName()],getHistArrays(hist)):
+              npyfile = BytesIO()
+              num.lib.format.write_array(npyfile,array)
+              npz.writestr(name+".npy",npyfile.getvalue())
+        shutil.rmtree(self.tmpdir,ignore_errors=True)
+
+
+
+class HDF5Writer(ColumnWriter):
+    """Append the chunks to resizable datasets in the 'tree' group of an HDF5 file with h5py,
+    one per branch. Histograms are stored as datasets in the top group."""
+    ext = ".h5"
+
+    def __init__(self, filename):
+        import h5py
+        super(HDF5Writer,self).__init__(filename)
+        self.file  = h5py.File(self.filename,'w')
+        self.group = self.file.create_group('tree')
+
+    def write(self, rows):
+        for name in rows.dtype.names:
+          if name not in self.group:
+            self.group.create_dataset(name,shape=(0,),maxshape=(None,),dtype=rows.dtype[name],chunks=True)
+          dataset = self.group[name]
+          nrows   = dataset.shape[0]
+          dataset.resize((nrows+len(rows),))
+          dataset[nrows:] = rows[name]
+
+    def close(self, hists=[ ]):
+        for hist in hists:
+          contents, edges = getHistArrays(hist)
+          self.file.create_dataset('hist_'+hist.GetName(),data=contents)
+          self.file.create_dataset('hist_%s_edges'%hist.GetName(),data=edges)
+        self.file.close()
+
+
+
+class ParquetWriter(ColumnWriter):
+    """Write the chunks as row groups of a Parquet file with pyarrow, one column per branch.
+    As the schema is fixed when opening the file, the histograms are written to a second
+    Parquet file, '<name>_hists.parquet', with one row per bin of each histogram:
+    hist (name), bin (index, with 0 the underflow), xlow (low edge) and content."""
+    ext = ".parquet"
+
+    def __init__(self, filename):
+        import pyarrow
+        super(ParquetWriter,self).__init__(filename)
+        self.writer = None
+
+    def write(self, rows):
+        import pyarrow, pyarrow.parquet
+        table = pyarrow.Table.from_arrays([pyarrow.array(rows[name]) for name in rows.dtype.names],list(rows.dtype.names))
+        if self.writer is None:
+          self.writer = pyarrow.parquet.ParquetWriter(self.filename,table.schema)
+        self.writer.write_table(table)
+
+    def close(self, hists=[ ]):
+        import pyarrow, pyarrow.parquet
+        if self.writer:
+          self.writer.close()
+        names, bins, xlows, contents = [ ], [ ], [ ], [ ]
+        for hist in hists:
+          content, edges = getHistArrays(hist)
+          names.extend([hist.GetName()]*len(content))
+          bins.extend(range(len(content)))
+          xlows.extend([-num.inf]+list(edges))
+          contents.extend(content)
+        table = pyarrow.Table.from_arrays([pyarrow.array(names),pyarrow.array(bins,pyarrow.int32()),
+                                           pyarrow.array(xlows,pyarrow.float64()),pyarrow.array(contents,pyarrow.float64())],
+                                          ['hist','bin','xlow','content'])
+        pyarrow.parquet.write_table(table,self.filename.replace(self.ext,"_hists"+self.ext))
+
+
+
+columnWriters = {
+  'npz':     NPZWriter,
+  'hdf5':    HDF5Writer,
+  'parquet': ParquetWriter,
+}
@@ -0,0 +1,116 @@
+# Tools to preselect events with a cut string, evaluated by ROOT in C++ when the PostProcessor
+# builds its entry list, so most events never reach the python event loop of the producers.
+import re
+import ROOT
+from PhysicsTools.NanoAODTools.postprocessing.framework.eventloop import Module
+from TreeProducerCommon import redirectedBranches
+
+
+def getTriggerCut(triggers):
+    """Return the OR of a list of triggers, or an empty string if any of them is redirected,
+    as it might not exist in the input tree (see checkBranches)."""
+    redirects = dict(redirectedBranches)
+    if any(trigger in redirects for trigger in triggers):
+      return ""
+    return ' || '.join(triggers)
+
+
+def joinCuts(*cuts):
+    """Return the AND of several cut strings, skipping empty ones."""
+    return ' && '.join("(%s)"%(cut) for cut in cuts if cut)
+
+
+def getPreselection(isData, triggers, *formulas):
+    """Return a conservative preselection for a channel: at least one primary vertex (data)
+    or pileup interaction (MC), like the start of analyze, any of the triggers,
+    and the objects of some selections, see Selection.formula."""
+    return joinCuts("PV_npvs>0" if isData else "Pileup_nTrueInt>0",getTriggerCut(triggers),*formulas)
+
+
+def combinePreselections(producers):
+    """Return the OR of the preselections of several producers running on the same
+    event loop, or None if any of them has none."""
+    cuts = [ ]
+    for producer in producers:
+      cut = getattr(producer,'preselection',"")
+      if not cut:
+        return None
+      if cut not in cuts:
+        cuts.append(cut)
+    if len(cuts)==1:
+      return cuts[0]
+    return ' || '.join("(%s)"%(cut) for cut in cuts)
+
+
+def getFormulaBranches(cut):
+    """Return the set of branch names used in a cut string."""
+    return set(re.findall(r"\b([A-Za-z_]\w*)\b(?!\$)",cut))-set(['abs'])
+
+
+def projectHist(tree, hist, varexp, selection="", elist=None):
+    """Fill a histogram from a tree with TTree::Project in C++, adding to its content.
+    Only the entries in the optional entry list are used."""
+    temp = hist.Clone(hist.GetName()+"_project")
+    temp.Reset()
+    temp.SetDirectory(ROOT.gDirectory)
+    if elist:
+      oldlist = tree.GetEntryList()
+      tree.SetEntryList(elist)
+    tree.Project(temp.GetName(),varexp,selection)
+    if elist:
+      tree.SetEntryList(oldlist)
+    hist.Add(temp)
+    temp.SetDirectory(0)
+
+
+def projectTotals(tree, cutflow, isData, nocut, total, total_no0PU, pileup=None, elist=None):
+    """Fill the bins of the cutflow before the trigger for all entries of a tree,
+    in the same way as the start of analyze, and the pileup histogram of MC, if given."""
+    weight = "1" if isData else "genWeight"
+    pucut  = "PV_npvs>0" if isData else "Pileup_nTrueInt>0"
+    projectHist(tree,cutflow,str(nocut),elist=elist)
+    projectHist(tree,cutflow,str(total),weight,elist=elist)
+    projectHist(tree,cutflow,str(total_no0PU),"(%s)*%s"%(pucut,weight),elist=elist)
+    if pileup and not isData:
+      projectHist(tree,pileup,"Pileup_nTrueInt",elist=elist)
+
+
+
+class Preselector(Module):
+    """Wrap the producers of a PostProcessor job running with their combined preselection.
+    As events failing it do not reach the producers, their cutflow before the trigger
+    is filled in a fast separate pass over all events of each input file, passing the JSON
+    for data, instead of in analyze."""
+
+    def __init__(self, module, producers, jsonInput=None):
+        self.module     = module
+        self.producers  = producers
+        self.jsonFilter = None
+        if jsonInput:
+          from PhysicsTools.NanoAODTools.postprocessing.framework.preskimming import JSONFilter
+          self.jsonFilter = JSONFilter(jsonInput)
+        for producer in producers:
+          producer.preselected = True
+
+    def beginJob(self):
+        self.module.beginJob()
+
+    def endJob(self):
+        self.module.endJob()
+
+    def beginFile(self, inputFile, outputFile, inputTree, wrappedOutputTree):
+        tree  = inputFile.Get('Events')
+        elist = None
+        if self.jsonFilter:
+          tree.Draw('>>totals_elist',self.jsonFilter.runCut(),'entrylist')
+          elist = self.jsonFilter.filterEList(tree,ROOT.gDirectory.Get('totals_elist'))
+        for producer in self.producers:
+          producer.fillTotals(tree,elist)
+        self.module.beginFile(inputFile,outputFile,inputTree,wrappedOutputTree)
+
+    def endFile(self, inputFile, outputFile, inputTree, wrappedOutputTree):
+        self.module.endFile(inputFile,outputFile,inputTree,wrappedOutputTree)
+
+    def analyze(self, event):
+        return self.module.analyze(event)
+
@@ -0,0 +1,467 @@
+# Tools to select the objects of a nanoAOD collection with a declared set of cuts,
+# evaluated on all objects of an event, or of a batch of events at once.
+import numpy as num
+from BatchTools import EventBatch, CharArray, pairIndices, firstPerEvent, deltaRArray
+from TreeProducerCommon import DiLeptonBasicClass, redirectedBranches
+
+
+# an object fails a cut (variable, operator, value) in the same way as in
+# "if not variable operator value: continue", also for NaN values
+cutOperators = {
+  '>=': lambda x, v: ~(x <  v),
+  '>':  lambda x, v: ~(x <= v),
+  '<=': lambda x, v: ~(x >  v),
+  '<':  lambda x, v: ~(x >= v),
+  '==': lambda x, v: x == v,
+  '!=': lambda x, v: x != v,
+  'in': lambda x, v: num.in1d(x,v),
+}
+
+# the same cuts on a single value, e.g. of an object of a single event
+valueOperators = {
+  '>=': lambda x, v: not x <  v,
+  '>':  lambda x, v: not x <= v,
+  '<=': lambda x, v: not x >  v,
+  '<':  lambda x, v: not x >= v,
+  '==': lambda x, v: x == v,
+  '!=': lambda x, v: x != v,
+  'in': lambda x, v: x in v,
+}
+
+# the same cuts as a TTreeFormula expression, e.g. for a preselection evaluated by ROOT
+cutFormulas = {
+  '>=': "!(%s<%s)",
+  '>':  "!(%s<=%s)",
+  '<=': "!(%s>%s)",
+  '<':  "!(%s>=%s)",
+  '==': "%s==%s",
+  '!=': "%s!=%s",
+}
+
+
+def getCache(event):
+    """Return a dictionary to cache results for an event, or a batch of events,
+    shared by all modules processing it on the same event loop."""
+    if isinstance(event,EventBatch):
+      return event._cache
+    return event.__dict__.setdefault('_sharedCache',{ })
+
+
+def getObjectArray(event, branch, nobjects):
+    """Get the values of a branch as a numpy array, for a batch or a single event.
+    Characters of UChar_t branches are converted to integers."""
+    values = getattr(event,branch)
+    if isinstance(values,num.ndarray):
+      return values
+    if isinstance(values,CharArray):
+      return values.array
+    values = [values[i] for i in range(nobjects)]
+    if nobjects and isinstance(values[0],str):
+      values = [ord(v) for v in values]
+    return num.array(values)
+
+
+class CachedValues(dict):
+    """Values of a branch of a single event, each read from the tree only when first needed,
+    and shared by all selections on the event (see getCachedValues).
+    Characters of UChar_t branches are converted to integers."""
+
+    def __init__(self, values):
+        self.values = values
+
+    def __missing__(self, i):
+        value   = self.values[i]
+        value   = ord(value) if isinstance(value,str) else value
+        self[i] = value
+        return value
+
+
+def getCachedValues(event, branch, cache=None):
+    """Get the CachedValues of a branch of a single event, from the event's cache (see getCache)."""
+    if cache is None:
+      cache = getCache(event)
+    values = cache.get(branch)
+    if values is None:
+      cache[branch] = values = CachedValues(getattr(event,branch))
+    return values
+
+
+def getObjectValues(event, branch, idxs, dtype=num.float64):
+    """Get the values of a branch for a list of object indices, for a batch or a single event."""
+    values = getattr(event,branch)
+    if isinstance(values,num.ndarray):
+      return values[idxs]
+    return num.array([values[i] for i in idxs],dtype=dtype)
+
+
+def getEventIndex(event, prefix, idxs):
+    """Get the event index of a list of object indices, for a batch or a single event."""
+    if isinstance(event,EventBatch):
+      return event.eventIndex(prefix)[idxs]
+    return num.zeros(len(idxs),dtype=num.int64)
+
+
+def getObjectIndices(event, prefix):
+    """Get the indices of all objects of a collection, for a batch or a single event."""
+    if isinstance(event,EventBatch):
+      return num.arange(len(event.eventIndex(prefix)))
+    return num.arange(getattr(event,'n'+prefix))
+
+
+class Selection(object):
+    """Declared set of cuts on the objects of a nanoAOD collection, e.g.
+      Selection('Muon',[('pt','>=',23),('|eta|','<=',2.4),('mediumId',)])
+    Each cut is a tuple (variable, operator, value). The variable can be wrapped in |...|
+    to take its absolute value, and the value can be a function of the event, e.g. for a
+    trigger-dependent threshold. A cut with only a variable requires it to be nonzero,
+    e.g. an ID flag. A list of cuts passes if any of them passes.
+    Without functions, the result for a single event is cached in the event, and shared
+    with identical selections, e.g. of other channels running on the same event loop."""
+
+    def __init__(self, prefix, cuts):
+        self.prefix = prefix
+        self.cuts   = cuts
+        self.tests  = [self.compile(cut) for cut in cuts] # for single events, see select
+        self.key    = None if any(callable(c[-1]) for c in self.flatten(cuts)) else repr((prefix,cuts))
+
+    def flatten(self, cuts):
+        """Return the list of single cuts."""
+        return [c for cut in cuts for c in (self.flatten(cut) if isinstance(cut,list) else [cut])]
+
+    def branches(self, cuts=None):
+        """Return the list of branches needed by this selection."""
+        branches = [ ]
+        for cut in (self.cuts if cuts==None else cuts):
+          for branch in (self.branches(cut) if isinstance(cut,list) else [self.prefix+'_'+cut[0].strip('|')]):
+            if branch not in branches:
+              branches.append(branch)
+        return branches
+
+    def mask(self, event, mask=None):
+        """Return a boolean array of the objects passing all cuts.
+        For a batch, the array runs over all objects in the batch, otherwise over the objects
+        of the event. Only objects passing an optional mask are considered."""
+        isBatch  = isinstance(event,EventBatch)
+        if not isBatch:
+          passed = num.zeros(getattr(event,'n'+self.prefix),dtype=bool)
+          passed[self.indices(event,mask)] = True
+          return passed
+        nobjects = len(event.eventIndex(self.prefix))
+        passed   = num.ones(nobjects,dtype=bool) if mask is None else num.array(mask,dtype=bool)
+        arrays   = { }
+        for cut in self.cuts:
+          if isinstance(cut,list):
+            passed &= num.any([self.evaluate(event,c,arrays,isBatch,nobjects) for c in cut],axis=0)
+          else:
+            passed &= self.evaluate(event,cut,arrays,isBatch,nobjects)
+        return passed
+
+    def select(self, event, idxs):
+        """Return the indices of the objects of a single event passing all cuts. Each cut is only
+        evaluated on the objects passing the previous ones, like a chain of "continue" cuts.
+        For the few objects of an event, this is faster than numpy, and reads fewer values."""
+        cache = getCache(event)
+        for test in self.tests:
+          if not idxs:
+            break
+          idxs = filter(self.cutFunction(event,test,cache),idxs)
+        return idxs
+
+    def compile(self, cut):
+        """Return a single cut as a tuple (branch, absolute, operator, value), or a list of them."""
+        if isinstance(cut,list):
+          return [self.compile(c) for c in cut]
+        branch = self.prefix+'_'+cut[0].strip('|')
+        if len(cut)==1:
+          return (branch,False,valueOperators['!='],0)
+        return (branch,cut[0][0]=='|',valueOperators[cut[1]],cut[2])
+
+    def cutFunction(self, event, test, cache):
+        """Return a function of the object index evaluating a compiled cut, or a list of cuts, on a single event."""
+        if isinstance(test,list):
+          tests = [self.cutFunction(event,t,cache) for t in test]
+          return lambda i: any(t(i) for t in tests)
+        branch, absolute, operator, value = test
+        values = getCachedValues(event,branch,cache)
+        if callable(value):
+          value = value(event)
+        if absolute:
+          return lambda i: operator(abs(values[i]),value)
+        return lambda i: operator(values[i],value)
+
+    def formula(self, nmin=1, **values):
+        """Return a TTreeFormula expression requiring at least nmin objects passing all cuts,
+        e.g. for a preselection of the PostProcessor. Cuts with a value depending on the event
+        take the value passed by keyword, e.g. pt=23, or are left out, as are cuts on redirected
+        branches, which might not exist in the input tree (see checkBranches)."""
+        cuts = [self.cutFormula(cut,values) for cut in self.cuts]
+        cuts = [c for c in cuts if c]
+        if not cuts:
+          return "n%s>=%d"%(self.prefix,nmin)
+        return "Sum$(%s)>=%d"%(' && '.join(cuts),nmin)
+
+    def cutFormula(self, cut, values):
+        """Return a single cut as a TTreeFormula expression, or an empty string if left out."""
+        if isinstance(cut,list):
+          cuts = [self.cutFormula(c,values) for c in cut]
+          return "" if "" in cuts else "(%s)"%(' || '.join(cuts))
+        variable = cut[0].strip('|')
+        branch   = self.prefix+'_'+variable
+        if branch in dict(redirectedBranches):
+          return ""
+        if cut[0][0]=='|':
+          branch = "abs(%s)"%(branch)
+        if len(cut)==1:
+          return "%s!=0"%(branch)
+        operator, value = cut[1], cut[2]
+        if callable(value):
+          if variable not in values:
+            return ""
+          value = values[variable]
+        if operator=='in':
+          return "(%s)"%(' || '.join("%s==%r"%(branch,v) for v in value))
+        return cutFormulas[operator]%(branch,repr(value))
+
+    def indices(self, event, mask=None):
+        """Return the list of indices of the objects in an event passing all cuts.
+        Without a mask, the result for a single event is cached in the event."""
+        if isinstance(event,EventBatch):
+          return num.nonzero(self.mask(event,mask))[0].tolist()
+        if mask is not None:
+          return self.select(event,num.nonzero(mask)[0].tolist())
+        if not self.key:
+          return self.select(event,range(getattr(event,'n'+self.prefix)))
+        cache = getCache(event)
+        if self.key not in cache:
+          cache[self.key] = self.select(event,range(getattr(event,'n'+self.prefix)))
+        return cache[self.key][:]
+
+    def evaluate(self, event, cut, arrays, isBatch, nobjects):
+        """Evaluate a single cut on all objects of a batch."""
+        variable = cut[0].strip('|')
+        if variable not in arrays:
+          arrays[variable] = getObjectArray(event,self.prefix+'_'+variable,nobjects)
+        values = arrays[variable]
+        if cut[0][0]=='|':
+          values = abs(values)
+        if len(cut)==1:
+          return values != 0
+        operator, value = cut[1], cut[2]
+        if callable(value):
+          value = value(event)
+          if isBatch and num.ndim(value)==1: # one value per event
+            value = value[event.eventIndex(self.prefix)]
+        return cutOperators[operator](values,value)
+    
+
+
+class PairSelection(object):
+    """Selection of the best pair of objects of two collections, separated by DeltaR>=dRmin,
+    for all object combinations of an event, or of a batch of events at once, e.g.
+      PairSelection('Muon','pfRelIso04_all','Tau','rawMVAoldDM2017v2',LeptonTauPair)
+    The best pair has the highest pT of the first, then of the second object, and then the
+    best isolation of both, as ordered by the pair class' __gt__ and isoOrder. In case of a
+    tie, the last pair in the order of the nested loop over both objects is chosen, like
+    bestDiLepton. If both collections are the same, only pairs with idx1<idx2 are built."""
+    
+    def __init__(self, prefix1, iso1, prefix2, iso2, pairclass=DiLeptonBasicClass, dRmin=0.5):
+        self.prefix1   = prefix1
+        self.prefix2   = prefix2
+        self.iso1      = iso1
+        self.iso2      = iso2
+        self.pairclass = pairclass
+        self.dRmin     = dRmin
+        
+    def branches(self):
+        """Return the list of branches needed by this selection."""
+        branches = [ ]
+        for prefix, iso in [(self.prefix1,self.iso1),(self.prefix2,self.iso2)]:
+          for var in ['pt','eta','phi',iso]:
+            if prefix+'_'+var not in branches:
+              branches.append(prefix+'_'+var)
+        return branches
+        
+    def values(self, event, prefix, var, idxs):
+        """Get the values of a branch for a list of object indices."""
+        return getObjectValues(event,prefix+'_'+var,idxs)
+        
+    def candidates(self, event, idxs1, idxs2):
+        """Return the object indices of all pairs separated by DeltaR>=dRmin, in the order
+        of the nested loop "for idx1 in idxs1: for idx2 in idxs2"."""
+        idxs1      = num.asarray(idxs1,dtype=num.int64)
+        idxs2      = num.asarray(idxs2,dtype=num.int64)
+        nevents    = len(event) if isinstance(event,EventBatch) else 1
+        triangular = self.prefix1==self.prefix2
+        pos1, pos2 = pairIndices(getEventIndex(event,self.prefix1,idxs1),
+                                 getEventIndex(event,self.prefix2,idxs2),nevents,triangular=triangular)
+        idxs1      = idxs1[pos1]
+        idxs2      = idxs2[pos2]
+        dR         = deltaRArray(self.values(event,self.prefix2,'eta',idxs2),self.values(event,self.prefix2,'phi',idxs2),
+                                 self.values(event,self.prefix1,'eta',idxs1),self.values(event,self.prefix1,'phi',idxs1))
+        keep       = ~(dR < self.dRmin)
+        return idxs1[keep], idxs2[keep]
+        
+    def bestIndices(self, event, idxs1, idxs2):
+        """Choose the best pair per event among candidate pairs, sorted by event.
+        Return a boolean array of the events with a pair, and the object indices of the
+        best pair in each of those events."""
+        nevents    = len(event) if isinstance(event,EventBatch) else 1
+        events     = getEventIndex(event,self.prefix1,idxs1)
+        isoOrder   = self.pairclass.isoOrder
+        order      = num.lexsort((-num.arange(len(events)),
+                                  isoOrder[1]*self.values(event,self.prefix2,self.iso2,idxs2),
+                                  isoOrder[0]*self.values(event,self.prefix1,self.iso1,idxs1),
+                                  -self.values(event,self.prefix2,'pt',idxs2),
+                                  -self.values(event,self.prefix1,'pt',idxs1), events))
+        haspair, best = firstPerEvent(events[order],nevents)
+        return haspair, idxs1[order[best]], idxs2[order[best]]
+        
+    def best(self, event, idxs1, idxs2, require=None):
+        """Return the best pair of a single event as an instance of the pair class,
+        or None if there is no pair. An additional requirement on the pairs can be
+        passed as a function of the object indices, e.g. for an invariant mass window."""
+        idxs1, idxs2 = self.candidates(event,idxs1,idxs2)
+        if require:
+          keep = num.array([require(i,j) for i, j in zip(idxs1.tolist(),idxs2.tolist())],dtype=bool)
+          idxs1, idxs2 = idxs1[keep], idxs2[keep]
+        haspair, best1, best2 = self.bestIndices(event,idxs1,idxs2)
+        if not haspair[0]:
+          return None
+        idx1, idx2 = int(best1[0]), int(best2[0])
+        return self.pairclass(idx1, getattr(event,self.prefix1+'_pt')[idx1], getattr(event,self.prefix1+'_'+self.iso1)[idx1],
+                              idx2, getattr(event,self.prefix2+'_pt')[idx2], getattr(event,self.prefix2+'_'+self.iso2)[idx2])
+    
+
+
+def getMuonSelection(ptcut, isocut=None):
+    """Return the selection of good muons, with an optional pfRelIso04_all cut."""
+    cuts = [
+      ('pt',       '>=', ptcut ),
+      ('|eta|',    '<=', 2.4   ),
+      ('|dz|',     '<=', 0.2   ),
+      ('|dxy|',    '<=', 0.045 ),
+    ]
+    if isocut!=None:
+      cuts.append(('pfRelIso04_all', '<=', isocut))
+    cuts.append(('mediumId',))
+    return Selection('Muon',cuts)
+
+def getElectronSelection(ptcut, mvaWP=None):
+    """Return the selection of good electrons, with an optional MVA ID working point, e.g. 'WP80'."""
+    cuts = [
+      ('pt',       '>=', ptcut ),
+      ('|eta|',    '<=', 2.1   ),
+      ('|dz|',     '<=', 0.2   ),
+      ('|dxy|',    '<=', 0.045 ),
+      ('convVeto', '==', 1     ),
+      ('lostHits', '<=', 1     ),
+    ]
+    if mvaWP:
+      cuts.append(('mvaFall17V2Iso_'+mvaWP, '>=', 0.5))
+    return Selection('Electron',cuts)
+
+def getTauSelection(year, etacut=2.3):
+    """Return the selection of loose taus, passing the VLoose working point of any
+    available tau ID. The pT cut is left out, as it is applied after energy scale shifts."""
+    cuts = [
+      [ ('idMVAoldDM',       '>', 0), ('idMVAnewDM2017v2', '>', 0),
+        ('idMVAoldDM2017v1', '>', 0), ('idMVAoldDM2017v2', '>', 0) ], # see getVLooseTauIso
+      ('|eta|',     '<=', etacut    ),
+      ('|dz|',      '<=', 0.2       ),
+      ('decayMode', 'in', [0,1,10]  ),
+      ('|charge|',  '==', 1         ),
+    ]
+    return Selection('Tau',cuts)
+
+def getJetFakeTauSelection(ptcut=20):
+    """Return the selection of taus for the jet -> tau fake rate measurement,
+    passing the loosest anti-lepton discriminators, but no isolation."""
+    cuts = [
+      ('pt',        '>=', ptcut         ),
+      ('|eta|',     '<=', 2.3           ),
+      ('|dz|',      '<=', 0.2           ),
+      ('decayMode', 'in', [0,1,10,11]   ),
+      ('|charge|',  '==', 1             ),
+      ('idAntiEle', '>=', 1             ), # VLoose
+      ('idAntiMu',  '>=', 1             ), # Loose
+    ]
+    return Selection('Tau',cuts)
+
+def getJetSelection(ptcut):
+    """Return the selection of jets before lepton cleaning."""
+    cuts = [
+      ('pt',       '>=', ptcut ),
+      ('|eta|',    '<=', 4.7   ),
+    ]
+    return Selection('Jet',cuts)
+
+    
+
+
+# loose leptons for the extra lepton and dilepton vetos, and the extra cuts on top of them
+vetoMuonSel = Selection('Muon',[
+  ('pt',             '>=', 10    ),
+  ('|eta|',          '<=', 2.4   ),
+  ('|dz|',           '<=', 0.2   ),
+  ('|dxy|',          '<=', 0.045 ),
+  ('pfRelIso04_all', '<=', 0.3   ),
+])
+vetoElectronSel = Selection('Electron',[
+  ('pt',             '>=', 10    ),
+  ('|eta|',          '<=', 2.5   ),
+  ('|dz|',           '<=', 0.2   ),
+  ('|dxy|',          '<=', 0.045 ),
+  ('pfRelIso03_all', '<=', 0.3   ),
+])
+extraMuonSel     = Selection('Muon',[('mediumId','>',0.5)])
+extraElectronSel = Selection('Electron',[('convVeto','==',1),('lostHits','<=',1),('mvaFall17V2Iso_WP90','>',0.5)])
+diMuonSel        = Selection('Muon',[('pt','>',15),('isPFcand',)])
+diElectronSel    = Selection('Electron',[('pt','>',15),('mvaFall17V2Iso_WPL','>',0.5)])
+
+def extraLeptonVetos(event, muon_idxs, electron_idxs, channel, mask=None):
+    """Check for extra muons and electrons besides the selected ones, and, for mutau and
+    eletau, for an opposite-sign pair of loose muons or electrons, respectively. For a single
+    event, return three booleans. For a batch, return a boolean array per veto, given the flat
+    indices of the selected muons and electrons, and only considering events passing an
+    optional mask. Indices of -1 are ignored. The loose lepton masks of a single event are
+    cached, and shared with other channels running on the same event loop."""
+    isBatch    = isinstance(event,EventBatch)
+    nevents    = len(event) if isBatch else 1
+    muons      = vetoMuonSel.mask(event,None if mask is None else mask[event.eventIndex('Muon')])
+    electrons  = vetoElectronSel.mask(event,None if mask is None else mask[event.eventIndex('Electron')])
+    extramuons = extraMuonSel.mask(event,muons)
+    extraelecs = extraElectronSel.mask(event,electrons)
+    for extras, idxs in [(extramuons,muon_idxs),(extraelecs,electron_idxs)]:
+      idxs = num.asarray(idxs,dtype=num.int64)
+      extras[idxs[idxs>=0]] = False
+    extramuon_veto = num.zeros(nevents,dtype=bool)
+    extraelec_veto = num.zeros(nevents,dtype=bool)
+    extramuon_veto[getEventIndex(event,'Muon',num.nonzero(extramuons)[0])] = True
+    extraelec_veto[getEventIndex(event,'Electron',num.nonzero(extraelecs)[0])] = True
+    dilepton_veto  = num.zeros(nevents,dtype=bool)
+    if channel=='mutau':
+      dilepton_veto = hasOppositeSignPair(event,'Muon',diMuonSel.mask(event,muons))
+    elif channel=='eletau':
+      dilepton_veto = hasOppositeSignPair(event,'Electron',diElectronSel.mask(event,electrons))
+    if not isBatch:
+      return bool(extramuon_veto[0]), bool(extraelec_veto[0]), bool(dilepton_veto[0])
+    return extramuon_veto, extraelec_veto, dilepton_veto
+
+def hasOppositeSignPair(event, prefix, mask, dRmin=0.15):
+    """Check per event if there is an opposite-sign pair of objects passing a mask,
+    separated by DeltaR>dRmin, for a batch, or a single event. Only pairs of a positive
+    and a negative object are built, so events without both charges build no pairs."""
+    nevents    = len(event) if isinstance(event,EventBatch) else 1
+    index      = num.nonzero(mask)[0]
+    charge     = getObjectValues(event,prefix+'_charge',index)
+    pos, neg   = index[charge>0], index[charge<0]
+    if len(pos)==0 or len(neg)==0:
+      return num.zeros(nevents,dtype=bool)
+    idx1, idx2 = pairIndices(getEventIndex(event,prefix,pos),getEventIndex(event,prefix,neg),nevents)
+    idx1, idx2 = pos[idx1], neg[idx2]
+    dR         = deltaRArray(getObjectValues(event,prefix+'_eta',idx1),getObjectValues(event,prefix+'_phi',idx1),
+                             getObjectValues(event,prefix+'_eta',idx2),getObjectValues(event,prefix+'_phi',idx2))
+    pairs      = getEventIndex(event,prefix,idx1[dR>dRmin])
+    passed     = num.zeros(nevents,dtype=bool)
+    passed[pairs] = True
+    return passed
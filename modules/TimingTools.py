@@ -0,0 +1,86 @@
+# Tools to time the stages of the producers' analyze methods (trigger, object selections,
+# gen matching, weights, filling, ...), to tell what dominates the processing time of a job.
+import time
+from ROOT import TH1D
+
+
+class StageTimer(object):
+    """Accumulate the time spent in each stage of a producer. Call start at the beginning of
+    analyze, and lap at the end of each stage, which adds the time since the previous call to
+    the stage. A stage can be lapped several times per event, e.g. for the filling of the
+    tree around the weights. The calls count the events, or batches, in which a stage ran,
+    so if a selection fails, the calls of the later stages show how many events got there."""
+
+    def __init__(self, name, stages):
+        self.name    = name
+        self.stages  = stages
+        self.index   = dict((stage,i) for i, stage in enumerate(stages))
+        self.times   = [0.]*len(stages)
+        self.calls   = [0]*len(stages)
+        self.counted = [-1]*len(stages) # last event counted per stage
+        self.nstarts = 0
+        self.last    = 0.
+        self.first   = None
+
+    def start(self):
+        """Start timing a new event, or batch of events."""
+        self.nstarts += 1
+        self.last     = time.time()
+        if self.first is None:
+          self.first  = self.last
+
+    def lap(self, stage):
+        """Add the time since the previous start or lap to a stage."""
+        now = time.time()
+        i   = self.index[stage]
+        self.times[i] += now-self.last
+        if self.counted[i]!=self.nstarts:
+          self.counted[i] = self.nstarts
+          self.calls[i]  += 1
+        self.last = now
+
+    def endJob(self, out):
+        """Write the cumulative time (in seconds) and calls per stage to the histograms
+        "timing" and "timing_calls" next to the cutflow of a tree producer, and print a summary."""
+        out.outputfile.cd()
+        nstages = len(self.stages)
+        timing  = TH1D('timing',       'timing',       nstages, 0, nstages)
+        calls   = TH1D('timing_calls', 'timing_calls', nstages, 0, nstages)
+        for i, stage in enumerate(self.stages):
+          for hist, value in [(timing,self.times[i]),(calls,self.calls[i])]:
+            hist.GetXaxis().SetBinLabel(i+1,stage)
+            hist.SetBinContent(i+1,value)
+        out.timing = [timing,calls]
+        self.printSummary()
+
+    def printSummary(self):
+        """Print the time per stage, and its fraction of the time from the first start to the
+        last lap; the rest is spent outside analyze, e.g. reading the input and other modules."""
+        total   = sum(self.times)
+        elapsed = self.last-self.first if self.first is not None else 0.
+        print ">>> Timing of %s: %.2f s in %d stages, %.2f s since the first event"%(self.name,total,len(self.stages),elapsed)
+        print ">>> %10s %10s %12s %14s %9s"%('stage','calls','total [s]','per call [ms]','fraction')
+        for stage, time_, calls in zip(self.stages,self.times,self.calls):
+          print ">>> %10s %10d %12.3f %14.4f %8.1f%%"%(stage,calls,time_,1000.*time_/calls if calls else 0.,100.*time_/elapsed if elapsed>0 else 0.)
+        print ">>> %10s %10s %12.3f %14s %8.1f%%"%('other','',elapsed-total,'',100.*(elapsed-total)/elapsed if elapsed>0 else 0.)
+
+
+
+class NoTimer(object):
+    """Stand-in for StageTimer if timing is not enabled, doing nothing."""
+
+    def start(self):
+        pass
+
+    def lap(self, stage):
+        pass
+
+    def endJob(self, out):
+        pass
+
+
+
+def getStageTimer(name, stages, enabled=True):
+    """Return a StageTimer for the stages of a producer, or a NoTimer if not enabled."""
+    return StageTimer(name,stages) if enabled else NoTimer()
+
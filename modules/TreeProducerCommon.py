@@ -5,19 +5,22 @@ import ROOT
 from ROOT import TTree, TH1D, TH2D, TLorentzVector, TVector3
 from CorrectionTools.RecoilCorrectionTool import hasBit
 from PhysicsTools.NanoAODTools.postprocessing.framework.datamodel import Collection, Event
+from OutputTools import columnWriters
+from Kinematics import deltaR, deltaPhi
 
 
+redirectedBranches = [
+  ('Electron_mvaFall17V2Iso',      'Electron_mvaFall17Iso'     ),
+  ('Electron_mvaFall17V2Iso_WPL',  'Electron_mvaFall17Iso_WPL' ),
+  ('Electron_mvaFall17V2Iso_WP80', 'Electron_mvaFall17Iso_WP80'),
+  ('Electron_mvaFall17V2Iso_WP90', 'Electron_mvaFall17Iso_WP90'),
+  ('HLT_Ele32_WPTight_Gsf',        False                       ),
+]
+
 def checkBranches(tree):
   """Redirect some branch names in case they are not available in some samples or nanoAOD version."""
-  branches = [
-    ('Electron_mvaFall17V2Iso',      'Electron_mvaFall17Iso'     ),
-    ('Electron_mvaFall17V2Iso_WPL',  'Electron_mvaFall17Iso_WPL' ),
-    ('Electron_mvaFall17V2Iso_WP80', 'Electron_mvaFall17Iso_WP80'),
-    ('Electron_mvaFall17V2Iso_WP90', 'Electron_mvaFall17Iso_WP90'),
-    ('HLT_Ele32_WPTight_Gsf',        False                       ),
-  ]
   fullbranchlist = tree.GetListOfBranches()
-  for newbranch, oldbranch in branches:
+  for newbranch, oldbranch in redirectedBranches:
     if newbranch not in fullbranchlist:
       if isinstance(oldbranch,str):
         print "checkBranches: directing '%s' -> '%s'"%(newbranch,oldbranch)
@@ -40,6 +43,11 @@ def setBranchStatuses(tree,otherbranches=[ ]):
    tree.SetBranchStatus(branchname,1)
   
 
+tauIDBranches = [ # read by getVLooseTauIso and Tau_idIso
+  'Tau_pt', 'Tau_idMVAoldDM', 'Tau_idMVAnewDM2017v2', 'Tau_idMVAoldDM2017v1', 'Tau_idMVAoldDM2017v2',
+  'Tau_rawIso', 'Tau_photonsOutsideSignalCone',
+]
+
 def getVLooseTauIso(year):
   """Return a method to check whether event passes the VLoose working
   point of all available tau IDs. (For tau ID measurement.)"""
@@ -76,20 +84,39 @@ root_dtype = {
 num_dtype = {
   'D':   'f',  'I': 'i',  'O':  '?',  'b': 'b'
 }
+column_dtype = { # numpy type of the ROOT type, to write buffered columns
+  'D':   num.float64, 'I': num.int32, 'O': num.bool_, 'b': num.uint8
+}
 
 class TreeProducerCommon(object):
     
-    def __init__(self, name):
+    def __init__(self, name, chunksize=1000, formats=['root']):
         
         print 'TreeProducerCommon is called', name
         
         # TREE
         self.outputfile = ROOT.TFile(name, 'RECREATE')
         self.tree = TTree('tree','tree')
+        self.chunksize = chunksize # number of rows buffered before writing them to the tree
+        self.branches  = [ ]       # names and ROOT types of all branches
+        self.row       = None      # record of the current values of all branches
+        self.buffer    = None      # column buffers of the filled rows
+        self.nbuffered = 0
+        
+        # OTHER OUTPUT FORMATS
+        self.fillTree = 'root' in formats # write the tree to the ROOT file
+        self.writers  = [ ]               # columnar writers, see OutputTools
+        for format in formats:
+          if format=='root': continue
+          if format not in columnWriters:
+            print "ERROR! TreeProducerCommon.__init__: Unknown output format '%s'! Choose from %s"%(format,', '.join(['root']+sorted(columnWriters)))
+            exit(1)
+          self.writers.append(columnWriters[format](name))
         
         # HISTOGRAM
         self.cutflow = TH1D('cutflow', 'cutflow',  25, 0,  25)
         self.pileup  = TH1D('pileup',  'pileup',  100, 0, 100)
+        self.timing  = [ ] # histograms of the time per stage, if enabled (see TimingTools)
         
         ## CHECK genPartFlav
         #self.flags_LTF_DM1 = TH1D('flags_LTF_DM1', "flags for l #rightarrow #tau_{h}, DM1", 18, 0, 18)
@@ -145,11 +172,15 @@ class TreeProducerCommon(object):
         self.addBranch('weight',                  float)
         self.addBranch('trigweight',              float)
         self.addBranch('puweight',                float)
+        self.addBranch('puweight_up',             float)
+        self.addBranch('puweight_down',           float)
         self.addBranch('zptweight',               float)
         self.addBranch('ttptweight',              float)
         self.addBranch('idisoweight_1',           float)
         self.addBranch('idisoweight_2',           float)
         self.addBranch('btagweight',              float)
+        self.addBranch('btagweight_up',           float)
+        self.addBranch('btagweight_down',         float)
         
         
         ############
@@ -236,9 +267,13 @@ class TreeProducerCommon(object):
         self.genweight[0]     = 1.
         self.trigweight[0]    = 1.
         self.puweight[0]      = 1.
+        self.puweight_up[0]   = 1.
+        self.puweight_down[0] = 1.
         self.idisoweight_1[0] = 1.
         self.idisoweight_2[0] = 1.
         self.btagweight[0]    = 1.
+        self.btagweight_up[0] = 1.
+        self.btagweight_down[0] = 1.
         self.zptweight[0]     = 1.
         self.ttptweight[0]    = 1.
         self.genmet[0]        = -1
@@ -252,16 +287,80 @@ class TreeProducerCommon(object):
         if hasattr(self,name):
           print "ERROR! TreeProducerCommon.addBranch: Branch of name '%s' already exists!"%(name)
           exit(1)
+        if self.row is not None:
+          print "ERROR! TreeProducerCommon.addBranch: Cannot add branch '%s' after filling!"%(name)
+          exit(1)
         setattr(self,name,num.zeros(1,dtype=dtype))
         self.tree.Branch(name, getattr(self,name), '%s/%s'%(name,root_dtype[dtype]))
+        self.branches.append((name,root_dtype[dtype]))
+        
+    def initBuffers(self):
+        """Gather the arrays of all branches into a single record, and allocate the column buffers.
+        The arrays are replaced by views of the record, so setting e.g. self.pt_1[0] sets the record."""
+        dtype    = num.dtype([(name,getattr(self,name).dtype) for name, rtype in self.branches])
+        self.row = num.zeros(1,dtype=dtype)
+        for name, rtype in self.branches:
+          self.row[name] = getattr(self,name)
+          setattr(self,name,self.row[name])
+          self.tree.SetBranchAddress(name,getattr(self,name))
+        self.buffer = num.zeros(max(1,self.chunksize),dtype=dtype)
+        
+    def fill(self):
+        """Fill the current values of all branches. They are copied into the column buffers,
+        which are written to the tree in bulk when full, and at the end of the job.
+        Without buffering (chunksize<=1) or other output formats, the tree is filled directly."""
+        if self.chunksize<=1 and not self.writers:
+          self.tree.Fill()
+          return
+        if self.row is None:
+          self.initBuffers()
+        self.buffer[self.nbuffered] = self.row[0]
+        self.nbuffered += 1
+        if self.nbuffered>=self.chunksize:
+          self.flush()
+        
+    def flush(self):
+        """Write the buffered rows to the other output formats, and to the tree, in bulk with
+        root_numpy if available, or else row by row through the record, which is the address of all branches."""
+        if self.nbuffered==0:
+          return
+        rows    = self.buffer[:self.nbuffered]
+        columns = rows.astype(self.getColumnDtype())
+        for writer in self.writers:
+          writer.write(columns)
+        if self.fillTree:
+          current = self.row.copy()
+          try:
+            from root_numpy import array2tree
+            array2tree(columns,tree=self.tree)
+            for name, rtype in self.branches: # restore addresses for filling directly
+              self.tree.SetBranchAddress(name,getattr(self,name))
+          except ImportError:
+            for row in rows:
+              self.row[0] = row
+              self.tree.Fill()
+          self.row[0] = current[0]
+        self.nbuffered = 0
+        
+    def getColumnDtype(self):
+        """Return the numpy type of the written columns, matching the ROOT types of the branches."""
+        return [(name,column_dtype[rtype]) for name, rtype in self.branches]
         
     def endJob(self):
+        self.flush()
+        for writer in self.writers:
+          writer.write(num.zeros(0,dtype=self.getColumnDtype())) # create all columns, even without selected events
+          writer.close([self.cutflow,self.pileup]+self.timing)
+        if not self.fillTree:
+          self.tree.SetDirectory(0)
         self.outputfile.Write()
         self.outputfile.Close()
         
 
 
 class DiLeptonBasicClass:
+    isoOrder = (+1,+1) # +1: smaller isolation value is better, -1: larger is better
+    
     def __init__(self, id1, pt1, iso1, id2, pt2, iso2):
         self.id1  = id1
         self.id2  = id2
@@ -279,6 +378,8 @@ class DiLeptonBasicClass:
         return True
     
 class LeptonTauPair(DiLeptonBasicClass):
+    isoOrder = (+1,-1)
+    
     def __gt__(self, oltau):
         """Override for tau isolation."""
         if   self.pt1  != oltau.pt1:  return self.pt1  > oltau.pt1  # greater = higher pT
@@ -288,6 +389,8 @@ class LeptonTauPair(DiLeptonBasicClass):
         return True
     
 class DiTauPair(DiLeptonBasicClass):
+    isoOrder = (-1,-1)
+    
     def __gt__(self, oditau):
         """Override for tau isolation."""
         if   self.pt1  != oditau.pt1:  return self.pt1  > oditau.pt1  # greater = higher pT
@@ -307,23 +410,6 @@ def bestDiLepton(diLeptons):
     return sorted(diLeptons, reverse=True)[0]
     
 
-def deltaR(eta1, phi1, eta2, phi2):
-    """Compute DeltaR."""
-    deta = eta1 - eta2
-    dphi = deltaPhi(phi1, phi2)
-    return sqrt( deta*deta + dphi*dphi )
-    
-def deltaPhi(phi1, phi2):
-    """Computes Delta phi, handling periodic limit conditions."""
-    res = phi1 - phi2
-    while res > pi:
-      res -= 2*pi
-    while res < -pi:
-      res += 2*pi
-    return res
-    
-
-
 def genmatch(event,index,out=None):
     """Match reco tau to gen particles, as there is a bug in the nanoAOD matching
     for lepton to tau fakes of taus reconstructed as DM1."""
@@ -463,57 +549,4 @@ def fillFlagHistogram(hist,particle):
   elif particle.status==51:           hist.Fill(12) # status==51
   elif particle.status==52:           hist.Fill(13) # status==52
   else:                               hist.Fill(14) # other status
-
-
-
-def extraLeptonVetos(event, muon_idxs, electron_idxs, channel):
-    
-    extramuon_veto = False
-    extraelec_veto = False
-    dilepton_veto  = False
-    
-    LooseMuons = [ ]
-    for imuon in range(event.nMuon):
-        if event.Muon_pt[imuon] < 10: continue
-        if abs(event.Muon_eta[imuon]) > 2.4: continue
-        if abs(event.Muon_dz[imuon]) > 0.2: continue
-        if abs(event.Muon_dxy[imuon]) > 0.045: continue
-        if event.Muon_pfRelIso04_all[imuon] > 0.3: continue
-        if event.Muon_mediumId[imuon] > 0.5 and (imuon not in muon_idxs):
-            extramuon_veto = True
-        if event.Muon_pt[imuon] > 15 and event.Muon_isPFcand[imuon]: #Muon_isGlobal[imuon] and Muon_isTracker[imuon]
-            LooseMuons.append(imuon)
     
-    LooseElectrons = [ ]
-    for ielectron in range(event.nElectron):
-        if event.Electron_pt[ielectron] < 10: continue
-        if abs(event.Electron_eta[ielectron]) > 2.5: continue
-        if abs(event.Electron_dz[ielectron]) > 0.2: continue
-        if abs(event.Electron_dxy[ielectron]) > 0.045: continue
-        if event.Electron_pfRelIso03_all[ielectron] > 0.3: continue
-        if event.Electron_convVeto[ielectron] ==1 and ord(event.Electron_lostHits[ielectron]) <= 1 and event.Electron_mvaFall17V2Iso_WP90[ielectron] > 0.5 and (ielectron not in electron_idxs):
-            extraelec_veto = True
-        if event.Electron_pt[ielectron] > 15 and event.Electron_mvaFall17V2Iso_WPL[ielectron] > 0.5:
-            LooseElectrons.append(ielectron)
-    
-    if channel=='mutau':
-      for idx1 in LooseMuons:
-        for idx2 in LooseMuons:
-            if idx1 >= idx2: continue 
-            dR = deltaR(event.Muon_eta[idx1], event.Muon_phi[idx1], 
-                        event.Muon_eta[idx2], event.Muon_phi[idx2])
-            if event.Muon_charge[idx1] * event.Muon_charge[idx2] < 0 and dR > 0.15:
-                dilepton_veto = True
-    
-    if channel=='eletau':
-      for idx1 in LooseElectrons:
-        for idx2 in LooseElectrons:
-            if idx1 >= idx2: continue 
-            dR = deltaR(event.Electron_eta[idx1], event.Electron_phi[idx1], 
-                        event.Electron_eta[idx2], event.Electron_phi[idx2])
-            if event.Electron_charge[idx1] * event.Electron_charge[idx2] < 0 and dR > 0.15:
-                dilepton_veto = True
-    
-    return extramuon_veto, extraelec_veto, dilepton_veto
-    
-
@@ -6,9 +6,9 @@ from TreeProducerCommon import *
 
 class TreeProducerEleMu(TreeProducerCommon):
     
-    def __init__(self, name):
+    def __init__(self, name, **kwargs):
         
-        super(TreeProducerEleMu, self).__init__(name)
+        super(TreeProducerEleMu, self).__init__(name,**kwargs)
         print 'TreeProducerEleMu is called', name
         
         
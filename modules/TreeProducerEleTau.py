@@ -5,8 +5,8 @@ from TreeProducerCommon import *
 
 class TreeProducerEleTau(TreeProducerCommon):
 
-    def __init__(self, name):
-        super(TreeProducerEleTau, self).__init__(name)
+    def __init__(self, name, **kwargs):
+        super(TreeProducerEleTau, self).__init__(name,**kwargs)
         print 'TreeProducerEleTau is called', name
         
         
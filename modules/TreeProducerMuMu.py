@@ -6,9 +6,9 @@ from TreeProducerCommon import *
 
 class TreeProducerMuMu(TreeProducerCommon):
 
-    def __init__(self, name):
+    def __init__(self, name, **kwargs):
 
-        super(TreeProducerMuMu, self).__init__(name)
+        super(TreeProducerMuMu, self).__init__(name,**kwargs)
         print 'TreeProducerMuMu is called', name
         
         
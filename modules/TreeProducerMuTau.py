@@ -5,9 +5,9 @@ from TreeProducerCommon import *
 
 class TreeProducerMuTau(TreeProducerCommon):
 
-    def __init__(self, name):
+    def __init__(self, name, **kwargs):
         
-        super(TreeProducerMuTau, self).__init__(name)
+        super(TreeProducerMuTau, self).__init__(name,**kwargs)
         print 'TreeProducerMuTau is called', name
         
         
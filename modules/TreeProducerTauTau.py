@@ -2,9 +2,9 @@ from TreeProducerCommon import *
 
 class TreeProducerTauTau(TreeProducerCommon):
 
-    def __init__(self, name):
+    def __init__(self, name, **kwargs):
         
-        super(TreeProducerTauTau, self).__init__(name)
+        super(TreeProducerTauTau, self).__init__(name,**kwargs)
         print 'TreeProducerTauTau is called', name
         
         
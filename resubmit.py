@@ -4,8 +4,8 @@ import os, glob, sys, shlex, re
 from commands import getoutput
 from argparse import ArgumentParser
 import submit, checkFiles
-from checkFiles import getSampleShortName, matchSampleToPattern, header
-from submit import args, bcolors, nFilesPerJob_defaults, createJobs, getFileListLocal, getFileListPNFS, getFileListDAS, submitJobs, split_seq
+from checkFiles import getSampleShortName, matchSampleToPattern, header, getOutputTags
+from submit import args, bcolors, nFilesPerJob_defaults, createJobs, useChannel, getFileListLocal, saveFileListLocal, getFileListPNFS, getFileListDAS, submitJobs, split_seq
 import itertools
 import subprocess
 from ROOT import TFile, Double
@@ -15,20 +15,22 @@ parser.add_argument('-f', '--force',   dest='force', action='store_true', defaul
                                        help="submit jobs without asking confirmation" )
 parser.add_argument('-y', '--year',    dest='years', choices=[2016,2017,2018], type=int, nargs='+', default=[2017], action='store',
                                        help="select year" )
-parser.add_argument('-c', '--channel', dest='channels', choices=['eletau','mutau','tautau','mumu'], type=str, nargs='+', default=['mutau'], action='store',
+parser.add_argument('-c', '--channel', dest='channels', choices=['eletau','mutau','tautau','mumu','elemu'], type=str, nargs='+', default=['mutau'], action='store',
                                        help="channels to submit" )
+parser.add_argument('-C', '--combine', dest='combine', action='store_true', default=False,
+                                       help="resubmit jobs that ran all channels of a sample, as submitted with submit.py -C" )
 parser.add_argument('-s', '--sample',  dest='samples', type=str, nargs='+', default=[ ], action='store',
                                        help="filter these samples, glob patterns (wildcards * and ?) are allowed." )
 parser.add_argument('-x', '--veto',    dest='vetos', type=str, nargs='+', default=[ ], action='store',
                                        help="veto this sample" )
 parser.add_argument('-t', '--type',    dest='type', choices=['data','mc'], type=str, default=None, action='store',
                                        help="filter data or MC to submit" )
-parser.add_argument('-T', '--tes',     dest='tes', type=float, default=1.0, action='store',
-                                       help="tau energy scale" )
-parser.add_argument('-L', '--ltf',     dest='ltf', type=float, default=1.0, action='store',
-                                       help="lepton to tau fake energy scale" )
-parser.add_argument('-J', '--jtf',     dest='jtf', type=float, default=1.0, action='store',
-                                       help="jet to tau fake energy scale" )
+parser.add_argument('-T', '--tes',     dest='tes', type=float, nargs='+', default=[1.0], action='store',
+                                       help="tau energy scale(s), as submitted" )
+parser.add_argument('-L', '--ltf',     dest='ltf', type=float, nargs='+', default=[1.0], action='store',
+                                       help="lepton to tau fake energy scale(s)" )
+parser.add_argument('-J', '--jtf',     dest='jtf', type=float, nargs='+', default=[1.0], action='store',
+                                       help="jet to tau fake energy scale(s)" )
 parser.add_argument('-M', '--Zmass',   dest='Zmass', action='store_true', default=False,
                                        help="use Z mass window for dimuon spectrum" )
 parser.add_argument('-d', '--das',     dest='useDAS', action='store_true', default=False,
@@ -45,6 +47,15 @@ args = parser.parse_args()
 checkFiles.args = args
 submit.args = args
 
+chunkpattern = re.compile(r".*_(\d+)_[a-z]+(?:_[A-Z]+\dp\d+)?(?:_Zmass)?\.root")
+def isGoodFile(filename):
+    """Check if an output file has the tree and cutflow."""
+    file = TFile(filename,'READ')
+    isgood = not file.IsZombie() and file.GetListOfKeys().Contains('tree') and file.GetListOfKeys().Contains('cutflow')
+    file.Close()
+    return isgood
+    
+
 def main():
     
     channels     = args.channels
@@ -56,12 +67,14 @@ def main():
     batchSystem  = 'psibatch_runner.sh'
     tag          = ""
     
-    if tes!=1.: tag += "_TES%.3f"%(tes)
-    if ltf!=1.: tag += "_LTF%.3f"%(ltf)
-    if jtf!=1.: tag += "_JTF%.3f"%(jtf)
-    if Zmass:   tag += "_Zmass"
+    if tes!=[1.]: tag += "_TES"+'_'.join("%.3f"%v for v in tes)
+    if ltf!=[1.]: tag += "_LTF"+'_'.join("%.3f"%v for v in ltf)
+    if jtf!=[1.]: tag += "_JTF"+'_'.join("%.3f"%v for v in jtf)
+    if Zmass:     tag += "_Zmass"
     tag = tag.replace('.','p')
-    chunkpattern = re.compile(r".*_(\d+)_[a-z]+%s\.root"%tag)
+    if args.combine and Zmass:
+      print bcolors.BOLD + bcolors.FAIL + "ERROR! Channels cannot be combined in one job with the Z mass window." + bcolors.ENDC
+      exit(1)
     
     for year in years:
       
@@ -81,17 +94,24 @@ def main():
         print samplelist
       
       # RESUBMIT samples
-      for channel in channels:
-        print header(year,channel,tag)
+      channelgroups = [channels] if args.combine else [[c] for c in channels]
+      for channelgroup in channelgroups:
+        print header(year,', '.join(channelgroup),tag)
         
         for directory in samplelist:
             #if directory.find('W4JetsToLNu_TuneCP5_13TeV-madgraphMLM-pythia8__ytakahas-NanoTest_20180507_W4JetsToLNu_TuneCP5_13TeV-madgraphMLM-pythia8-a7a5b67d3e3590e4899e147be08660be__USER')==-1: continue
+            
+            # OUTPUT of each channel and variation of a job, as written by job.py
+            sample_channels = [c for c in channelgroup if useChannel(directory,c)]
+            if not sample_channels: continue
+            channel      = '_'.join(sample_channels)
+            outputs      = [ (c,t) for c in sample_channels for t in getOutputTags(c,tes,ltf,jtf,Zmass and c=='mumu') ]
             outdir       = "output_%s/%s"%(year,directory)
-            outfilelist  = glob.glob("%s/*_%s%s.root"%(outdir,channel,tag))
+            outfilelist  = [ f for c, t in outputs for f in glob.glob("%s/*_%s%s.root"%(outdir,c,t)) ]
             nFilesPerJob = args.nFilesPerJob
             jobName      = getSampleShortName(directory)[1]
             jobName     += "_%s_%s"%(channel,year)+tag
-            if not outfilelist: continue            
+            if not outfilelist: continue
             
             # FILE LIST
             infiles = [ ]
@@ -128,43 +148,40 @@ def main():
             infilelists = list(split_seq(infiles,nFilesPerJob))
             
             # JOB LIST
+            # a chunk is one job, writing one file per channel and variation,
+            # resubmit it once if any of them is bad or missing
             badchunks   = [ ]
-            misschunks  = range(0,len(infilelists))
+            misschunks  = [ ]
             jobList = 'joblist/joblist_%s_%s%s_retry.txt'%(directory,channel,tag)
             with open(jobList, 'w') as jobslog:
               for filename in outfilelist:
                   match = chunkpattern.search(filename)
-                  if match:
-                    chunk = int(match.group(1))
-                  else:
+                  if not match:
                     print bcolors.BOLD + bcolors.FAIL + '[NG] did not recognize output file %s !'%(filename) + bcolors.ENDC
                     exit(1)
-                  if chunk in misschunks:
-                    misschunks.remove(chunk)
-                  elif chunk >= len(infilelists):
+                  chunk = int(match.group(1))
+                  if chunk >= len(infilelists):
                     print bcolors.BOLD + bcolors.FAIL + '[WN] %s: found chunk %s >= total number of chunks %s ! Please make sure you have chosen the correct number of files per job (-n=%s), check DAS, or resubmit everything!'%(filename,chunk,len(infilelists),nFilesPerJob) + bcolors.ENDC
+              for chunk, infiles in enumerate(infilelists):
+                  filenames = [ "%s/%s_%d_%s%s.root"%(outdir,directory,chunk,c,t) for c, t in outputs ]
+                  existing  = [ f for f in filenames if os.path.isfile(f) ]
+                  if not existing:
+                    misschunks.append(chunk)
+                  elif len(existing)<len(filenames) or not all(isGoodFile(f) for f in existing):
+                    badchunks.append(chunk)
                   else:
-                    print bcolors.BOLD + bcolors.FAIL + '[WN] %s: found weird chunk %s ! Please check if there is any overcounting !'%(filename,chunk,len(infilelists)) + bcolors.ENDC
-                  file = TFile(filename,'READ')
-                  if not file.IsZombie() and file.GetListOfKeys().Contains('tree') and file.GetListOfKeys().Contains('cutflow'):
                     continue
-                  infiles = infilelists[chunk]
-                  createJobs(jobslog,infiles,outdir,directory,chunk,channel,year=year,tes=tes,ltf=ltf,jtf=jtf,Zmass=Zmass)
-                  badchunks.append(chunk)
+                  createJobs(jobslog,infiles,outdir,directory,chunk,sample_channels,year=year,tes=tes,ltf=ltf,jtf=jtf,Zmass=Zmass)
               
               # BAD CHUNKS
               if len(badchunks)>0:
-                badchunks.sort()
                 chunktext = ('chunks ' if len(badchunks)>1 else 'chunk ') + ', '.join(str(ch) for ch in badchunks)
-                print bcolors.BOLD + bcolors.WARNING + '[NG] %s, %d/%d failed!\n     Resubmitting %s...'%(directory,len(badchunks),len(outfilelist),chunktext) + bcolors.ENDC
+                print bcolors.BOLD + bcolors.WARNING + '[NG] %s, %d/%d failed!\n     Resubmitting %s...'%(directory,len(badchunks),len(infilelists),chunktext) + bcolors.ENDC
               
               # MISSING CHUNKS
               if len(misschunks)>0:
                 chunktext = ('chunks ' if len(misschunks)>1 else 'chunk ') + ', '.join(str(i) for i in misschunks)
-                print bcolors.BOLD + bcolors.WARNING + "[WN] %s missing %d/%d files !\n     Resubmitting %s..."%(directory,len(misschunks),len(outfilelist),chunktext) + bcolors.ENDC
-                for chunk in misschunks:
-                  infiles = infilelists[chunk]
-                  createJobs(jobslog,infiles,outdir,directory,chunk,channel,year=year,tes=tes,ltf=ltf,jtf=jtf,Zmass=Zmass)
+                print bcolors.BOLD + bcolors.WARNING + "[WN] %s missing %d/%d jobs !\n     Resubmitting %s..."%(directory,len(misschunks),len(infilelists),chunktext) + bcolors.ENDC
             
             # RESUBMIT
             nChunks = len(badchunks)+len(misschunks)
@@ -14,20 +14,22 @@ if __name__ == "__main__":
                                            help="submit jobs without asking confirmation" )
   parser.add_argument('-y', '--year',      dest='years', choices=[2016,2017,2018], type=int, nargs='+', default=[2017], action='store',
                                            help="select year" )
-  parser.add_argument('-c', '--channel',   dest='channels', choices=['eletau','mutau','tautau','mumu'], type=str, nargs='+', default=['mutau'], action='store',
+  parser.add_argument('-c', '--channel',   dest='channels', choices=['eletau','mutau','tautau','mumu','elemu'], type=str, nargs='+', default=['mutau'], action='store',
                                            help="channels to submit" )
+  parser.add_argument('-C', '--combine',   dest='combine', action='store_true', default=False,
+                                           help="run all channels of a sample in a single job, reading each input file once" )
   parser.add_argument('-s', '--sample',    dest='samples', type=str, nargs='+', default=[ ], action='store',
                                            help="filter these samples, glob patterns (wildcards * and ?) are allowed." )
   parser.add_argument('-x', '--veto',      dest='vetos', nargs='+', default=[ ], action='store',
                                            help="veto this sample" )
   parser.add_argument('-t', '--type',      dest='type', choices=['data','mc'], type=str, default=None, action='store',
                                            help="filter data or MC to submit" )
-  parser.add_argument('-T', '--tes',       dest='tes', type=float, default=1.0, action='store',
-                                           help="tau energy scale" )
-  parser.add_argument('-L', '--ltf',       dest='ltf', type=float, default=1.0, action='store',
-                                           help="lepton to tau fake energy scale" )
-  parser.add_argument('-J', '--jtf',       dest='jtf', type=float, default=1.0, action='store',
-                                           help="jet to tau fake energy scale" )
+  parser.add_argument('-T', '--tes',       dest='tes', type=float, nargs='+', default=[1.0], action='store',
+                                           help="tau energy scale(s), several variations are run in the same job" )
+  parser.add_argument('-L', '--ltf',       dest='ltf', type=float, nargs='+', default=[1.0], action='store',
+                                           help="lepton to tau fake energy scale(s)" )
+  parser.add_argument('-J', '--jtf',       dest='jtf', type=float, nargs='+', default=[1.0], action='store',
+                                           help="jet to tau fake energy scale(s)" )
   parser.add_argument('-M', '--Zmass',     dest='Zmass', action='store_true', default=False,
                                            help="use Z mass window for dimuon spectrum" )
   parser.add_argument('-d', '--das',       dest='useDAS', action='store_true', default=False,
@@ -144,20 +146,29 @@ def getFileListPNFS(dataset):
     return filelist
     
 
+def useChannel(directory, channel):
+    """Check if a channel should run on a sample."""
+    if 'SingleMuon' in directory and channel not in ['mutau','mumu','elemu']: return False
+    if ('SingleElectron' in directory or 'EGamma' in directory) and channel!='eletau': return False
+    if 'Tau' in directory[:5] and channel!='tautau': return False
+    if 'LQ3' in directory[:5] and channel not in ['mutau','eletau','tautau']: return False
+    return True
+    
+
 def createJobs(jobsfile, infiles, outdir, name, nchunks, channel, year, **kwargs):
-    """Create file with commands to execute per job."""
+    """Create file with commands to execute per job. Several channels, or
+    energy scale variations can be passed as a list, to run them in one job."""
     tes     = kwargs.get('tes',   1.)
     ltf     = kwargs.get('ltf',   1.)
     jtf     = kwargs.get('jtf',   1.)
     Zmass   = kwargs.get('Zmass', False)
-    cmd = 'python job.py -i %s -o %s -N %s -n %i -c %s -y %s'%(','.join(infiles),outdir,name,nchunks,channel,year)
-    if tes!=1.:
-      cmd += " --tes %.3f"%(tes)
-    if ltf!=1.:
-      cmd += " --ltf %.3f"%(ltf)
-    if jtf!=1.:
-      cmd += " --jtf %.3f"%(jtf)
-    if Zmass and channel=='mumu':
+    channels = channel if isinstance(channel,list) else [channel]
+    cmd = 'python job.py -i %s -o %s -N %s -n %i -c %s -y %s'%(','.join(infiles),outdir,name,nchunks,' '.join(channels),year)
+    for option, values in [('tes',tes),('ltf',ltf),('jtf',jtf)]:
+      values = values if isinstance(values,list) else [values]
+      if values!=[1.]:
+        cmd += " --%s %s"%(option,' '.join("%.3f"%v for v in values))
+    if Zmass and channels==['mumu']:
       cmd += " --Zmass"
     if args.verbose:
       print cmd
@@ -193,11 +204,14 @@ def main():
     batchSystem = 'psibatch_runner.sh'
     tag         = ""
     
-    if tes!=1.: tag += "_TES%.3f"%(tes)
-    if ltf!=1.: tag += "_LTF%.3f"%(ltf)
-    if jtf!=1.: tag += "_JTF%.3f"%(jtf)
-    if Zmass:   tag += "_Zmass"
+    if tes!=[1.]: tag += "_TES"+'_'.join("%.3f"%v for v in tes)
+    if ltf!=[1.]: tag += "_LTF"+'_'.join("%.3f"%v for v in ltf)
+    if jtf!=[1.]: tag += "_JTF"+'_'.join("%.3f"%v for v in jtf)
+    if Zmass:     tag += "_Zmass"
     tag = tag.replace('.','p')
+    if args.combine and Zmass:
+      print bcolors.BOLD + bcolors.FAIL + "ERROR! Channels cannot be combined in one job with the Z mass window." + bcolors.ENDC
+      exit(1)
     
     for year in years:
       
@@ -216,8 +230,9 @@ def main():
           directories.append(line)
       #print directories
       
-      for channel in channels:
-        print header(year,channel,tag)
+      channelgroups = [channels] if args.combine else [[c] for c in channels]
+      for channelgroup in channelgroups:
+        print header(year,', '.join(channelgroup),tag)
         
         # SUBMIT SAMPLES
         for directory in directories:
@@ -226,10 +241,9 @@ def main():
               print "\ndirectory =",directory
             
             # FILTER
-            if 'SingleMuon' in directory and channel not in ['mutau','mumu','elemu']: continue
-            if ('SingleElectron' in directory or 'EGamma' in directory) and channel!='eletau': continue
-            if 'Tau' in directory[:5] and channel!='tautau': continue
-            if 'LQ3' in directory[:5] and channel not in ['mutau','eletau','tautau']: continue
+            sample_channels = [c for c in channelgroup if useChannel(directory,c)]
+            if not sample_channels: continue
+            channel = '_'.join(sample_channels)
             
             print bcolors.BOLD + bcolors.OKGREEN + directory + bcolors.ENDC
             
@@ -280,11 +294,12 @@ def main():
             
             # CREATE JOBS
             nChunks = 0
-            checkExistingFiles(outdir,channel,len(filelists))
+            for c in sample_channels:
+              checkExistingFiles(outdir,c,len(filelists))
             #filelists = list(split_seq(files,1))
             for file in filelists:
             #print "FILES = ",f
-                createJobs(jobs,file,outdir,name,nChunks,channel,year=year,tes=tes,ltf=ltf,jtf=jtf,Zmass=Zmass)
+                createJobs(jobs,file,outdir,name,nChunks,sample_channels,year=year,tes=tes,ltf=ltf,jtf=jtf,Zmass=Zmass)
                 nChunks = nChunks+1
             jobs.close()
             
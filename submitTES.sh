@@ -7,12 +7,13 @@ OPTIONS=""
 CHECKDAS=0
 RESUBMIT=0
 REMOVE=0
+ONEJOB=0
 VARFLAG="--tes"
 TES_FIRST=0.972
 TES_LAST=1.028
 STEP_SIZE=0.002
 VARIATIONS=`seq $TES_FIRST $STEP_SIZE $TES_LAST`
-while getopts "aCc:dcfJLmRrs:Tvx:y:" option; do case "${option}" in
+while getopts "aCc:dcfJLmRrSs:Tvx:y:" option; do case "${option}" in
   a) OPTIONS+=" -a"; CHECKDAS=1;;
   C) CHECKDAS=1;;
   c) CHANNELS="${OPTARG}";;
@@ -23,6 +24,7 @@ while getopts "aCc:dcfJLmRrs:Tvx:y:" option; do case "${option}" in
   m) OPTIONS+=" -m";;
   R) RESUBMIT=1;;
   r) OPTIONS+=" -r"; REMOVE=1;;
+  S) ONEJOB=1;; # run all variations in the same jobs
   s) SAMPLES="${OPTARG}";;
   T) VARFLAG="--tes"; VARIATIONS="0.970 1.030";;
   v) OPTIONS+=" -v";;
@@ -36,6 +38,10 @@ for year in $YEARS; do
   [[ $year = '#'* ]] && continue
   for channel in $CHANNELS; do
     [[ $channel = '#'* ]] && continue
+    if [ $ONEJOB -gt 0 -a $CHECKDAS -eq 0 -a $RESUBMIT -eq 0 -a $REMOVE -eq 0 ]; then
+      peval "./submit.py -c $channel -y $year $VARFLAG `echo $VARIATIONS | sed 's/\b1\.000\b//'` $OPTIONS"
+      continue
+    fi
     for var in $VARIATIONS; do
       [[ $var = 1.000 ]] && continue
       